@@ -0,0 +1,318 @@
+"""
+Analysis of the profile databases written by the Stages API when `PROFILE_STAGES_API` is enabled.
+
+See :func:`~pulpcore.plugin.stages.create_profile_db_and_connection` for the layout of the
+database. Each queue of the pipeline is recorded under the stage it feeds into. The waiting and
+service times of a stage are recorded when it puts an item into the queue of the next stage, so the
+last stage of a pipeline has none. A task running several pipelines records all of them in the same
+database, one after the other.
+
+Print a report with::
+
+    $ python -m pulpcore.plugin.profile_analysis /var/lib/pulp/debug/<task id>
+
+or with the `pulp-stages-profile` command.
+"""
+import argparse
+from gettext import gettext as _
+import math
+import sqlite3
+import sys
+
+
+class StageReport:
+    """
+    The statistics of one stage of a profiled pipeline.
+
+    Times are in seconds.
+
+    Attributes:
+        name (str): The dotted path of the stage class.
+        num (int): The position of the stage in the pipeline.
+        arrivals (int): The number of items put into the input queue of the stage.
+        arrival_rate (float): The number of items arriving per second.
+        mean_queue_length (float): The mean length of the input queue, measured at each arrival.
+            A stage puts the items of a batch without waiting until the queue is full, so the queue
+            after a batched stage looks long at arrivals even when it is emptied right away.
+        p95_queue_length (float): The 95th percentile of the length of the input queue.
+        items (int): The number of items with waiting and service times.
+        mean_waiting_time (float): The mean time an item waited in the input queue.
+        p95_waiting_time (float): The 95th percentile of the waiting time.
+        mean_service_time (float): The mean time an item spent in the stage.
+        p95_service_time (float): The 95th percentile of the service time.
+        duration (float): The time from the creation of the input queue until the last item left
+            the stage, estimated as the time of the last arrival plus the longest time an item
+            waited and spent in the stage.
+        mean_in_service (float): The mean number of items in the stage over the duration by Little's
+            law, the total service time divided by the duration. It is not a utilization: a stage
+            handling batches or concurrent items keeps many items in service while mostly waiting
+            for input.
+        little_queue_length (float): The mean queue length over the duration by Little's law, the
+            total waiting time divided by the duration.
+        maxsize (int): The maxsize of the input queue, 0 if it is unbounded, or None if it was not
+            recorded.
+        queue_fill (float): The Little's law queue length as a fraction of the maxsize, i.e. how
+            full the input queue was on average over the duration, or None if the queue is unbounded
+            or its maxsize was not recorded.
+    """
+
+    def __init__(self, name, num, lengths, interarrival_times, waiting_times, service_times,
+                 maxsize=None):
+        self.name = name
+        self.num = num
+        self.maxsize = maxsize
+        self.arrivals = len(lengths)
+        elapsed = sum(interarrival_times)
+        self.arrival_rate = self.arrivals / elapsed if elapsed > 0 else 0
+        self.mean_queue_length = _mean(lengths)
+        self.p95_queue_length = _percentile(lengths, 95)
+        self.items = len(service_times)
+        self.mean_waiting_time = _mean(waiting_times)
+        self.p95_waiting_time = _percentile(waiting_times, 95)
+        self.mean_service_time = _mean(service_times)
+        self.p95_service_time = _percentile(service_times, 95)
+        self.duration = elapsed + max(
+            (waiting_time + service_time
+             for waiting_time, service_time in zip(waiting_times, service_times)),
+            default=0
+        )
+        if self.duration > 0:
+            self.mean_in_service = sum(service_times) / self.duration
+            self.little_queue_length = sum(waiting_times) / self.duration
+        else:
+            self.mean_in_service = self.little_queue_length = 0
+        self.queue_fill = self.little_queue_length / maxsize if maxsize else None
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else 0
+
+
+def _percentile(values, percent):
+    """
+    The nearest-rank percentile of `values`, or 0 if there are none.
+    """
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def analyze(db_path):
+    """
+    Compute the statistics of each stage recorded in a profile database.
+
+    Args:
+        db_path (str): The path of the sqlite3 profile database.
+
+    Returns:
+        list: For each pipeline recorded, in the order they ran, a list of the :class:`StageReport`
+            of its stages, in pipeline order.
+    """
+    connection = sqlite3.connect(db_path)
+    try:
+        try:
+            stages = connection.execute(
+                'SELECT uuid, name, num, maxsize FROM stages ORDER BY rowid'
+            ).fetchall()
+        except sqlite3.OperationalError:
+            # Databases written before the maxsize was recorded
+            stages = connection.execute(
+                'SELECT uuid, name, num, NULL FROM stages ORDER BY rowid'
+            ).fetchall()
+        pipelines = []
+        for stage in stages:
+            # The queues of a pipeline are recorded in order, the numbers restart with the next one
+            if not pipelines or stage[2] <= pipelines[-1][-1][2]:
+                pipelines.append([])
+            pipelines[-1].append(stage)
+        return [_analyze_pipeline(connection, pipeline) for pipeline in pipelines]
+    finally:
+        connection.close()
+
+
+def _analyze_pipeline(connection, stages):
+    """
+    Compute the statistics of the stages of one pipeline.
+
+    Args:
+        connection (sqlite3.Connection): The connection to the profile database.
+        stages (list): The (uuid, name, num, maxsize) rows of the stages, in pipeline order.
+
+    Returns:
+        list: A :class:`StageReport` for each stage.
+    """
+    reports = []
+    for i, (uuid, name, num, maxsize) in enumerate(stages):
+        system = connection.execute(
+            'SELECT length, interarrival_time FROM system WHERE uuid = ? ORDER BY rowid', (uuid,)
+        ).fetchall()
+        if i + 1 < len(stages):
+            # The times of this stage are recorded when putting into the next queue
+            traffic = connection.execute(
+                'SELECT waiting_time, service_time FROM traffic WHERE uuid = ?',
+                (stages[i + 1][0],)
+            ).fetchall()
+        else:
+            traffic = []
+        reports.append(StageReport(
+            name, num,
+            lengths=[row[0] for row in system],
+            interarrival_times=[row[1] for row in system],
+            waiting_times=[row[0] for row in traffic],
+            service_times=[row[1] for row in traffic],
+            maxsize=maxsize,
+        ))
+    return reports
+
+
+def find_bottleneck(reports, threshold=0.5):
+    """
+    Find the stage limiting the throughput of the pipeline.
+
+    The queues between the stages are bounded. The input queue of a stage that cannot keep up fills
+    up, and once it is full the puts of the stage before it block, so the queues before it fill up
+    as well while the stages after it are starved. The bottleneck is the last stage whose input
+    queue was at least `threshold` full on average over time. A batched stage drains its queue at
+    each batch. While it keeps up, its queue holds the items arriving during one batch, so it is
+    less than half full on average.
+
+    The number of items in service is not compared: a stage handling batches or concurrent items
+    keeps many items in service even when it mostly waits for input. Neither are the queue lengths
+    measured at arrivals: the queue after a batched stage fills up with each batch, even when the
+    next stage empties it right away.
+
+    Args:
+        reports (list): The :class:`StageReport` of the stages.
+        threshold (float): The mean fraction of the maxsize a queue holds when it is backed up.
+
+    Returns:
+        The :class:`StageReport` of the bottleneck, or None if no bounded queue was backed up, i.e.
+        the stages keep up with the first stage.
+    """
+    backed_up = [
+        report for report in reports
+        if report.queue_fill is not None and report.queue_fill >= threshold
+    ]
+    if not backed_up:
+        return None
+    return max(backed_up, key=lambda report: report.num)
+
+
+def suggest(reports):
+    """
+    Suggest changes to the batch and queue sizes of the pipeline.
+
+    Args:
+        reports (list): The :class:`StageReport` of the stages.
+
+    Returns:
+        list: The suggestions, as strings.
+    """
+    if not any(report.items for report in reports):
+        return [_('No stage recorded service times, the pipeline is too short to analyze.')]
+    bottleneck = find_bottleneck(reports)
+    if bottleneck is None:
+        if any(report.queue_fill is None for report in reports):
+            return [_('No bounded input queue was backed up. Either the first stage, which '
+                      'produces the items, limits the pipeline, or the bottleneck has an unbounded '
+                      'input queue or was profiled before the queue sizes were recorded.')]
+        return [_('No input queue was backed up, the stages keep up with the first stage. Speed up '
+                  'the first stage, which produces the items, e.g. by fetching the metadata '
+                  'faster; larger queues or batches will not help.')]
+
+    suggestions = [
+        _('{name} is the bottleneck, its input queue was {fill:.0%} full on average. Run replicas '
+          'of it if it is replica_safe, or make its batches larger: about {batch} items arrive '
+          'during one second, the default batch_max_latency.').format(
+            name=bottleneck.name, fill=bottleneck.queue_fill,
+            batch=max(1, min(1000, round(bottleneck.arrival_rate)))
+        ),
+        _('An in_q_maxsize of about {size} for {name} holds the items arriving during the 95th '
+          'percentile waiting time. A deeper queue only holds more items in memory.').format(
+            name=bottleneck.name,
+            size=max(1, round(bottleneck.arrival_rate * bottleneck.p95_waiting_time))
+        ),
+    ]
+    for report in reports:
+        if report.num < bottleneck.num and report.items:
+            suggestions.append(
+                _('{name} is blocked by the bottleneck, its input queue fills up because its puts '
+                  'wait for the bottleneck. Speeding it up will not help.').format(name=report.name)
+            )
+        elif report.num > bottleneck.num and report.items:
+            suggestions.append(
+                _('{name} is starved by the bottleneck, its input queue is mostly empty. Larger '
+                  'queues or batches will not speed it up.').format(name=report.name)
+            )
+    return suggestions
+
+
+def format_report(reports):
+    """
+    Format the statistics of the stages, the bottleneck and the suggestions as text.
+
+    Args:
+        reports (list): The :class:`StageReport` of the stages.
+
+    Returns:
+        str: The report.
+    """
+    lines = []
+    for report in reports:
+        lines.append('{num}. {name}'.format(num=report.num, name=report.name))
+        lines.append(
+            _('    arrivals: {arrivals} ({rate:.2f}/s), queue length mean/p95: {length:.2f}/'
+              '{p95_length:.0f}, Little\'s law estimate: {little:.2f}').format(
+                arrivals=report.arrivals, rate=report.arrival_rate,
+                length=report.mean_queue_length, p95_length=report.p95_queue_length,
+                little=report.little_queue_length
+            )
+        )
+        if report.queue_fill is not None:
+            lines.append(
+                _('    queue fill over time: {fill:.0%} of {maxsize}').format(
+                    fill=report.queue_fill, maxsize=report.maxsize
+                )
+            )
+        if report.items:
+            lines.append(
+                _('    waiting time mean/p95: {wait:.4f}/{p95_wait:.4f}s, service time mean/p95: '
+                  '{service:.4f}/{p95_service:.4f}s, items in service: {in_service:.2f}').format(
+                    wait=report.mean_waiting_time, p95_wait=report.p95_waiting_time,
+                    service=report.mean_service_time, p95_service=report.p95_service_time,
+                    in_service=report.mean_in_service
+                )
+            )
+    lines.append('')
+    lines.extend(suggest(reports))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """
+    Print the report of each pipeline of a profile database.
+
+    Args:
+        argv (list): The command line arguments. Defaults to `sys.argv[1:]`.
+
+    Returns:
+        int: The exit status.
+    """
+    parser = argparse.ArgumentParser(
+        description=_('Analyze a Stages API profile database and report its bottleneck.')
+    )
+    parser.add_argument('file_path', help=_('The path to the sqlite3 db with the run data.'))
+    args = parser.parse_args(argv)
+    pipelines = analyze(args.file_path)
+    for i, reports in enumerate(pipelines, 1):
+        if len(pipelines) > 1:
+            print(_('Pipeline {num} of {count}').format(num=i, count=len(pipelines)))
+        print(format_report(reports))
+        if i < len(pipelines):
+            print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
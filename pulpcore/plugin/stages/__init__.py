@@ -1,16 +1,29 @@
-from .api import create_pipeline, EndStage, Stage  # noqa
+from .api import AdaptiveBatchSizer, create_pipeline, EndStage, Stage  # noqa
 from .artifact_stages import (  # noqa
     ArtifactDownloader,
     ArtifactSaver,
+    DownloadBudget,
     QueryExistingArtifacts,
     RemoteArtifactSaver,
 )
 from .association_stages import (  # noqa
     ContentAssociation,
+    ContentChunk,
     ContentUnassociation,
     RemoveDuplicates
 )
-from .content_stages import ContentSaver, QueryExistingContents, ResolveContentFutures  # noqa
+from .bloom import BloomFilter  # noqa
+from .content_stages import (  # noqa
+    ContentSaver,
+    DeferredContentSaver,
+    QueryExistingContents,
+    ResolveContentFutures,
+)
 from .declarative_version import DeclarativeVersion  # noqa
+from .executor import DatabaseExecutor  # noqa
+from .metrics import LogHistogram, pipeline_metrics, StageMetrics  # noqa
 from .models import DeclarativeArtifact, DeclarativeContent  # noqa
 from .profiler import ProfilingQueue, create_profile_db_and_connection  # noqa
+from .progress import ProgressThrottle  # noqa
+from .storage import DownloadDirectory  # noqa
+from .tracing import Tracer  # noqa
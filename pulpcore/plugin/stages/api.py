@@ -1,23 +1,134 @@
 import asyncio
 import logging
+import time
 
 from gettext import gettext as _
 
 from django.conf import settings
 
-from .profiler import ProfilingQueue
+from .executor import DatabaseExecutor
+from .metrics import StageMetrics
+from .profiler import debug_data_path, ProfilingQueue
+from .storage import DownloadDirectory
+from .tracing import NO_SPAN, Tracer
 
 
 log = logging.getLogger(__name__)
 
+try:
+    _current_task = asyncio.current_task
+except AttributeError:  # Python 3.6
+    _current_task = asyncio.Task.current_task
+
+
+class AdaptiveBatchSizer:
+    """
+    Adapts the minimum batch size of :meth:`Stage.batches` to the measured throughput of a stage.
+
+    After each batch, the time the stage spent handling it (the service time) and the number of
+    items waiting in its input queue are recorded. The next minimum batch size is chosen so that a
+    batch takes about `target_service_time` seconds to handle, within the `minsize` and `maxsize`
+    bounds. When no items were waiting the size does not grow, since upstream stages cannot fill
+    larger batches anyway. A partial batch is flushed after waiting `max_latency` seconds for more
+    items instead of waiting for stragglers.
+
+    Set an instance as the `batch_sizer` attribute of a stage to enable adaptive batching::
+
+        stage = ContentSaver()
+        stage.batch_sizer = AdaptiveBatchSizer(minsize=10, maxsize=500)
+
+    Args:
+        minsize (int): The lower bound of the minimum batch size. Defaults to 10.
+        maxsize (int): The upper bound of the minimum batch size. Defaults to 1000.
+        target_service_time (float): The number of seconds handling a batch should take. Defaults
+            to 1.0.
+        max_latency (float): The number of seconds a partial batch waits for more items before it
+            is yielded anyway. Defaults to 1.0.
+    """
+
+    def __init__(self, minsize=10, maxsize=1000, target_service_time=1.0, max_latency=1.0):
+        if not 0 < minsize <= maxsize:
+            raise ValueError(_('AdaptiveBatchSizer requires 0 < minsize <= maxsize.'))
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.target_service_time = target_service_time
+        self.max_latency = max_latency
+        self.size = minsize
+
+    def record(self, batch_size, service_time, queue_depth):
+        """
+        Record the handling of a batch and compute the next minimum batch size.
+
+        Args:
+            batch_size (int): The number of items in the handled batch.
+            service_time (float): The number of seconds the stage spent handling the batch.
+            queue_depth (int): The number of items waiting in the input queue afterwards.
+
+        Returns:
+            int: The next minimum batch size.
+        """
+        if service_time > 0:
+            wanted = self.target_service_time * batch_size / service_time
+        else:
+            wanted = self.maxsize
+        if not queue_depth:
+            wanted = min(wanted, batch_size)
+        # Move halfway to the wanted size to smooth out noisy measurements
+        size = int(round((self.size + wanted) / 2))
+        self.size = max(self.minsize, min(self.maxsize, size))
+        return self.size
+
+
+class _Replicas:
+    """
+    Bookkeeping shared by the replicas of a stage, which all use the same input and output queues.
+
+    Args:
+        count (int): The number of replicas.
+    """
+
+    def __init__(self, count):
+        self.running = count
+
 
 class Stage:
     """
     The base class for all Stages API stages.
 
     To make a stage, inherit from this class and implement :meth:`run` on the subclass.
+
+    Attributes:
+        batch_maxsize (int): The preferred maximum batch size of the :meth:`batches` iterator of
+            this stage. Defaults to `None`, meaning unbounded.
+        batch_max_latency (float): The preferred number of seconds a partial batch of the
+            :meth:`batches` iterator of this stage waits for more items before it is yielded.
+            Defaults to `None`, meaning it waits until `minsize` items are available.
+        batch_sizer (:class:`~pulpcore.plugin.stages.AdaptiveBatchSizer`): When set, the
+            :meth:`batches` iterator of this stage adapts its batch size. Defaults to `None`.
+        in_q_maxsize (int): The maximum amount of items the input queue of this stage should hold
+            when built by :func:`~pulpcore.plugin.stages.create_pipeline`. Defaults to `None`,
+            meaning the `maxsize` passed to :func:`~pulpcore.plugin.stages.create_pipeline`.
+        replica_safe (bool): Whether several instances of this stage may run as replicas sharing
+            their input and output queues. See :func:`~pulpcore.plugin.stages.create_pipeline`.
+            Defaults to `False`.
+
+    Each stage records :class:`~pulpcore.plugin.stages.StageMetrics` in :meth:`items`,
+    :meth:`batches` and :meth:`put`, available as its `metrics` attribute. When tracing is enabled,
+    they also record spans with the :class:`~pulpcore.plugin.stages.Tracer` of the pipeline.
     """
 
+    batch_maxsize = None
+    batch_max_latency = None
+    batch_sizer = None
+    in_q_maxsize = None
+    replica_safe = False
+    _replicas = None
+    _db_executor = None
+    _temp_dir = None
+    _metrics = None
+    _tracer = None
+    _trace_track = None
+
     def __init__(self):
         self._in_q = None
         self._out_q = None
@@ -33,17 +144,45 @@ class Stage:
         self._in_q = in_q
         self._out_q = out_q
 
+    @property
+    def metrics(self):
+        """
+        The :class:`~pulpcore.plugin.stages.StageMetrics` of this stage.
+        """
+        if self._metrics is None:
+            self._metrics = StageMetrics()
+        return self._metrics
+
     async def __call__(self):
         """
         This coroutine makes the stage callable.
 
-        It calls :meth:`run` and signals the next stage that its work is finished.
+        It calls :meth:`run` and signals the next stage that its work is finished. Replicas of a
+        stage only signal it once the last replica is finished.
         """
         log.debug(_('%(name)s - begin.'), {'name': self})
-        await self.run()
+        self.metrics.start()
+        try:
+            await self.run()
+        finally:
+            self.metrics.finish()
+        if self._replicas is not None:
+            self._replicas.running -= 1
+            if self._replicas.running:
+                log.debug(_('%(name)s - replica finished.'), {'name': self})
+                return
         await self._out_q.put(None)
         log.debug(_('%(name)s - put end-marker.'), {'name': self})
 
+    def _end_of_input(self):
+        """
+        Handle the end-marker received from `self._in_q`.
+
+        Replicas put the end-marker back, so every replica sharing `self._in_q` receives it.
+        """
+        if self._replicas is not None:
+            self._in_q.put_nowait(None)
+
     async def run(self):
         """
         The coroutine that is run as part of this stage.
@@ -74,23 +213,54 @@ class Stage:
                             await self.put(d_content)
 
         """
+        metrics = self.metrics
+        tracer = self._tracer
         while True:
+            waiting_since = time.monotonic()
             content = await self._in_q.get()
             if content is None:
+                self._end_of_input()
                 break
             log.debug(_('%(name)s - next: %(content)s.'), {'name': self, 'content': content})
+            metrics.items_in += 1
+            yielded_at = time.monotonic()
+            metrics.wait_times.record(yielded_at - waiting_since)
+            # Stages may hand items over to other tasks, whose blocked puts overlap this span
+            task = _current_task()
+            put_blocked = metrics.put_blocked_by(task)
             yield content
-
-    async def batches(self, minsize=50):
+            resumed_at = time.monotonic()
+            metrics.service_times.record(
+                max(0, resumed_at - yielded_at - (metrics.put_blocked_by(task) - put_blocked))
+            )
+            if tracer is not None:
+                tracer.add_span(self._trace_track, 'wait', 'queue', waiting_since, yielded_at)
+                tracer.add_span(self._trace_track, 'item', 'stage', yielded_at, resumed_at)
+
+    async def batches(self, minsize=50, maxsize=None, max_latency=None, batch_sizer=None):
         """
         Asynchronous iterator yielding batches of :class:`DeclarativeContent` from `self._in_q`.
 
         The iterator will try to get as many instances of
         :class:`DeclarativeContent` as possible without blocking, but
-        at least `minsize` instances.
+        at least `minsize` instances and at most `maxsize` instances.
+
+        A partial batch is yielded once it waited `max_latency` seconds for more items, measured
+        from the arrival of its first item.
+
+        If a `batch_sizer` is used, its current size replaces `minsize` and its bounds and latency
+        are used unless `maxsize` and `max_latency` are given. The time the stage spends handling
+        each batch is reported back to the `batch_sizer`.
 
         Args:
             minsize (int): The minimum batch size to yield (unless it is the final batch)
+            maxsize (int): The maximum batch size to yield. Defaults to the `batch_maxsize`
+                attribute of the stage.
+            max_latency (float): The number of seconds a partial batch waits for more items.
+                Defaults to the `batch_max_latency` attribute of the stage.
+            batch_sizer (:class:`~pulpcore.plugin.stages.AdaptiveBatchSizer`): Adapts the batch
+                size to the measured throughput. Defaults to the `batch_sizer` attribute of the
+                stage.
 
         Yields:
             A list of :class:`DeclarativeContent` instances
@@ -106,43 +276,108 @@ class Stage:
                                 await self.put(d_content)
 
         """
+        if maxsize is None:
+            maxsize = self.batch_maxsize
+        if max_latency is None:
+            max_latency = self.batch_max_latency
+        if batch_sizer is None:
+            batch_sizer = self.batch_sizer
+        if batch_sizer:
+            if maxsize is None:
+                maxsize = batch_sizer.maxsize
+            if max_latency is None:
+                max_latency = batch_sizer.max_latency
+        metrics = self.metrics
+        tracer = self._tracer
         batch = []
         shutdown = False
         no_block = False
+        batch_deadline = None
+        get_task = None
+        waiting_since = time.monotonic()
 
         def add_to_batch(content):
             nonlocal batch
             nonlocal shutdown
             nonlocal no_block
+            nonlocal batch_deadline
             if content is None:
                 shutdown = True
+                self._end_of_input()
                 log.debug(_('%(name)s - shutdown.'), {'name': self})
             else:
                 if not content.does_batch:
                     no_block = True
+                if not batch and max_latency is not None:
+                    batch_deadline = time.monotonic() + max_latency
                 batch.append(content)
 
-        while not shutdown:
-            content = await self._in_q.get()
-            add_to_batch(content)
+        try:
             while not shutdown:
-                try:
-                    content = self._in_q.get_nowait()
-                except asyncio.QueueEmpty:
-                    break
-                else:
+                expired = False
+                if batch_deadline is None and get_task is None:
+                    content = await self._in_q.get()
                     add_to_batch(content)
-
-            if batch and (len(batch) >= minsize or shutdown or no_block):
-                log.debug(
-                    _('%(name)s - next batch[%(length)d].'),
-                    {
-                        'name': self,
-                        'length': len(batch),
-                    })
-                yield batch
-                batch = []
-                no_block = False
+                else:
+                    # Keep the pending get() across batches, so no item gets lost on timeouts
+                    if get_task is None:
+                        get_task = asyncio.ensure_future(self._in_q.get())
+                    if batch_deadline is None:
+                        timeout = None
+                    else:
+                        timeout = max(0, batch_deadline - time.monotonic())
+                    done, _pending = await asyncio.wait([get_task], timeout=timeout)
+                    if done:
+                        content = get_task.result()
+                        get_task = None
+                        add_to_batch(content)
+                    else:
+                        expired = True
+                while not shutdown and (maxsize is None or len(batch) < maxsize):
+                    try:
+                        content = self._in_q.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                    else:
+                        add_to_batch(content)
+
+                if batch_sizer:
+                    minsize = batch_sizer.size
+                if maxsize is not None:
+                    minsize = min(minsize, maxsize)
+                if batch and (len(batch) >= minsize or shutdown or no_block or expired):
+                    log.debug(
+                        _('%(name)s - next batch[%(length)d].'),
+                        {
+                            'name': self,
+                            'length': len(batch),
+                        })
+                    metrics.items_in += len(batch)
+                    metrics.batch_sizes.record(len(batch))
+                    yielded_at = time.monotonic()
+                    metrics.wait_times.record(yielded_at - waiting_since)
+                    if tracer is not None:
+                        tracer.add_span(self._trace_track, 'wait', 'queue', waiting_since,
+                                        yielded_at, size=len(batch))
+                    task = _current_task()
+                    put_blocked = metrics.put_blocked_by(task)
+                    yield batch
+                    waiting_since = time.monotonic()
+                    service_time = waiting_since - yielded_at
+                    metrics.service_times.record(
+                        max(0, service_time - (metrics.put_blocked_by(task) - put_blocked))
+                    )
+                    if tracer is not None:
+                        tracer.add_span(self._trace_track, 'batch', 'stage', yielded_at,
+                                        waiting_since, size=len(batch))
+                    if batch_sizer:
+                        batch_sizer.record(len(batch), service_time, self._in_q.qsize())
+                    batch = []
+                    no_block = False
+                    batch_deadline = None
+        finally:
+            if get_task is not None:
+                get_task.cancel()
 
     async def put(self, item):
         """
@@ -156,9 +391,78 @@ class Stage:
         """
         if item is None:
             raise ValueError(_('(None) not permitted.'))
-        await self._out_q.put(item)
+        if self._out_q.full():
+            blocked_since = time.monotonic()
+            await self._out_q.put(item)
+            unblocked_at = time.monotonic()
+            self.metrics.record_put_blocked(_current_task(), unblocked_at - blocked_since)
+            if self._tracer is not None:
+                self._tracer.add_span(
+                    self._trace_track, 'put', 'queue', blocked_since, unblocked_at
+                )
+        else:
+            await self._out_q.put(item)
+        self.metrics.items_out += 1
         log.debug(_('%(name)s - put: %(content)s'), {'name': self, 'content': item})
 
+    async def run_in_db_executor(self, func, *args, **kwargs):
+        """
+        Coroutine to run blocking database work without blocking the event loop.
+
+        Within a pipeline built by :func:`~pulpcore.plugin.stages.create_pipeline`, `func` runs in a
+        thread of the :class:`~pulpcore.plugin.stages.DatabaseExecutor` of the pipeline, with its
+        own database connection. Otherwise `func` is called directly.
+
+        Example:
+            >>> class MyStage(Stage):
+            >>>     async def run(self):
+            >>>         async for batch in self.batches():
+            >>>             await self.run_in_db_executor(self.save_batch, batch)
+            >>>             for d_content in batch:
+            >>>                 await self.put(d_content)
+
+        Args:
+            func (callable): The blocking function to run.
+            args: positional arguments passed along to `func`.
+            kwargs: keyword arguments passed along to `func`.
+
+        Returns:
+            The return value of `func`.
+        """
+        if self._tracer is not None:
+            name = getattr(func, '__qualname__', str(func))
+            func = self._tracer.wrap(self._trace_track, name, 'db', func)
+        if self._db_executor is None:
+            return func(*args, **kwargs)
+        return await self._db_executor.run(func, *args, **kwargs)
+
+    def trace(self, name, category, concurrent=False, **args):
+        """
+        Return a context manager recording a span around its body when tracing is enabled.
+
+        Spans of batches, items, queue waits, blocked puts and database calls are recorded by the
+        stage itself. This adds spans of other work, e.g. downloads.
+
+        Example:
+            >>> with self.trace('parse', 'metadata', path=path):
+            >>>     parse(path)
+
+        Args:
+            name (str): The name of the span.
+            category (str): The category of the span.
+            concurrent (bool): Whether the span may overlap other spans of this stage, e.g. for
+                concurrent downloads. Defaults to `False`.
+            args: Details shown with the span.
+
+        Returns:
+            A context manager, which does nothing when tracing is disabled.
+        """
+        if self._tracer is None:
+            return NO_SPAN
+        if concurrent:
+            return self._tracer.async_span(self._trace_track, name, category, **args)
+        return self._tracer.span(self._trace_track, name, category, **args)
+
     def __str__(self):
         return '[{id}] {name}'.format(id=id(self), name=self.__class__.__name__)
 
@@ -177,34 +481,103 @@ async def create_pipeline(stages, maxsize=100):
     >>>         async for d_content in self.items():  # Fetch items from the previous stage
     >>>             await self.put(d_content)  # Hand them over to the next stage
 
+    Each stage can declare the depth of its input queue with its `in_q_maxsize` attribute, e.g. to
+    keep a deep buffer in front of a stage handling many items concurrently.
+
+    Instead of a single stage, an entry of `stages` can be a list of replicas of a stage. The
+    replicas consume items from a shared input queue and put them into a shared output queue. The
+    next stage receives the end-marker once all replicas are finished. Only stages declaring
+    `replica_safe` can be replicated, and items may be reordered by replicated stages.
+
+    >>> stages = [first_stage, [QueryExistingArtifacts(), QueryExistingArtifacts()], ...]
+
+    The stages of the pipeline share a :class:`~pulpcore.plugin.stages.DatabaseExecutor` to run
+    blocking database work with :meth:`~pulpcore.plugin.stages.Stage.run_in_db_executor`. It is
+    shut down when the pipeline finishes.
+
+    When the working directory is on another filesystem than the artifact storage, they also share
+    a :class:`~pulpcore.plugin.stages.DownloadDirectory` in the artifact storage, which
+    :meth:`~pulpcore.plugin.stages.DeclarativeArtifact.download` writes the downloads to. It is
+    deleted with the downloads not saved yet, e.g. when a stage fails or the pipeline is cancelled,
+    when the pipeline finishes.
+
+    The :class:`~pulpcore.plugin.stages.StageMetrics` of the stages are logged when the pipeline
+    finishes. :func:`~pulpcore.plugin.stages.pipeline_metrics` takes a snapshot of them at any time.
+
+    With the `TRACE_STAGES_API` setting enabled, the stages record spans with a
+    :class:`~pulpcore.plugin.stages.Tracer`, written as a trace file when the pipeline finishes.
+
     Args:
-        stages (list of coroutines): A list of Stages API compatible coroutines.
-        maxsize (int): The maximum amount of items a queue between two stages should hold. Optional
-            and defaults to 100.
+        stages (list of coroutines): A list of Stages API compatible coroutines, or of lists of
+            replicas of such coroutines.
+        maxsize (int): The maximum amount of items a queue between two stages should hold, unless
+            the stage it feeds into sets `in_q_maxsize`. Optional and defaults to 100.
 
     Returns:
         A single coroutine that can be used to run, wait, or cancel the entire pipeline with.
     Raises:
-        ValueError: When a stage instance is specified more than once.
+        ValueError: When a stage instance is specified more than once, or when a stage that is not
+            `replica_safe` is replicated.
     """
+    stage_groups = []
+    for stage in stages:
+        if isinstance(stage, (list, tuple)):
+            replicas = list(stage)
+            if not replicas:
+                raise ValueError(_('A list of replicas must not be empty.'))
+            if len(replicas) > 1:
+                for replica in replicas:
+                    if not replica.replica_safe:
+                        raise ValueError(
+                            _('{stage} does not support replicas.').format(stage=replica)
+                        )
+            stage_groups.append(replicas)
+        else:
+            stage_groups.append([stage])
+
+    db_executor = DatabaseExecutor()
+    download_dir = DownloadDirectory() if DownloadDirectory.needed() else None
+    temp_dir = download_dir.path if download_dir is not None else None
+    if getattr(settings, 'TRACE_STAGES_API', False):
+        tracer = Tracer(debug_data_path() + '.trace.json')
+    else:
+        tracer = None
+    profiling_queues = []
     futures = []
     history = set()
     in_q = None
-    for i, stage in enumerate(stages):
-        if stage in history:
-            raise ValueError(_('Each stage instance must be unique.'))
-        history.add(stage)
-        if i < len(stages) - 1:
+    for i, replicas in enumerate(stage_groups):
+        for stage in replicas:
+            if stage in history:
+                raise ValueError(_('Each stage instance must be unique.'))
+            history.add(stage)
+        if i < len(stage_groups) - 1:
+            next_stage = stage_groups[i + 1][0]
+            if next_stage.in_q_maxsize is not None:
+                q_maxsize = next_stage.in_q_maxsize
+            else:
+                q_maxsize = maxsize
             if settings.PROFILE_STAGES_API:
-                out_q = ProfilingQueue.make_and_record_queue(stages[i + 1], i + 1, maxsize)
+                out_q = ProfilingQueue.make_and_record_queue(next_stage, i + 1, q_maxsize)
+                profiling_queues.append(out_q)
             else:
-                out_q = asyncio.Queue(maxsize=maxsize)
+                out_q = asyncio.Queue(maxsize=q_maxsize)
         else:
             out_q = None
-        stage._connect(in_q, out_q)
-        futures.append(asyncio.ensure_future(stage()))
+        shared = _Replicas(len(replicas)) if len(replicas) > 1 else None
+        for stage in replicas:
+            stage._replicas = shared
+            stage._db_executor = db_executor
+            stage._temp_dir = temp_dir
+            if tracer is not None:
+                stage._tracer = tracer
+                stage._trace_track = tracer.track(stage)
+            stage._connect(in_q, out_q)
+            futures.append(asyncio.ensure_future(stage()))
         in_q = out_q
 
+    if download_dir is not None:
+        download_dir.create()
     try:
         await asyncio.gather(*futures)
     except Exception:
@@ -218,6 +591,19 @@ async def create_pipeline(stages, maxsize=100):
         if pending:
             await asyncio.wait(pending, timeout=60)
         raise
+    finally:
+        db_executor.shutdown()
+        if download_dir is not None:
+            download_dir.delete()
+        for profiling_queue in profiling_queues:
+            profiling_queue.flush()
+        for replicas in stage_groups:
+            for stage in replicas:
+                log.info(_('%(name)s - %(summary)s'),
+                         {'name': stage, 'summary': stage.metrics.summary()})
+        if tracer is not None:
+            tracer.write()
+            log.info(_('Stages API trace written to %(path)s.'), {'path': tracer.path})
 
 
 class EndStage(Stage):
@@ -236,5 +622,7 @@ class EndStage(Stage):
         Importantly it does not try to put items into the nonexistent next queue.
         """
         # We overwrite __call__ here to avoid trying to put None in `self._out_q`.
+        self.metrics.start()
         async for _ in self.items():  # noqa
             pass
+        self.metrics.finish()
@@ -1,12 +1,17 @@
 import asyncio
+from collections import defaultdict
+import functools
 from gettext import gettext as _
 import logging
+import os
+from urllib.parse import urlsplit
 
-from django.db.models import Q, Prefetch, prefetch_related_objects
+from django.db.models import FilteredRelation, Q
 
 from pulpcore.plugin.models import Artifact, ContentArtifact, ProgressReport, RemoteArtifact
 
 from .api import Stage
+from .progress import ProgressThrottle
 
 log = logging.getLogger(__name__)
 
@@ -30,10 +35,16 @@ class QueryExistingArtifacts(Stage):
     Each :class:`~pulpcore.plugin.stages.DeclarativeContent` is sent to `self._out_q` after all of
     its :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects have been handled.
 
-    This stage drains all available items from `self._in_q` and batches everything into one large
-    call to the db for efficiency.
+    This stage drains all available items from `self._in_q` and batches everything into one
+    `digest__in` query per digest type for efficiency. Each artifact is only looked up by its
+    strongest known digest.
     """
 
+    batch_maxsize = 500
+    batch_max_latency = 1.0
+    in_q_maxsize = 500
+    replica_safe = True
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -42,24 +53,118 @@ class QueryExistingArtifacts(Stage):
             The coroutine for this stage.
         """
         async for batch in self.batches():
-            all_artifacts_q = Q(pulp_created=None)
-            for d_content in batch:
-                for d_artifact in d_content.d_artifacts:
-                    one_artifact_q = d_artifact.artifact.q()
-                    if one_artifact_q:
-                        all_artifacts_q |= one_artifact_q
-
-            for artifact in Artifact.objects.filter(all_artifacts_q):
-                for d_content in batch:
-                    for d_artifact in d_content.d_artifacts:
-                        for digest_name in artifact.DIGEST_FIELDS:
-                            digest_value = getattr(d_artifact.artifact, digest_name)
-                            if digest_value and digest_value == getattr(artifact, digest_name):
-                                d_artifact.artifact = artifact
-                                break
+            await self.run_in_db_executor(self._query_existing_artifacts, batch)
             for d_content in batch:
                 await self.put(d_content)
 
+    def _query_existing_artifacts(self, batch):
+        """
+        Replace the unsaved artifacts of a batch with the already-saved ones.
+
+        Args:
+            batch (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+        """
+        d_artifacts_by_digest = self._index_by_digest(batch)
+        for digest_name, d_artifacts_by_value in d_artifacts_by_digest.items():
+            query = {'{digest}__in'.format(digest=digest_name): list(d_artifacts_by_value)}
+            for artifact in Artifact.objects.filter(**query):
+                for d_artifact in d_artifacts_by_value[getattr(artifact, digest_name)]:
+                    d_artifact.artifact = artifact
+
+    @staticmethod
+    def _index_by_digest(batch):
+        """
+        Index the unsaved artifacts of a batch by their strongest available digest.
+
+        Only the strongest digest of each :class:`~pulpcore.plugin.models.Artifact` is used, so
+        each artifact is looked up once, using the unique index of that digest.
+
+        Args:
+            batch (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+
+        Returns:
+            dict: Keyed on the digest name. Each value is a dict mapping a digest value to the list
+                of :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects carrying it.
+        """
+        d_artifacts_by_digest = {}
+        for d_content in batch:
+            for d_artifact in d_content.d_artifacts:
+                if not d_artifact.artifact._state.adding:
+                    continue
+                # DIGEST_FIELDS is ordered by algorithm strength, strongest first
+                for digest_name in d_artifact.artifact.DIGEST_FIELDS:
+                    digest_value = getattr(d_artifact.artifact, digest_name)
+                    if digest_value:
+                        d_artifacts_by_value = d_artifacts_by_digest.setdefault(digest_name, {})
+                        d_artifacts_by_value.setdefault(digest_value, []).append(d_artifact)
+                        break
+        return d_artifacts_by_digest
+
+
+class DownloadBudget:
+    """
+    Limits the number of downloads in flight, overall and for each host.
+
+    Each download first waits for a slot of the host of its url, and then for one of the overall
+    slots. The limits apply on top of the `download_concurrency` of each
+    :class:`~pulpcore.plugin.models.Remote`.
+
+    A DownloadBudget can be shared by several :class:`ArtifactDownloader` stages, to limit the
+    downloads of a whole pipeline.
+
+    Args:
+        max_downloads (int): The maximum number of downloads in flight. Defaults to 200.
+        max_downloads_per_host (int): The maximum number of downloads in flight from a single host.
+            Defaults to `None`, meaning only `max_downloads` applies.
+
+    Attributes:
+        in_flight (int): The number of downloads currently in flight.
+        peak (int): The highest number of downloads in flight so far.
+    """
+
+    def __init__(self, max_downloads=200, max_downloads_per_host=None):
+        self.max_downloads = max_downloads
+        self.max_downloads_per_host = max_downloads_per_host
+        self.in_flight = 0
+        self.peak = 0
+        self._semaphore = asyncio.Semaphore(max_downloads)
+        self._host_semaphores = {}
+
+    def _host_semaphore(self, url):
+        host = urlsplit(url).netloc
+        try:
+            return self._host_semaphores[host]
+        except KeyError:
+            semaphore = asyncio.Semaphore(self.max_downloads_per_host)
+            self._host_semaphores[host] = semaphore
+            return semaphore
+
+    async def run(self, url, download):
+        """
+        Run a download once a slot is available for it.
+
+        Args:
+            url (str): The url to download, used to select the host slots.
+            download (callable): A function returning the download coroutine, e.g.
+                :meth:`DeclarativeArtifact.download`.
+
+        Returns:
+            The return value of the download coroutine.
+        """
+        if self.max_downloads_per_host is None:
+            return await self._run(download)
+        async with self._host_semaphore(url):
+            return await self._run(download)
+
+    async def _run(self, download):
+        async with self._semaphore:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            try:
+                return await download()
+            finally:
+                self.in_flight -= 1
+
 
 class ArtifactDownloader(Stage):
     """
@@ -76,22 +181,34 @@ class ArtifactDownloader(Stage):
     its :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects have been handled.
 
     This stage creates a ProgressReport named 'Downloading Artifacts' that counts the number of
-    downloads completed. Since it's a stream the total count isn't known until it's finished.
+    downloads completed. Since it's a stream the total count isn't known until it's finished. It is
+    saved at most every 500 milliseconds by a :class:`~pulpcore.plugin.stages.ProgressThrottle`.
 
     This stage drains all available items from `self._in_q` and starts as many downloaders as
-    possible (up to `download_concurrency` set on a Remote)
+    possible (up to `download_concurrency` set on a Remote). The number of downloads in flight is
+    further limited by a :class:`~pulpcore.plugin.stages.DownloadBudget`, whatever the number of
+    artifacts of each content unit. Its usage is reported in the suffix of the ProgressReport.
+
+    The input queue of this stage holds twice `max_concurrent_content` items, so that finished
+    content units can be replaced right away.
 
     Args:
         max_concurrent_content (int): The maximum number of
             :class:`~pulpcore.plugin.stages.DeclarativeContent` instances to handle simultaneously.
             Default is 200.
+        download_budget (:class:`~pulpcore.plugin.stages.DownloadBudget`): The budget limiting the
+            downloads in flight. Defaults to a new DownloadBudget with its default limits.
         args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
         kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
-    def __init__(self, max_concurrent_content=200, *args, **kwargs):
+    def __init__(self, max_concurrent_content=200, download_budget=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.max_concurrent_content = max_concurrent_content
+        self.in_q_maxsize = 2 * max_concurrent_content
+        if download_budget is None:
+            download_budget = DownloadBudget()
+        self.download_budget = download_budget
 
     async def run(self):
         """
@@ -117,6 +234,7 @@ class ArtifactDownloader(Stage):
         content_get_task = _add_to_pending(content_iterator.__anext__())
 
         with ProgressReport(message='Downloading Artifacts', code='downloading.artifacts') as pb:
+            progress = ProgressThrottle(pb)
             try:
                 while pending:
                     done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
@@ -129,8 +247,8 @@ class ArtifactDownloader(Stage):
                                 # content instances: shutdown
                                 content_get_task = None
                         else:
-                            pb.done += task.result()  # download_count
-                            pb.save()
+                            pb.suffix = self._budget_usage()
+                            progress.increase_by(task.result())  # download_count
 
                     if content_get_task and content_get_task not in pending:  # not yet shutdown
                         if len(pending) < self.max_concurrent_content:
@@ -140,6 +258,18 @@ class ArtifactDownloader(Stage):
                 for future in pending:
                     future.cancel()
                 raise
+            pb.suffix = _('at most {peak}/{limit} downloads in flight').format(
+                peak=self.download_budget.peak, limit=self.download_budget.max_downloads
+            )
+
+    def _budget_usage(self):
+        return _('{in_flight}/{limit} downloads in flight').format(
+            in_flight=self.download_budget.in_flight, limit=self.download_budget.max_downloads
+        )
+
+    async def _download(self, d_artifact):
+        with self.trace('download', 'download', concurrent=True, url=d_artifact.url):
+            return await d_artifact.download(temp_dir=self._temp_dir)
 
     async def _handle_content_unit(self, d_content):
         """Handle one content unit.
@@ -148,7 +278,8 @@ class ArtifactDownloader(Stage):
             The number of downloads
         """
         downloaders_for_content = [
-            d_artifact.download() for d_artifact in d_content.d_artifacts
+            self.download_budget.run(d_artifact.url, functools.partial(self._download, d_artifact))
+            for d_artifact in d_content.d_artifacts
             if d_artifact.artifact._state.adding and
             not d_artifact.deferred_download and
             not d_artifact.artifact.file
@@ -174,8 +305,16 @@ class ArtifactSaver(Stage):
 
     This stage drains all available items from `self._in_q` and batches everything into one large
     call to the db for efficiency.
+
+    A download written to the download directory of the pipeline is moved into place when its
+    Artifact is saved. If an existing Artifact is used instead, the downloaded file is removed.
     """
 
+    batch_maxsize = 500
+    batch_max_latency = 1.0
+    in_q_maxsize = 500
+    replica_safe = True
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -192,13 +331,34 @@ class ArtifactSaver(Stage):
                         da_to_save.append(d_artifact)
 
             if da_to_save:
-                for d_artifact, artifact in zip(da_to_save, Artifact.objects.bulk_get_or_create(
-                        d_artifact.artifact for d_artifact in da_to_save)):
-                    d_artifact.artifact = artifact
+                await self.run_in_db_executor(self._save_artifacts, da_to_save, self._temp_dir)
 
             for d_content in batch:
                 await self.put(d_content)
 
+    @staticmethod
+    def _save_artifacts(da_to_save, temp_dir=None):
+        """
+        Save the artifacts of `da_to_save`, replacing them with the saved ones.
+
+        Args:
+            da_to_save (list): List of :class:`~pulpcore.plugin.stages.DeclarativeArtifact`.
+            temp_dir (str): The download directory of the pipeline. The downloads in it that were
+                not moved into the artifact storage are removed. Defaults to None.
+        """
+        paths = [str(d_artifact.artifact.file) for d_artifact in da_to_save]
+        for d_artifact, artifact in zip(da_to_save, Artifact.objects.bulk_get_or_create(
+                d_artifact.artifact for d_artifact in da_to_save)):
+            d_artifact.artifact = artifact
+        if temp_dir:
+            for path in paths:
+                if os.path.dirname(path) == temp_dir:
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        # The file was moved into the artifact storage
+                        pass
+
 
 class RemoteArtifactSaver(Stage):
     """
@@ -208,6 +368,11 @@ class RemoteArtifactSaver(Stage):
     :class:`~pulpcore.plugin.stages.DeclarativeArtifact`.
     """
 
+    batch_maxsize = 500
+    batch_max_latency = 1.0
+    in_q_maxsize = 500
+    replica_safe = True
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -216,15 +381,31 @@ class RemoteArtifactSaver(Stage):
             The coroutine for this stage.
         """
         async for batch in self.batches():
-            RemoteArtifact.objects.bulk_get_or_create(self._needed_remote_artifacts(batch))
+            await self.run_in_db_executor(self._save_remote_artifacts, batch)
             for d_content in batch:
                 await self.put(d_content)
 
+    def _save_remote_artifacts(self, batch):
+        """
+        Save the :class:`~pulpcore.plugin.models.RemoteArtifact` objects needed for the batch.
+
+        Args:
+            batch (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+        """
+        RemoteArtifact.objects.bulk_get_or_create(self._needed_remote_artifacts(batch))
+
     def _needed_remote_artifacts(self, batch):
         """
         Build a list of only :class:`~pulpcore.plugin.models.RemoteArtifact` that need
         to be created for the batch.
 
+        The existing :class:`~pulpcore.plugin.models.ContentArtifact` of the batch are fetched with
+        the remotes of their :class:`~pulpcore.plugin.models.RemoteArtifact` in a single query,
+        and matched to the declared artifacts by relative path and remote. Content created by the
+        :class:`~pulpcore.plugin.stages.ContentSaver` stage of this pipeline cannot have any
+        :class:`~pulpcore.plugin.models.RemoteArtifact` yet, so the
+        :class:`~pulpcore.plugin.models.ContentArtifact` created along with it are used instead.
+
         Args:
             batch (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent`.
 
@@ -236,42 +417,60 @@ class RemoteArtifactSaver(Stage):
             for d_artifact in d_content.d_artifacts:
                 if d_artifact.remote:
                     remotes_present.add(d_artifact.remote)
+        if not remotes_present:
+            return []
 
-        prefetch_related_objects(
-            [d_c.content for d_c in batch],
-            Prefetch(
-                'contentartifact_set',
-                queryset=ContentArtifact.objects.prefetch_related(
-                    Prefetch(
-                        'remoteartifact_set',
-                        queryset=RemoteArtifact.objects.filter(remote__in=remotes_present),
-                        to_attr='_remote_artifact_saver_ras',
+        # content pk -> relative path -> (content artifact pk, pks of the remotes having it)
+        content_artifacts = defaultdict(dict)
+        existing_contents = []
+        for d_content in batch:
+            if d_content.newly_created and d_content._content_artifacts is not None:
+                for relative_path, content_artifact in d_content._content_artifacts.items():
+                    content_artifacts[d_content.content.pk][relative_path] = (
+                        content_artifact.pk, set()
                     )
-                ),
-                to_attr='_remote_artifact_saver_cas',
-            ),
-        )
+            else:
+                existing_contents.append(d_content.content)
+
+        if existing_contents:
+            rows = ContentArtifact.objects.filter(content__in=existing_contents).annotate(
+                remote_artifact_saver_ras=FilteredRelation(
+                    'remoteartifact', condition=Q(remoteartifact__remote__in=remotes_present)
+                )
+            ).values_list(
+                'pk', 'content_id', 'relative_path', 'remote_artifact_saver_ras__remote_id'
+            )
+        else:
+            rows = []
+        for content_artifact_pk, content_pk, relative_path, remote_pk in rows:
+            remote_pks = content_artifacts[content_pk].setdefault(
+                relative_path, (content_artifact_pk, set())
+            )[1]
+            if remote_pk is not None:
+                remote_pks.add(remote_pk)
+
         needed_ras = []
         for d_content in batch:
-            for content_artifact in d_content.content._remote_artifact_saver_cas:
-                for d_artifact in d_content.d_artifacts:
-                    if d_artifact.relative_path == content_artifact.relative_path:
-                        break
-                else:
+            d_artifacts_by_path = {}
+            for d_artifact in d_content.d_artifacts:
+                d_artifacts_by_path.setdefault(d_artifact.relative_path, d_artifact)
+            content_artifacts_by_path = content_artifacts.get(d_content.content.pk, {})
+            for relative_path, (content_artifact_pk, remote_pks) in \
+                    content_artifacts_by_path.items():
+                try:
+                    d_artifact = d_artifacts_by_path[relative_path]
+                except KeyError:
                     msg = _('No declared artifact with relative path "{rp}" for content "{c}"')
-                    raise ValueError(msg.format(rp=content_artifact.relative_path,
-                                                c=d_content.content))
-                for remote_artifact in content_artifact._remote_artifact_saver_ras:
-                    if remote_artifact.remote_id == d_artifact.remote.pk:
-                        break
-                else:
-                    if d_artifact.remote:
-                        remote_artifact = self._create_remote_artifact(d_artifact, content_artifact)
-                        needed_ras.append(remote_artifact)
+                    raise ValueError(msg.format(rp=relative_path, c=d_content.content))
+                if d_artifact.remote and d_artifact.remote.pk not in remote_pks:
+                    remote_artifact = self._create_remote_artifact(d_artifact, content_artifact_pk)
+                    needed_ras.append(remote_artifact)
+                    # The same content may be declared more than once in a batch
+                    remote_pks.add(d_artifact.remote.pk)
         return needed_ras
 
     @staticmethod
-    def _create_remote_artifact(d_artifact, content_artifact):
+    def _create_remote_artifact(d_artifact, content_artifact_pk):
         return RemoteArtifact(
             url=d_artifact.url,
             size=d_artifact.artifact.size,
@@ -281,6 +480,6 @@ class RemoteArtifactSaver(Stage):
             sha256=d_artifact.artifact.sha256,
             sha384=d_artifact.artifact.sha384,
             sha512=d_artifact.artifact.sha512,
-            content_artifact=content_artifact,
+            content_artifact_id=content_artifact_pk,
             remote=d_artifact.remote,
         )
@@ -1,8 +1,142 @@
-from django.db.models import Q
+from uuid import uuid4
+
+from django.db import connections, router
 
 from pulpcore.plugin.models import Content, ProgressReport
 
 from .api import Stage
+from .executor import DatabaseExecutor
+from .progress import ProgressThrottle
+
+
+class _ContentPkTable:
+    """
+    A temporary table of content primary keys, flagged as either received or stale.
+
+    The table is only visible to the database connection creating it, so all the methods must be
+    called from the same thread. It is dropped by :meth:`drop`, or by the database when the
+    connection is closed, e.g. when the worker is killed.
+
+    Args:
+        new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The repo version whose
+            content is compared to the received primary keys.
+        chunk_size (int): The number of primary keys of the chunks returned by :meth:`chunks`.
+    """
+
+    def __init__(self, new_version, chunk_size):
+        self.new_version = new_version
+        self.chunk_size = chunk_size
+        self.using = router.db_for_write(Content)
+        connection = connections[self.using]
+        self.name = connection.ops.quote_name(
+            'stages_content_association_{id}'.format(id=uuid4().hex)
+        )
+
+    def _execute(self, sql, params=()):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(sql, params)
+            if cursor.description:
+                return [row[0] for row in cursor.fetchall()]
+
+    def create(self):
+        """
+        Create the table.
+        """
+        pk_type = Content._meta.pk.db_type(connections[self.using])
+        self._execute(
+            'CREATE TEMPORARY TABLE {table} (content_id {pk_type} PRIMARY KEY, '
+            'stale boolean NOT NULL DEFAULT false)'.format(table=self.name, pk_type=pk_type)
+        )
+
+    def drop(self):
+        """
+        Drop the table.
+        """
+        self._execute('DROP TABLE IF EXISTS {table}'.format(table=self.name))
+
+    def insert_received(self, pks):
+        """
+        Record primary keys received by the stage.
+
+        Args:
+            pks (list): The primary keys.
+        """
+        self._execute(
+            'INSERT INTO {table} (content_id) VALUES {values} ON CONFLICT DO NOTHING'.format(
+                table=self.name, values=', '.join(['(%s)'] * len(pks))
+            ),
+            pks
+        )
+
+    def insert_stale(self):
+        """
+        Record the content of `new_version` which was not received as stale.
+        """
+        version_sql, version_params = self._version_content_sql()
+        self._execute(
+            'INSERT INTO {table} (content_id, stale) SELECT U.*, true FROM ({version}) U '
+            'ON CONFLICT DO NOTHING'.format(table=self.name, version=version_sql),
+            version_params
+        )
+
+    def chunks(self, stale):
+        """
+        Iterate over the received primary keys not in `new_version`, or over the stale ones.
+
+        The primary keys are fetched a chunk at a time, ordered by primary key.
+
+        Args:
+            stale (bool): Whether to iterate over the stale primary keys.
+
+        Yields:
+            list: Chunks of at most `chunk_size` primary keys.
+        """
+        where = 'stale'
+        version_params = ()
+        if not stale:
+            version_sql, version_params = self._version_content_sql()
+            where = 'NOT stale AND content_id NOT IN ({version})'.format(version=version_sql)
+        last_pk = None
+        while True:
+            if last_pk is None:
+                sql = 'SELECT content_id FROM {table} WHERE {where} ORDER BY content_id LIMIT %s'
+                params = list(version_params) + [self.chunk_size]
+            else:
+                sql = ('SELECT content_id FROM {table} WHERE {where} AND content_id > %s '
+                       'ORDER BY content_id LIMIT %s')
+                params = list(version_params) + [last_pk, self.chunk_size]
+            chunk = self._execute(sql.format(table=self.name, where=where), params)
+            if not chunk:
+                return
+            yield chunk
+            last_pk = chunk[-1]
+
+    def _version_content_sql(self):
+        return self.new_version.content.values('pk').query.sql_with_params()
+
+
+class ContentChunk:
+    """
+    A chunk of Content units passed on by :class:`~pulpcore.plugin.stages.ContentAssociation`.
+
+    Args:
+        pks (list): The primary keys of the units.
+
+    Attributes:
+        pks (list): The primary keys of the units.
+    """
+
+    __slots__ = ('pks',)
+
+    def __init__(self, pks):
+        self.pks = pks
+
+    @property
+    def queryset(self):
+        """
+        :class:`django.db.models.query.QuerySet`: The Content units of the chunk.
+        """
+        return Content.objects.filter(pk__in=self.pks)
 
 
 class ContentAssociation(Stage):
@@ -11,21 +145,37 @@ class ContentAssociation(Stage):
 
     This stage stores all content unit primary keys in memory before running. This is done to
     compute the units already associated but not received from `self._in_q`. These units are passed
-    via `self._out_q` to the next stage as a :class:`django.db.models.query.QuerySet`.
+    via `self._out_q` to the next stage as :class:`~pulpcore.plugin.stages.ContentChunk` objects of
+    at most `batch_maxsize` units each, holding the primary keys of the units.
+
+    With `use_temp_table=True`, the primary keys received are instead streamed into a temporary
+    database table, and the units to associate and the ones not received are computed with SQL once
+    all units are received. Both are handled in chunks of `batch_maxsize` units. The memory used
+    does not grow with the size of the repository. The database work of the stage then runs in a
+    :class:`~pulpcore.plugin.stages.DatabaseExecutor` of its own with a single thread, since the
+    table is only visible to the connection of that thread.
 
     This stage creates a ProgressReport named 'Associating Content' that counts the number of units
-    associated. Since it's a stream the total count isn't known until it's finished.
+    associated. Since it's a stream the total count isn't known until it's finished. It is saved at
+    most every 500 milliseconds by a :class:`~pulpcore.plugin.stages.ProgressThrottle`.
 
     Args:
         new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The repo version this
             stage associates content with.
+        use_temp_table (bool): Whether to compute the content to associate and unassociate in the
+            database. Defaults to `False`.
         args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
         kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
-    def __init__(self, new_version, *args, **kwargs):
+    batch_maxsize = 1000
+    batch_max_latency = 1.0
+    in_q_maxsize = 1000
+
+    def __init__(self, new_version, use_temp_table=False, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.new_version = new_version
+        self.use_temp_table = use_temp_table
 
     async def run(self):
         """
@@ -35,22 +185,75 @@ class ContentAssociation(Stage):
             The coroutine for this stage.
         """
         with ProgressReport(message='Associating Content', code='associating.content') as pb:
-            to_delete = set(self.new_version.content.values_list('pk', flat=True))
+            progress = ProgressThrottle(pb)
+            if self.use_temp_table:
+                await self._associate_with_temp_table(progress)
+            else:
+                await self._associate_in_memory(progress)
+
+    async def _associate_in_memory(self, progress):
+        to_delete = await self.run_in_db_executor(
+            lambda: set(self.new_version.content.values_list('pk', flat=True))
+        )
+        async for batch in self.batches():
+            to_add = set()
+            for d_content in batch:
+                try:
+                    to_delete.remove(d_content.content.pk)
+                except KeyError:
+                    to_add.add(d_content.content.pk)
+
+            if to_add:
+                await self.run_in_db_executor(
+                    self.new_version.add_content, Content.objects.filter(pk__in=to_add)
+                )
+                progress.increase_by(len(to_add))
+
+        to_delete = list(to_delete)
+        chunk_size = self.batch_maxsize or max(len(to_delete), 1)
+        for i in range(0, len(to_delete), chunk_size):
+            await self.put(ContentChunk(to_delete[i:i + chunk_size]))
+
+    async def _associate_with_temp_table(self, progress):
+        pipeline_executor = self._db_executor
+        if pipeline_executor is not None:
+            self._db_executor = DatabaseExecutor(max_workers=1)
+        try:
+            await self._fill_and_read_temp_table(progress)
+        finally:
+            if pipeline_executor is not None:
+                # Closes its connection, which drops the table if dropping it failed
+                self._db_executor.shutdown()
+                self._db_executor = pipeline_executor
+
+    async def _fill_and_read_temp_table(self, progress):
+        table = _ContentPkTable(self.new_version, chunk_size=self.batch_maxsize or 1000)
+        await self.run_in_db_executor(table.create)
+        try:
             async for batch in self.batches():
-                to_add = set()
-                for d_content in batch:
-                    try:
-                        to_delete.remove(d_content.content.pk)
-                    except KeyError:
-                        to_add.add(d_content.content.pk)
+                pks = [d_content.content.pk for d_content in batch]
+                await self.run_in_db_executor(table.insert_received, pks)
+            # The stale content is the content of the version before adding the received one
+            await self.run_in_db_executor(table.insert_stale)
 
-                if to_add:
-                    self.new_version.add_content(Content.objects.filter(pk__in=to_add))
-                    pb.done = pb.done + len(to_add)
-                    pb.save()
+            to_add_chunks = table.chunks(stale=False)
+            while True:
+                to_add = await self.run_in_db_executor(next, to_add_chunks, None)
+                if to_add is None:
+                    break
+                await self.run_in_db_executor(
+                    self.new_version.add_content, Content.objects.filter(pk__in=to_add)
+                )
+                progress.increase_by(len(to_add))
 
-            if to_delete:
-                await self.put(Content.objects.filter(pk__in=to_delete))
+            to_delete_chunks = table.chunks(stale=True)
+            while True:
+                to_delete = await self.run_in_db_executor(next, to_delete_chunks, None)
+                if to_delete is None:
+                    break
+                await self.put(ContentChunk(to_delete))
+        finally:
+            await self.run_in_db_executor(table.drop)
 
 
 class ContentUnassociation(Stage):
@@ -58,15 +261,28 @@ class ContentUnassociation(Stage):
     A Stages API stage that unassociates content units from `new_version`.
 
     This stage creates a ProgressReport named 'Un-Associating Content' that counts the number of
-    units un-associated. Since it's a stream the total count isn't known until it's finished.
+    units un-associated. Since it's a stream the total count isn't known until it's finished. It
+    is saved at most every 500 milliseconds by a :class:`~pulpcore.plugin.stages.ProgressThrottle`.
+
+    Each item received is either a :class:`~pulpcore.plugin.stages.ContentChunk`, as passed on by
+    :class:`~pulpcore.plugin.stages.ContentAssociation`, or a
+    :class:`django.db.models.query.QuerySet` of Content, whose primary keys are queried once. The
+    units are unassociated in chunks of at most `chunk_size` units, each with its own statement.
+    Each item is sent to `self._out_q` once its units are unassociated.
 
     Args:
         new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The repo version this
             stage unassociates content from.
         args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
         kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+
+    Attributes:
+        chunk_size (int): The maximum number of units unassociated by one statement. Defaults to
+            1000.
     """
 
+    chunk_size = 1000
+
     def __init__(self, new_version, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.new_version = new_version
@@ -79,12 +295,22 @@ class ContentUnassociation(Stage):
             The coroutine for this stage.
         """
         with ProgressReport(message='Un-Associating Content', code='unassociating.content') as pb:
-            async for queryset_to_unassociate in self.items():
-                self.new_version.remove_content(queryset_to_unassociate)
-                pb.done = pb.done + queryset_to_unassociate.count()
-                pb.save()
+            progress = ProgressThrottle(pb)
+            async for to_unassociate in self.items():
+                if isinstance(to_unassociate, ContentChunk):
+                    pks = to_unassociate.pks
+                else:
+                    pks = await self.run_in_db_executor(
+                        list, to_unassociate.values_list('pk', flat=True)
+                    )
+                for i in range(0, len(pks), self.chunk_size):
+                    chunk = pks[i:i + self.chunk_size]
+                    await self.run_in_db_executor(
+                        self.new_version.remove_content, Content.objects.filter(pk__in=chunk)
+                    )
+                    progress.increase_by(len(chunk))
 
-                await self.put(queryset_to_unassociate)
+                await self.put(to_unassociate)
 
 
 class RemoveDuplicates(Stage):
@@ -93,8 +319,16 @@ class RemoveDuplicates(Stage):
 
     This stage is expected to be added by the
     :class:`~pulpcore.plugin.stages.DeclarativeVersion`. See that class for example usage.
+
+    For each batch, the content of `new_version` is joined with a `VALUES` list of the values of
+    `field_names` and the primary key of each unit of the batch, in a single query. A unit is not a
+    duplicate of itself. Content is only unassociated if duplicates were found.
     """
 
+    batch_maxsize = 500
+    batch_max_latency = 1.0
+    in_q_maxsize = 500
+
     def __init__(self, new_version, model, field_names):
         """
         Args:
@@ -117,19 +351,93 @@ class RemoveDuplicates(Stage):
             The coroutine for this stage.
         """
         async for batch in self.batches():
-            rm_q = Q()
-            for d_content in batch:
-                if isinstance(d_content.content, self.model):
-                    unit_q_dict = {
-                        field: getattr(d_content.content, field) for field in self.field_names
-                    }
-                    # Don't remove *this* object if it is already in the repository version.
-                    not_this = ~Q(pk=d_content.content.pk)
-                    dupe = Q(**unit_q_dict)
-                    rm_q |= Q(dupe & not_this)
-            if rm_q:
-                queryset_to_unassociate = self.model.objects.filter(rm_q)
-                self.new_version.remove_content(queryset_to_unassociate)
+            units = [
+                d_content.content for d_content in batch
+                if isinstance(d_content.content, self.model)
+            ]
+            if units:
+                duplicate_pks = await self.run_in_db_executor(self._find_duplicates, units)
+                if duplicate_pks:
+                    await self.run_in_db_executor(
+                        self.new_version.remove_content,
+                        self.model.objects.filter(pk__in=duplicate_pks)
+                    )
 
             for d_content in batch:
                 await self.put(d_content)
+
+    def _find_duplicates(self, units):
+        """
+        Find the content of `new_version` with the same unique field values as one of `units`.
+
+        The tables of the parent models holding some of the unique fields are joined on the primary
+        key. NULL values are equal to each other, as in Django lookups.
+
+        Args:
+            units (list): Content units of type `model`.
+
+        Returns:
+            list: The primary keys of the duplicates. A unit is not a duplicate of itself.
+        """
+        using = router.db_for_read(self.model)
+        connection = connections[using]
+        quote_name = connection.ops.quote_name
+        pk_field = self.model._meta.pk
+        fields = [self.model._meta.get_field(name) for name in self.field_names]
+
+        table = quote_name(self.model._meta.db_table)
+        pk_column = '{table}.{column}'.format(table=table, column=quote_name(pk_field.column))
+        joins = []
+        joined_tables = {self.model._meta.db_table}
+        for field in fields:
+            field_table = field.model._meta.db_table
+            if field_table not in joined_tables:
+                joined_tables.add(field_table)
+                joins.append('JOIN {parent} ON {parent}.{parent_pk} = {pk_column}'.format(
+                    parent=quote_name(field_table),
+                    parent_pk=quote_name(field.model._meta.pk.column),
+                    pk_column=pk_column,
+                ))
+
+        conditions = []
+        for i, field in enumerate(fields):
+            column = '{table}.{column}'.format(table=quote_name(field.model._meta.db_table),
+                                               column=quote_name(field.column))
+            condition = '{column} = units.f{i}'.format(column=column, i=i)
+            if field.null:
+                condition = '({condition} OR ({column} IS NULL AND units.f{i} IS NULL))'.format(
+                    condition=condition, column=column, i=i
+                )
+            conditions.append(condition)
+        conditions.append('{pk_column} <> units.unit_pk'.format(pk_column=pk_column))
+
+        row_sql = '({values})'.format(values=', '.join(
+            '%s::{type}'.format(type=field.cast_db_type(connection))
+            for field in fields + [pk_field]
+        ))
+        params = []
+        for unit in units:
+            params.extend(
+                field.get_db_prep_value(getattr(unit, field.attname), connection)
+                for field in fields + [pk_field]
+            )
+        version_sql, version_params = self.new_version.content.values('pk').query.get_compiler(
+            using
+        ).as_sql()
+
+        sql = (
+            'SELECT DISTINCT {pk_column} FROM {table} {joins} '
+            'JOIN (VALUES {rows}) AS units ({columns}, unit_pk) ON {conditions} '
+            'WHERE {pk_column} IN ({version_sql})'
+        ).format(
+            pk_column=pk_column,
+            table=table,
+            joins=' '.join(joins),
+            rows=', '.join([row_sql] * len(units)),
+            columns=', '.join('f{i}'.format(i=i) for i in range(len(fields))),
+            conditions=' AND '.join(conditions),
+            version_sql=version_sql,
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + list(version_params))
+            return [row[0] for row in cursor.fetchall()]
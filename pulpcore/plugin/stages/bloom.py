@@ -0,0 +1,75 @@
+from gettext import gettext as _
+import hashlib
+import math
+
+
+class BloomFilter:
+    """
+    A probabilistic set of keys, answering whether a key might have been added.
+
+    A key that was added is always reported as contained. A key that was not added is reported as
+    contained with a probability close to `false_positive_rate`, as long as no more than `capacity`
+    keys were added.
+
+    Keys are tuples of values, such as natural keys. Values are compared by their `str()`.
+
+    Args:
+        capacity (int): The number of keys the filter is sized for.
+        false_positive_rate (float): The probability of false positives at `capacity` keys.
+
+    Attributes:
+        count (int): The number of keys added.
+        size (int): The number of bits of the filter.
+        hash_count (int): The number of bits set for each key.
+
+    Raises:
+        ValueError: When `capacity` is not positive or `false_positive_rate` is not between 0 and 1.
+    """
+
+    def __init__(self, capacity, false_positive_rate=0.01):
+        if capacity <= 0:
+            raise ValueError(_('The capacity must be positive.'))
+        if not 0 < false_positive_rate < 1:
+            raise ValueError(_('The false positive rate must be between 0 and 1.'))
+        self.size = int(math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    @property
+    def nbytes(self):
+        """
+        The memory used by the bits of the filter, in bytes.
+        """
+        return len(self._bits)
+
+    @property
+    def false_positive_rate(self):
+        """
+        The expected probability of false positives for the keys added so far.
+        """
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+    def _positions(self, key):
+        data = '\0'.join(str(value) for value in key).encode()
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key):
+        """
+        Add a key.
+
+        Args:
+            key (tuple): The key to add.
+        """
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key)
+        )
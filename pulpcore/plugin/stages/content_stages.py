@@ -1,11 +1,19 @@
 from collections import defaultdict
+from gettext import gettext as _
+import logging
+import time
+import warnings
 
-from django.db import IntegrityError, transaction
+from django.db import IntegrityError, router, transaction
 from django.db.models import Q
 
-from pulpcore.plugin.models import ContentArtifact
+from pulpcore.plugin.models import ContentArtifact, MasterModel
 
 from .api import Stage
+from .artifact_stages import ArtifactSaver, QueryExistingArtifacts, RemoteArtifactSaver
+from .bloom import BloomFilter
+
+log = logging.getLogger(__name__)
 
 
 class QueryExistingContents(Stage):
@@ -27,8 +35,41 @@ class QueryExistingContents(Stage):
 
     This stage drains all available items from `self._in_q` and batches everything into one large
     call to the db for efficiency.
+
+    With `bloom_filter=True`, a :class:`~pulpcore.plugin.stages.BloomFilter` of the natural
+    keys of the existing units is built for each content type when the type is first seen. Only the
+    units the filter reports as possibly existing are queried, which skips most queries when
+    syncing into an empty Pulp. The keys of the units passing through are added to the filter. The
+    size, build time and expected false positive rate of the filters are logged when they are
+    built, and the number of units skipped and queried when the stage finishes. A unit created
+    concurrently by another task may be missed, in which case the
+    :class:`~pulpcore.plugin.stages.ContentSaver` stage finds it when saving fails. Replicas of this
+    stage each build their own filters.
+
+    Args:
+        bloom_filter (bool): Whether to skip the units missing from a Bloom filter. Defaults to
+            `False`.
+        false_positive_rate (float): The false positive rate the Bloom filters are sized for.
+            Defaults to 0.01.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
+    batch_maxsize = 500
+    batch_max_latency = 1.0
+    in_q_maxsize = 500
+    replica_safe = True
+
+    #: The minimal number of keys a Bloom filter is sized for, to leave room for the new units.
+    bloom_filter_min_capacity = 100000
+
+    def __init__(self, bloom_filter=False, false_positive_rate=0.01, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bloom_filter = bloom_filter
+        self.false_positive_rate = false_positive_rate
+        self._bloom_filters = {}
+        self._bloom_filter_stats = defaultdict(lambda: {'skipped': 0, 'queried': 0, 'found': 0})
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -37,30 +78,156 @@ class QueryExistingContents(Stage):
             The coroutine for this stage.
         """
         async for batch in self.batches():
-            content_q_by_type = defaultdict(lambda: Q(pulp_created=None))
-            for d_content in batch:
-                if d_content.content._state.adding:
-                    model_type = type(d_content.content)
-                    unit_q = d_content.content.q()
-                    content_q_by_type[model_type] = content_q_by_type[model_type] | unit_q
-
-            for model_type in content_q_by_type.keys():
-                for result in model_type.objects.filter(content_q_by_type[model_type]):
-                    for d_content in batch:
-                        if type(d_content.content) is not model_type:
-                            continue
-                        not_same_unit = False
-                        for field in result.natural_key_fields():
-                            in_memory_digest_value = getattr(d_content.content, field)
-                            if in_memory_digest_value != getattr(result, field):
-                                not_same_unit = True
-                                break
-                        if not_same_unit:
-                            continue
-                        d_content.content = result
+            d_contents_by_type = self._index_unsaved_by_type(batch)
+
+            if self.bloom_filter:
+                for model_type, d_contents_by_key in list(d_contents_by_type.items()):
+                    d_contents_by_key = await self._skip_missing_from_bloom_filter(
+                        model_type, d_contents_by_key
+                    )
+                    if d_contents_by_key:
+                        d_contents_by_type[model_type] = d_contents_by_key
+                    else:
+                        del d_contents_by_type[model_type]
+
+            if d_contents_by_type:
+                await self.run_in_db_executor(self._query_existing_contents, d_contents_by_type)
+                if self.bloom_filter:
+                    for model_type, d_contents_by_key in d_contents_by_type.items():
+                        self._bloom_filter_stats[model_type]['found'] += sum(
+                            1 for d_contents_of_key in d_contents_by_key.values()
+                            if not d_contents_of_key[0].content._state.adding
+                        )
             for d_content in batch:
                 await self.put(d_content)
 
+        for model_type, stats in self._bloom_filter_stats.items():
+            log.info(
+                _('Bloom filter for %(type)s: %(skipped)d units skipped, %(queried)d queried, '
+                  '%(found)d found.'),
+                dict(type=model_type.__name__, **stats)
+            )
+
+    async def _skip_missing_from_bloom_filter(self, model_type, d_contents_by_key):
+        """
+        Filter out the units which cannot exist according to the Bloom filter of their type.
+
+        The Bloom filter is built the first time a content type is seen. The keys of all units are
+        added to it, since they will exist once saved.
+
+        Args:
+            model_type (type): A subclass of :class:`~pulpcore.plugin.models.Content`.
+            d_contents_by_key (dict): Maps a natural key to the list of
+                :class:`~pulpcore.plugin.stages.DeclarativeContent` objects carrying it.
+
+        Returns:
+            dict: The items of `d_contents_by_key` which may exist already.
+        """
+        attnames = self._natural_key_attnames(model_type)
+        if not attnames:
+            return d_contents_by_key
+        try:
+            bloom_filter = self._bloom_filters[model_type]
+        except KeyError:
+            bloom_filter = await self.run_in_db_executor(
+                self._build_bloom_filter, model_type, attnames
+            )
+            self._bloom_filters[model_type] = bloom_filter
+
+        stats = self._bloom_filter_stats[model_type]
+        may_exist = {}
+        for natural_key, d_contents_of_key in d_contents_by_key.items():
+            bloom_key = tuple(getattr(d_contents_of_key[0].content, name) for name in attnames)
+            if bloom_key in bloom_filter:
+                may_exist[natural_key] = d_contents_of_key
+                stats['queried'] += 1
+            else:
+                bloom_filter.add(bloom_key)
+                stats['skipped'] += 1
+        return may_exist
+
+    def _build_bloom_filter(self, model_type, attnames):
+        """
+        Build a Bloom filter of the natural keys of the existing units of a content type.
+
+        Args:
+            model_type (type): A subclass of :class:`~pulpcore.plugin.models.Content`.
+            attnames (list): The attribute names of the natural key fields.
+
+        Returns:
+            :class:`~pulpcore.plugin.stages.BloomFilter`: The Bloom filter.
+        """
+        start = time.monotonic()
+        count = model_type.objects.count()
+        bloom_filter = BloomFilter(
+            capacity=max(2 * count, self.bloom_filter_min_capacity),
+            false_positive_rate=self.false_positive_rate,
+        )
+        for bloom_key in model_type.objects.values_list(*attnames).iterator():
+            bloom_filter.add(bloom_key)
+        log.info(
+            _('Built a Bloom filter of %(nbytes)d bytes for %(count)d %(type)s units in %(time).3f '
+              'seconds, expected false positive rate %(rate).4f.'),
+            {'nbytes': bloom_filter.nbytes, 'count': bloom_filter.count,
+             'type': model_type.__name__, 'time': time.monotonic() - start,
+             'rate': bloom_filter.false_positive_rate}
+        )
+        return bloom_filter
+
+    @staticmethod
+    def _natural_key_attnames(model_type):
+        """
+        The attribute names of the natural key fields, holding the primary key of related objects.
+
+        Args:
+            model_type (type): A subclass of :class:`~pulpcore.plugin.models.Content`.
+
+        Returns:
+            list: The attribute names, empty if the type has no natural key.
+        """
+        return [
+            model_type._meta.get_field(name).attname for name in model_type.natural_key_fields()
+        ]
+
+    @staticmethod
+    def _index_unsaved_by_type(batch):
+        """
+        Index the DeclarativeContent of a batch with unsaved Content units.
+
+        Args:
+            batch (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+
+        Returns:
+            dict: Keyed on the content type. Each value is a dict mapping a natural key to the list
+                of :class:`~pulpcore.plugin.stages.DeclarativeContent` objects carrying it.
+        """
+        d_contents_by_type = defaultdict(dict)
+        for d_content in batch:
+            if d_content.content._state.adding:
+                d_contents_by_key = d_contents_by_type[type(d_content.content)]
+                natural_key = d_content.content.natural_key()
+                # The same unit may be declared more than once in a batch
+                d_contents_by_key.setdefault(natural_key, []).append(d_content)
+        return d_contents_by_type
+
+    @staticmethod
+    def _query_existing_contents(d_contents_by_type):
+        """
+        Replace unsaved Content units with the already-saved ones, with one query per content type.
+
+        Args:
+            d_contents_by_type (dict): Keyed on the content type. Each value is a dict mapping a
+                natural key to the list of :class:`~pulpcore.plugin.stages.DeclarativeContent`
+                objects carrying it.
+        """
+        for model_type, d_contents_by_key in d_contents_by_type.items():
+            content_q = Q(pulp_created=None)
+            for d_contents_of_key in d_contents_by_key.values():
+                content_q |= d_contents_of_key[0].content.q()
+            for result in model_type.objects.filter(content_q):
+                for d_content in d_contents_by_key.get(result.natural_key(), []):
+                    d_content.content = result
+
 
 class ContentSaver(Stage):
     """
@@ -73,14 +240,54 @@ class ContentSaver(Stage):
     :class:`~pulpcore.plugin.models.Artifact`.
 
     Each "unsaved" Content objects is saved and a :class:`~pulpcore.plugin.models.ContentArtifact`
-    objects too.
+    objects too. The :class:`~pulpcore.plugin.stages.DeclarativeContent` of the units created are
+    marked as `newly_created`.
 
     Each :class:`~pulpcore.plugin.stages.DeclarativeContent` is sent to after it has been handled.
 
     This stage drains all available items from `self._in_q` and batches everything into one large
-    call to the db for efficiency.
+    call to the db for efficiency. Each batch is saved in one transaction, in a thread of the
+    :class:`~pulpcore.plugin.stages.DatabaseExecutor`. The :meth:`_pre_save_sync` and
+    :meth:`_post_save_sync` hooks are called within that transaction before and after saving the
+    content units.
+
+    Subclasses overriding the deprecated :meth:`_pre_save` and :meth:`_post_save` coroutines have
+    their batches saved on the event loop instead, with the coroutines awaited within the
+    transaction.
+
+    By default each Content unit is saved with its own `save()` call inside its own savepoint. With
+    `bulk_insert=True`, Content units whose model supports it are inserted with one
+    `INSERT ... ON CONFLICT DO NOTHING` statement per table and content type instead. Only the units
+    that conflicted with already existing ones are then fetched back by their natural key. Bulk
+    insertion does not call the `save()` method of the model and does not send the `pre_save` and
+    `post_save` signals. It is used for models which have a natural key and whose tables form a
+    single chain of parents, as in the :class:`~pulpcore.plugin.models.MasterModel` layout. Other
+    models are saved one by one.
+
+    Args:
+        bulk_insert (bool): Whether to insert Content units in bulk. Defaults to `False`.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
+    batch_maxsize = 500
+    batch_max_latency = 1.0
+    in_q_maxsize = 500
+
+    def __init__(self, bulk_insert=False, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bulk_insert = bulk_insert
+        cls = type(self)
+        self._async_hooks = (cls._pre_save is not ContentSaver._pre_save or
+                             cls._post_save is not ContentSaver._post_save)
+        if self._async_hooks:
+            warnings.warn(
+                _('{cls} overrides the deprecated _pre_save() or _post_save() coroutines, its '
+                  'batches are saved on the event loop. Override _pre_save_sync() and '
+                  '_post_save_sync() instead.').format(cls=cls.__name__),
+                DeprecationWarning
+            )
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -89,43 +296,267 @@ class ContentSaver(Stage):
             The coroutine for this stage.
         """
         async for batch in self.batches():
-            content_artifact_bulk = []
-            with transaction.atomic():
-                await self._pre_save(batch)
-                for d_content in batch:
-                    # Are we saving to the database for the first time?
-                    content_already_saved = not d_content.content._state.adding
-                    if not content_already_saved:
-                        try:
-                            with transaction.atomic():
-                                d_content.content.save()
-                        except IntegrityError:
-                            d_content.content = \
-                                d_content.content.__class__.objects.get(
-                                    d_content.content.q())
-                            continue
-                        for d_artifact in d_content.d_artifacts:
-                            if not d_artifact.artifact._state.adding:
-                                artifact = d_artifact.artifact
-                            else:
-                                # set to None for on-demand synced artifacts
-                                artifact = None
-                            content_artifact = ContentArtifact(
-                                content=d_content.content,
-                                artifact=artifact,
-                                relative_path=d_artifact.relative_path
-                            )
-                            content_artifact_bulk.append(content_artifact)
-                ContentArtifact.objects.bulk_get_or_create(content_artifact_bulk)
-                await self._post_save(batch)
+            if self._async_hooks:
+                with transaction.atomic():
+                    await self._pre_save(batch)
+                    self._save_batch(batch)
+                    await self._post_save(batch)
+            else:
+                await self.run_in_db_executor(self._save_batch, batch)
             for declarative_content in batch:
                 await self.put(declarative_content)
 
+    def _save_batch(self, batch):
+        """
+        Save the Content units of a batch and their ContentArtifacts in one transaction, along with
+        the objects saved by the :meth:`_pre_save_sync` and :meth:`_post_save_sync` hooks.
+
+        Args:
+            batch (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+        """
+        with transaction.atomic():
+            self._pre_save_sync(batch)
+            self._save_content_and_artifacts(batch)
+            self._post_save_sync(batch)
+
+    def _save_content_and_artifacts(self, batch):
+        """
+        Save the unsaved Content units of a batch and their ContentArtifacts.
+
+        Args:
+            batch (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+        """
+        content_artifact_bulk = []
+        # Are we saving to the database for the first time?
+        unsaved = [d_content for d_content in batch if d_content.content._state.adding]
+        if self.bulk_insert:
+            created = self._bulk_insert_content(unsaved)
+        else:
+            created = self._save_content(unsaved)
+        for d_content in created:
+            d_content.newly_created = True
+            for d_artifact in d_content.d_artifacts:
+                if not d_artifact.artifact._state.adding:
+                    artifact = d_artifact.artifact
+                else:
+                    # set to None for on-demand synced artifacts
+                    artifact = None
+                content_artifact = ContentArtifact(
+                    content=d_content.content,
+                    artifact=artifact,
+                    relative_path=d_artifact.relative_path
+                )
+                content_artifact_bulk.append(content_artifact)
+        content_artifacts = ContentArtifact.objects.bulk_get_or_create(content_artifact_bulk)
+        # They are returned in order, one for each declared artifact of the created units
+        content_artifacts = iter(content_artifacts)
+        for d_content in created:
+            d_content._content_artifacts = {}
+            # d_artifacts comes first, so zip() stops before taking from the next unit
+            for d_artifact, content_artifact in zip(d_content.d_artifacts, content_artifacts):
+                d_content._content_artifacts.setdefault(
+                    d_artifact.relative_path, content_artifact
+                )
+
+    @staticmethod
+    def _save_content(d_contents):
+        """
+        Save Content units one at a time, each within its own savepoint.
+
+        Units that already exist are replaced with the saved instance from the database.
+
+        Args:
+            d_contents (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent` with
+                unsaved Content units.
+
+        Returns:
+            list: The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects whose Content
+                unit was created.
+        """
+        created = []
+        for d_content in d_contents:
+            try:
+                with transaction.atomic():
+                    d_content.content.save()
+            except IntegrityError:
+                d_content.content = \
+                    d_content.content.__class__.objects.get(
+                        d_content.content.q())
+            else:
+                created.append(d_content)
+        return created
+
+    def _bulk_insert_content(self, d_contents):
+        """
+        Insert Content units in bulk, grouped by content type.
+
+        Content types not supporting bulk insertion are saved one by one.
+
+        Args:
+            d_contents (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent` with
+                unsaved Content units.
+
+        Returns:
+            list: The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects whose Content
+                unit was created.
+        """
+        d_contents_by_type = defaultdict(list)
+        for d_content in d_contents:
+            d_contents_by_type[type(d_content.content)].append(d_content)
+
+        created = []
+        for model_type, d_contents_of_type in d_contents_by_type.items():
+            if self._supports_bulk_insert(model_type):
+                created.extend(self._bulk_insert(model_type, d_contents_of_type))
+            else:
+                created.extend(self._save_content(d_contents_of_type))
+        return created
+
+    @staticmethod
+    def _supports_bulk_insert(model_type):
+        """
+        Whether units of `model_type` can be inserted by :meth:`_bulk_insert`.
+
+        The model needs a natural key, stored in its own table so that conflicts show up when
+        inserting into that table, and each of its tables may have at most one parent table.
+
+        Args:
+            model_type (type): A subclass of :class:`~pulpcore.plugin.models.Content`.
+
+        Returns:
+            bool: True if units of `model_type` can be inserted in bulk.
+        """
+        natural_key_fields = model_type.natural_key_fields()
+        if not natural_key_fields:
+            return False
+        local_fields = {field.name for field in model_type._meta.local_concrete_fields}
+        if not set(natural_key_fields) <= local_fields:
+            return False
+        models = [model_type] + model_type._meta.get_parent_list()
+        return all(len(model._meta.parents) <= 1 for model in models)
+
+    def _bulk_insert(self, model_type, d_contents):
+        """
+        Insert the Content units of one content type with one statement per table.
+
+        The rows of the parent tables are inserted first, the same way `Model.save()` does. The rows
+        of the table holding the natural key are inserted ignoring conflicts. The parent rows of the
+        conflicting units are then deleted and the existing units are fetched by their natural key.
+
+        Args:
+            model_type (type): A subclass of :class:`~pulpcore.plugin.models.Content` supporting
+                bulk insertion.
+            d_contents (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent` with
+                unsaved Content units of type `model_type`.
+
+        Returns:
+            list: The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects whose Content
+                unit was created.
+        """
+        # The same unit may be declared more than once in a batch, only insert it once
+        d_contents_by_key = {}
+        for d_content in d_contents:
+            d_contents_by_key.setdefault(d_content.content.natural_key(), []).append(d_content)
+        units = [d_contents_of_key[0].content for d_contents_of_key in d_contents_by_key.values()]
+
+        using = router.db_for_write(model_type)
+        parents = model_type._meta.get_parent_list()
+        for model in reversed(parents):
+            self._insert_rows(model, units, using)
+        self._insert_rows(model_type, units, using, ignore_conflicts=True)
+
+        inserted_pks = set(
+            model_type.objects.filter(pk__in=[unit.pk for unit in units]).values_list(
+                'pk', flat=True
+            )
+        )
+
+        created = []
+        conflicting = {}
+        for natural_key, d_contents_of_key in d_contents_by_key.items():
+            unit = d_contents_of_key[0].content
+            if unit.pk in inserted_pks:
+                unit._state.adding = False
+                unit._state.db = using
+                created.append(d_contents_of_key[0])
+                for d_content in d_contents_of_key[1:]:
+                    d_content.content = unit
+            else:
+                conflicting[natural_key] = d_contents_of_key
+
+        if conflicting:
+            conflicting_pks = [ds[0].content.pk for ds in conflicting.values()]
+            for model in parents:
+                model._base_manager.filter(pk__in=conflicting_pks)._raw_delete(using)
+            existing_q = Q()
+            for d_contents_of_key in conflicting.values():
+                existing_q |= Q(**d_contents_of_key[0].content.natural_key_dict())
+            for result in model_type.objects.filter(existing_q):
+                for d_content in conflicting.pop(result.natural_key(), []):
+                    d_content.content = result
+            # Whatever is left conflicted on something other than its natural key
+            created.extend(self._save_content(
+                [d_content for d_contents_of_key in conflicting.values()
+                 for d_content in d_contents_of_key]
+            ))
+        return created
+
+    @staticmethod
+    def _insert_rows(model, units, using, ignore_conflicts=False):
+        """
+        Insert the rows of one table of a multi-table model for all `units`.
+
+        Args:
+            model (type): The model owning the table. Either the model of `units` or a parent of it.
+            units (list): The Content units to insert the rows for.
+            using (str): The database alias to insert into.
+            ignore_conflicts (bool): Whether rows conflicting with existing ones are skipped.
+        """
+        for unit in units:
+            if isinstance(unit, MasterModel) and not unit.pulp_type:
+                unit.pulp_type = '{app_label}.{type}'.format(app_label=unit._meta.app_label,
+                                                             type=unit.TYPE)
+            for parent, link_field in model._meta.parents.items():
+                setattr(unit, link_field.attname, unit._get_pk_val(parent._meta))
+        # This is what Model.save() and QuerySet.bulk_create() use, which refuses multi-table models
+        model._base_manager._insert(units, fields=model._meta.local_concrete_fields, using=using,
+                                    ignore_conflicts=ignore_conflicts)
+
+    def _pre_save_sync(self, batch):
+        """
+        A hook plugin-writers can override to save related objects prior to content unit saving.
+
+        This is called in a thread of the :class:`~pulpcore.plugin.stages.DatabaseExecutor`, within
+        the transaction saving the content units.
+
+        Args:
+            batch (list of :class:`~pulpcore.plugin.stages.DeclarativeContent`): The batch of
+                :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to be saved.
+
+        """
+        pass
+
+    def _post_save_sync(self, batch):
+        """
+        A hook plugin-writers can override to save related objects after content unit saving.
+
+        This is called in a thread of the :class:`~pulpcore.plugin.stages.DatabaseExecutor`, within
+        the transaction saving the content units.
+
+        Args:
+            batch (list of :class:`~pulpcore.plugin.stages.DeclarativeContent`): The batch of
+                :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to be saved.
+
+        """
+        pass
+
     async def _pre_save(self, batch):
         """
         A hook plugin-writers can override to save related objects prior to content unit saving.
 
-        This is run within the same transaction as the content unit saving.
+        Deprecated, override :meth:`_pre_save_sync` instead. When overridden, the batches are saved
+        on the event loop of the pipeline, and this is awaited within the transaction saving the
+        content units.
 
         Args:
             batch (list of :class:`~pulpcore.plugin.stages.DeclarativeContent`): The batch of
@@ -138,7 +569,9 @@ class ContentSaver(Stage):
         """
         A hook plugin-writers can override to save related objects after content unit saving.
 
-        This is run within the same transaction as the content unit saving.
+        Deprecated, override :meth:`_post_save_sync` instead. When overridden, the batches are saved
+        on the event loop of the pipeline, and this is awaited within the transaction saving the
+        content units.
 
         Args:
             batch (list of :class:`~pulpcore.plugin.stages.DeclarativeContent`): The batch of
@@ -148,6 +581,122 @@ class ContentSaver(Stage):
         pass
 
 
+class DeferredContentSaver(ContentSaver):
+    """
+    A Stages API stage saving everything needed for content whose artifacts are not downloaded.
+
+    This stage is used instead of the :class:`~pulpcore.plugin.stages.QueryExistingArtifacts`,
+    :class:`~pulpcore.plugin.stages.ArtifactDownloader`,
+    :class:`~pulpcore.plugin.stages.ArtifactSaver`,
+    :class:`~pulpcore.plugin.stages.QueryExistingContents`,
+    :class:`~pulpcore.plugin.stages.ContentSaver` and
+    :class:`~pulpcore.plugin.stages.RemoteArtifactSaver` stages when all artifacts have
+    `deferred_download` set, e.g. for on-demand syncs. It does the database work of those stages for
+    each batch in one transaction, in one call to its DatabaseExecutor, and does not download
+    anything. The existing artifacts and content are resolved and the artifacts saved, then
+    :meth:`~pulpcore.plugin.stages.ContentSaver._pre_save_sync` is called, the content and the
+    remote artifacts are saved, and :meth:`~pulpcore.plugin.stages.ContentSaver._post_save_sync` is
+    called. Like in :class:`~pulpcore.plugin.stages.ContentSaver`, the batches are saved on the
+    event loop when the deprecated hook coroutines are overridden.
+
+    Existing :class:`~pulpcore.plugin.models.Artifact` and
+    :class:`~pulpcore.plugin.models.Content` objects replace their unsaved counterparts. Unsaved
+    artifacts with a file are saved. New Content units are saved along with their
+    :class:`~pulpcore.plugin.models.ContentArtifact`, and the
+    :class:`~pulpcore.plugin.models.RemoteArtifact` objects missing are created.
+
+    Each :class:`~pulpcore.plugin.stages.DeclarativeContent` is sent to `self._out_q` after it has
+    been handled.
+
+    Args:
+        bulk_insert (bool): Whether to insert Content units in bulk, see
+            :class:`~pulpcore.plugin.stages.ContentSaver`. Defaults to `False`.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+
+    Raises:
+        ValueError: If an unsaved artifact without a file does not have `deferred_download` set.
+    """
+
+    def __init__(self, bulk_insert=False, *args, **kwargs):
+        super().__init__(bulk_insert, *args, **kwargs)
+        self._query_existing_artifacts = QueryExistingArtifacts()
+        self._remote_artifact_saver = RemoteArtifactSaver()
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        async for batch in self.batches():
+            if self._async_hooks:
+                with transaction.atomic():
+                    self._resolve_deferred_batch(batch)
+                    await self._pre_save(batch)
+                    self._save_content_and_remote_artifacts(batch)
+                    await self._post_save(batch)
+            else:
+                await self.run_in_db_executor(self._save_batch, batch)
+            for d_content in batch:
+                await self.put(d_content)
+
+    def _save_batch(self, batch):
+        """
+        Resolve and save everything needed for the Content units of a batch in one transaction,
+        along with the objects saved by the hooks.
+
+        Args:
+            batch (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+        """
+        with transaction.atomic():
+            self._resolve_deferred_batch(batch)
+            self._pre_save_sync(batch)
+            self._save_content_and_remote_artifacts(batch)
+            self._post_save_sync(batch)
+
+    def _resolve_deferred_batch(self, batch):
+        """
+        Replace the unsaved Artifacts and Content units of a batch by the existing ones, and save
+        the remaining Artifacts with a file.
+
+        Args:
+            batch (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+        """
+        self._query_existing_artifacts._query_existing_artifacts(batch)
+        da_to_save = []
+        for d_content in batch:
+            for d_artifact in d_content.d_artifacts:
+                if not d_artifact.artifact._state.adding or d_artifact.deferred_download:
+                    continue
+                if not d_artifact.artifact.file:
+                    raise ValueError(
+                        _('The artifact at {url} of {content} is not deferred and has no '
+                          'file, it cannot be saved without being downloaded.').format(
+                            url=d_artifact.url, content=d_content.content
+                        )
+                    )
+                d_artifact.artifact.file = str(d_artifact.artifact.file)
+                da_to_save.append(d_artifact)
+        if da_to_save:
+            ArtifactSaver._save_artifacts(da_to_save)
+
+        d_contents_by_type = QueryExistingContents._index_unsaved_by_type(batch)
+        if d_contents_by_type:
+            QueryExistingContents._query_existing_contents(d_contents_by_type)
+
+    def _save_content_and_remote_artifacts(self, batch):
+        """
+        Save the Content units of a batch with their ContentArtifacts and RemoteArtifacts.
+
+        Args:
+            batch (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+        """
+        self._save_content_and_artifacts(batch)
+        self._remote_artifact_saver._save_remote_artifacts(batch)
+
+
 class ResolveContentFutures(Stage):
     """
     This stage resolves the futures in :class:`~pulpcore.plugin.stages.DeclarativeContent`.
@@ -171,6 +720,8 @@ class ResolveContentFutures(Stage):
     can introduce new additional to-be-downloaded content at the beginning of the pipeline.
     """
 
+    replica_safe = True
+
     async def run(self):
         """
         The coroutine for this stage.
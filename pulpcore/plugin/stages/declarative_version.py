@@ -11,12 +11,18 @@ from .artifact_stages import (
     RemoteArtifactSaver,
 )
 from .association_stages import ContentAssociation, ContentUnassociation, RemoveDuplicates
-from .content_stages import ContentSaver, QueryExistingContents, ResolveContentFutures
+from .content_stages import (
+    ContentSaver,
+    DeferredContentSaver,
+    QueryExistingContents,
+    ResolveContentFutures,
+)
 
 
 class DeclarativeVersion:
 
-    def __init__(self, first_stage, repository, mirror=False, remove_duplicates=None):
+    def __init__(self, first_stage, repository, mirror=False, remove_duplicates=None,
+                 deferred_download=False):
         """
         A pipeline that creates a new :class:`~pulpcore.plugin.models.RepositoryVersion` from a
         stream of :class:`~pulpcore.plugin.stages.DeclarativeContent` objects.
@@ -54,6 +60,12 @@ class DeclarativeVersion:
         12. Unassociate any content units not declared in the stream (only when mirror=True)
             with :class:`~pulpcore.plugin.stages.ContentUnassociation`
 
+        With `deferred_download=True`, steps 3 to 8 are done by a single
+        :class:`~pulpcore.plugin.stages.DeferredContentSaver` stage instead, in one transaction per
+        batch and without downloading anything. All the
+        :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects of the stream must then have
+        `deferred_download` set, or be artifacts that already have a file.
+
         To do this, the plugin writer should subclass the
         :class:`~pulpcore.plugin.stages.Stage` class and define its
         :meth:`run()` interface which returns a coroutine. This coroutine should
@@ -115,12 +127,15 @@ class DeclarativeVersion:
                 pipeline. Each dict should have 2 keys, `model`, which is a subclass of
                 :class:`pulpcore.plugin.models.Content` and `field_names` which is a list of
                 strings corresponding to fields on the provided model.
+            deferred_download (bool): 'True' if the artifacts of all content units of the stream
+                are not downloaded, e.g. for an on-demand sync. 'False' is the default.
 
         """
         self.first_stage = first_stage
         self.repository = repository
         self.mirror = mirror
         self.remove_duplicates = remove_duplicates or []
+        self.deferred_download = deferred_download
 
     def pipeline_stages(self, new_version):
         """
@@ -130,6 +145,9 @@ class DeclarativeVersion:
         can be achieved by returning a list with different stages or by extending
         the list returned by this method.
 
+        The built-in stages declare the depth of their input queue with their `in_q_maxsize`
+        attribute. It can be changed on the returned stage instances.
+
         Args:
             new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The
                 new repository version that is going to be built.
@@ -138,16 +156,23 @@ class DeclarativeVersion:
             list: List of :class:`~pulpcore.plugin.stages.Stage` instances
 
         """
-        pipeline = [
-            self.first_stage,
-            QueryExistingArtifacts(),
-            ArtifactDownloader(),
-            ArtifactSaver(),
-            QueryExistingContents(),
-            ContentSaver(),
-            RemoteArtifactSaver(),
-            ResolveContentFutures(),
-        ]
+        if self.deferred_download:
+            pipeline = [
+                self.first_stage,
+                DeferredContentSaver(),
+                ResolveContentFutures(),
+            ]
+        else:
+            pipeline = [
+                self.first_stage,
+                QueryExistingArtifacts(),
+                ArtifactDownloader(),
+                ArtifactSaver(),
+                QueryExistingContents(),
+                ContentSaver(),
+                RemoteArtifactSaver(),
+                ResolveContentFutures(),
+            ]
         for dupe_query_dict in self.remove_duplicates:
             pipeline.extend([RemoveDuplicates(new_version, **dupe_query_dict)])
 
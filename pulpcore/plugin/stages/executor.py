@@ -0,0 +1,69 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+
+class DatabaseExecutor:
+    """
+    A bounded pool of threads to run blocking Django ORM calls without blocking the event loop.
+
+    Django opens database connections per thread, so each worker thread of the pool uses its own
+    connections. They are closed by :meth:`shutdown`.
+
+    :func:`~pulpcore.plugin.stages.create_pipeline` creates one DatabaseExecutor for each pipeline.
+    Stages use it through :meth:`~pulpcore.plugin.stages.Stage.run_in_db_executor`.
+
+    Args:
+        max_workers (int): The number of worker threads. Defaults to the `STAGES_API_DB_WORKERS`
+            setting, or 4 if it is not set.
+    """
+
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = getattr(settings, 'STAGES_API_DB_WORKERS', 4)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run `func` in a worker thread and wait for its result.
+
+        Args:
+            func (callable): The blocking function to run.
+            args: positional arguments passed along to `func`.
+            kwargs: keyword arguments passed along to `func`.
+
+        Returns:
+            The return value of `func`.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(self._call, func, *args, **kwargs)
+        )
+
+    def _call(self, func, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._connections.update(connections.all())
+
+    def shutdown(self):
+        """
+        Wait for the running calls to finish and close the connections of the worker threads.
+        """
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for connection in self._connections:
+                # The connection belongs to a worker thread, which is finished by now
+                connection.inc_thread_sharing()
+                try:
+                    connection.close()
+                finally:
+                    connection.dec_thread_sharing()
+            self._connections.clear()
@@ -0,0 +1,230 @@
+from bisect import bisect_left
+import time
+import weakref
+
+
+class LogHistogram:
+    """
+    Counts values in buckets whose upper bounds grow by a constant factor.
+
+    The bounds are fixed when the histogram is created, so recording a value is a binary search and
+    an increment. Values above the last bound are counted in an overflow bucket.
+
+    Args:
+        first_bound (float): The upper bound of the first bucket.
+        bucket_count (int): The number of buckets, not counting the overflow bucket.
+        factor (float): The ratio between the upper bounds of two consecutive buckets. Defaults to
+            2.
+
+    Attributes:
+        bounds (tuple): The upper bounds of the buckets.
+        counts (list): The number of values in each bucket, followed by the overflow bucket.
+        count (int): The number of values recorded.
+        sum (float): The sum of the values recorded.
+        max (float): The largest value recorded.
+    """
+
+    def __init__(self, first_bound, bucket_count, factor=2):
+        self.bounds = tuple(first_bound * factor ** i for i in range(bucket_count))
+        self.counts = [0] * (bucket_count + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def record(self, value):
+        """
+        Record a value.
+
+        Args:
+            value (float): The value to record.
+        """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """
+        Estimate a percentile of the recorded values.
+
+        Args:
+            percent (float): The percentile to estimate, between 0 and 100.
+
+        Returns:
+            The upper bound of the bucket holding the percentile, or the largest value recorded if
+            it is lower. 0 if no value was recorded.
+        """
+        if not self.count:
+            return 0
+        rank = percent / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: The count, sum, mean, maximum, estimated 50th, 95th and 99th percentiles, and
+                the non-empty buckets as a list of `(upper bound, count)` pairs, where the upper
+                bound of the overflow bucket is `None`.
+        """
+        bounds = self.bounds + (None,)
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'buckets': [(bound, count) for bound, count in zip(bounds, self.counts) if count],
+        }
+
+
+class StageMetrics:
+    """
+    Throughput counters and latency histograms of a :class:`~pulpcore.plugin.stages.Stage`.
+
+    They are recorded by :meth:`~pulpcore.plugin.stages.Stage.items`,
+    :meth:`~pulpcore.plugin.stages.Stage.batches` and :meth:`~pulpcore.plugin.stages.Stage.put`,
+    and are always on. Times are in seconds.
+
+    Attributes:
+        items_in (int): The number of items received from the input queue.
+        items_out (int): The number of items put into the output queue.
+        batch_sizes (:class:`LogHistogram`): The sizes of the batches yielded by
+            :meth:`~pulpcore.plugin.stages.Stage.batches`.
+        wait_times (:class:`LogHistogram`): The time the stage waited for each item, or for each
+            batch to fill, on its input queue.
+        service_times (:class:`LogHistogram`): The time the stage spent handling each item or
+            batch, not counting the time the task that received it blocked on a full output queue
+            meanwhile.
+        put_blocked_times (:class:`LogHistogram`): The time each put into a full output queue
+            blocked.
+    """
+
+    def __init__(self):
+        self.items_in = 0
+        self.items_out = 0
+        self.batch_sizes = LogHistogram(1, 12)
+        self.wait_times = LogHistogram(0.0001, 20)
+        self.service_times = LogHistogram(0.0001, 20)
+        self.put_blocked_times = LogHistogram(0.0001, 20)
+        self.started_at = None
+        self.finished_at = None
+        self._put_blocked_by_task = weakref.WeakKeyDictionary()
+
+    def start(self):
+        """
+        Record that the stage started running.
+        """
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    def finish(self):
+        """
+        Record that the stage finished running.
+        """
+        self.finished_at = time.monotonic()
+
+    def record_put_blocked(self, task, seconds):
+        """
+        Record the time a put into a full output queue blocked.
+
+        Args:
+            task (:class:`asyncio.Task`): The task that was blocked, or None.
+            seconds (float): The time the put blocked.
+        """
+        self.put_blocked_times.record(seconds)
+        if task is not None:
+            self._put_blocked_by_task[task] = self._put_blocked_by_task.get(task, 0) + seconds
+
+    def put_blocked_by(self, task):
+        """
+        Args:
+            task (:class:`asyncio.Task`): A task of the stage, or None.
+
+        Returns:
+            float: The total time puts of `task` blocked on a full output queue.
+        """
+        if task is None:
+            return 0
+        return self._put_blocked_by_task.get(task, 0)
+
+    @property
+    def elapsed(self):
+        """
+        The number of seconds the stage has been running, or ran.
+        """
+        if self.started_at is None:
+            return 0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: The counters, the throughput in items out per second, and the snapshots of the
+                histograms. It can be taken while the stage is running.
+        """
+        elapsed = self.elapsed
+        return {
+            'items_in': self.items_in,
+            'items_out': self.items_out,
+            'elapsed': elapsed,
+            'throughput': self.items_out / elapsed if elapsed else 0,
+            'batch_sizes': self.batch_sizes.snapshot(),
+            'wait_times': self.wait_times.snapshot(),
+            'service_times': self.service_times.snapshot(),
+            'put_blocked_times': self.put_blocked_times.snapshot(),
+        }
+
+    def summary(self):
+        """
+        Returns:
+            str: A one line summary of the metrics, for logging.
+        """
+        return (
+            '{items_in} in, {items_out} out in {elapsed:.1f}s ({throughput:.1f}/s), '
+            'service p50/p95 {service_p50:.4f}/{service_p95:.4f}s, '
+            'wait p50/p95 {wait_p50:.4f}/{wait_p95:.4f}s, '
+            'blocked on put {blocked:.1f}s, mean batch {batch:.1f}'
+        ).format(
+            items_in=self.items_in,
+            items_out=self.items_out,
+            elapsed=self.elapsed,
+            throughput=self.items_out / self.elapsed if self.elapsed else 0,
+            service_p50=self.service_times.percentile(50),
+            service_p95=self.service_times.percentile(95),
+            wait_p50=self.wait_times.percentile(50),
+            wait_p95=self.wait_times.percentile(95),
+            blocked=self.put_blocked_times.sum,
+            batch=self.batch_sizes.sum / self.batch_sizes.count if self.batch_sizes.count else 0,
+        )
+
+
+def pipeline_metrics(stages):
+    """
+    Take a snapshot of the metrics of the stages of a pipeline.
+
+    It can be called while the pipeline runs, e.g. from another task, or after it finished.
+
+    Args:
+        stages (list): The stages passed to :func:`~pulpcore.plugin.stages.create_pipeline`, or
+            lists of replicas of stages.
+
+    Returns:
+        list: A dict for each stage instance, with its name under `stage` along with the snapshot
+            of its :class:`~pulpcore.plugin.stages.StageMetrics`.
+    """
+    snapshots = []
+    for stage in stages:
+        replicas = stage if isinstance(stage, (list, tuple)) else [stage]
+        for replica in replicas:
+            snapshot = replica.metrics.snapshot()
+            snapshot['stage'] = str(replica)
+            snapshots.append(snapshot)
+    return snapshots
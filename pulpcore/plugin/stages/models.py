@@ -1,6 +1,8 @@
 from gettext import gettext as _
 
 import asyncio
+import os
+import tempfile
 
 from pulpcore.plugin.models import Artifact
 
@@ -55,10 +57,15 @@ class DeclarativeArtifact:
         self.extra_data = extra_data or {}
         self.deferred_download = deferred_download
 
-    async def download(self):
+    async def download(self, temp_dir=None):
         """
         Download content and update the associated Artifact.
 
+        Args:
+            temp_dir (str): The directory the download is written to, see
+                :class:`~pulpcore.plugin.stages.DownloadDirectory`. Defaults to None,
+                meaning the downloader writes to the working directory.
+
         Returns:
             Returns the :class:`~pulpcore.plugin.download.DownloadResult` of the Artifact.
         """
@@ -73,15 +80,27 @@ class DeclarativeArtifact:
         if self.artifact.size:
             expected_size = self.artifact.size
             validation_kwargs['expected_size'] = expected_size
+        writer = None
+        if temp_dir is not None:
+            writer = tempfile.NamedTemporaryFile(dir=temp_dir, delete=False)
+            validation_kwargs['custom_file_object'] = writer
         downloader = self.remote.get_downloader(
             url=self.url,
             **validation_kwargs
         )
-        # Custom downloaders may need extra information to complete the request.
-        download_result = await downloader.run(extra_data=self.extra_data)
+        try:
+            # Custom downloaders may need extra information to complete the request.
+            download_result = await downloader.run(extra_data=self.extra_data)
+        except BaseException:
+            if writer is not None:
+                writer.close()
+                os.unlink(writer.name)
+            raise
+        # The downloader only knows the path of a temporary file it created itself
+        path = download_result.path if writer is None else writer.name
         self.artifact = Artifact(
             **download_result.artifact_attributes,
-            file=download_result.path
+            file=path
         )
         return download_result
 
@@ -108,12 +127,16 @@ class DeclarativeContent:
             :class:`~pulpcore.plugin.models.Content` in the
             :class:`~pulpcore.plugin.stages.ResolveContentFutures` stage. See the
             :class:`~pulpcore.plugin.stages.ResolveContentFutures` stage for example usage.
+        newly_created (bool): Whether `content` was created by the
+            :class:`~pulpcore.plugin.stages.ContentSaver` stage in this pipeline. Defaults to
+            `False`.
 
     Raises:
         ValueError: If `content` is not specified.
     """
 
-    __slots__ = ('content', 'd_artifacts', 'extra_data', 'does_batch', 'future')
+    __slots__ = ('content', 'd_artifacts', 'extra_data', 'does_batch', 'future', 'newly_created',
+                 '_content_artifacts')
 
     def __init__(self, content=None, d_artifacts=None, extra_data=None, does_batch=True):
         if not content:
@@ -123,6 +146,9 @@ class DeclarativeContent:
         self.extra_data = extra_data or {}
         self.does_batch = does_batch
         self.future = None
+        self.newly_created = False
+        # The ContentArtifacts created along with `content`, keyed by relative path
+        self._content_artifacts = None
 
     def get_or_create_future(self):
         """
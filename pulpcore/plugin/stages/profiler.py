@@ -1,4 +1,6 @@
+from array import array
 from asyncio import Queue
+from itertools import repeat
 import pathlib
 import time
 import uuid
@@ -26,6 +28,11 @@ class ProfilingQueue(Queue):
         * queue_length - The number of waiting items in the queue, measured before each new arrival.
         * interarrival_time - The number of seconds since the previous arrival to this Queue.
 
+    The statistics are recorded in preallocated in-memory arrays of `buffer_size` samples. They are
+    written to the database with one `executemany()` per table and a single commit when a buffer is
+    full, when `flush_interval` seconds passed since the last write, and by :meth:`flush` when the
+    pipeline ends.
+
     See the :meth:`create_profile_db_and_connection()` docs for more info on the database tables and
     layout.
 
@@ -35,9 +42,22 @@ class ProfilingQueue(Queue):
          kwargs (dict): unused keyword arguments
     """
 
+    #: The number of samples kept in memory for each table before writing them.
+    buffer_size = 10000
+    #: The maximum number of seconds between two writes.
+    flush_interval = 5.0
+
     def __init__(self, stage_uuid, *args, **kwargs):
         self.last_arrival_time = time.time()
         self.stage_uuid = stage_uuid
+        self._stage_uuid_str = str(stage_uuid)
+        self._waiting_times = array('d', bytes(8 * self.buffer_size))
+        self._service_times = array('d', bytes(8 * self.buffer_size))
+        self._traffic_count = 0
+        self._lengths = array('q', bytes(8 * self.buffer_size))
+        self._interarrival_times = array('d', bytes(8 * self.buffer_size))
+        self._system_count = 0
+        self._last_flush_time = time.monotonic()
         return super().__init__(*args, **kwargs)
 
     def get_nowait(self):
@@ -53,9 +73,9 @@ class ProfilingQueue(Queue):
 
     def put_nowait(self, item):
         """
-        Thinly wrap `asyncio.put_nowait` happens and write statistics about them to the sqlite3 DB.
+        Thinly wrap `asyncio.put_nowait` and record statistics about the put items.
 
-        This method computes and writes the following statistics: waiting time, service time, queue
+        This method computes and records the following statistics: waiting time, service time, queue
         length, and interarrival time.
         """
         if item:
@@ -68,27 +88,49 @@ class ProfilingQueue(Queue):
             except KeyError:
                 pass
             else:
-                service_time = now - item.extra_data['last_get_time']
-                sql = "INSERT INTO traffic (uuid, waiting_time, service_time) VALUES (" \
-                      "'{uuid}','{waiting_time}','{service_time}')"
-                formatted_sql = sql.format(
-                    uuid=self.stage_uuid, waiting_time=last_waiting_time, service_time=service_time
-                )
-                CONN.cursor().execute(formatted_sql)
-
-            interarrival_time = now - self.last_arrival_time
-            sql = "INSERT INTO system (uuid, length, interarrival_time) VALUES (" \
-                  "'{uuid}','{length}','{interarrival}')"
-            formatted_sql = sql.format(
-                uuid=self.stage_uuid, length=super().qsize(), interarrival=interarrival_time
-            )
-            CONN.cursor().execute(formatted_sql)
-            CONN.commit()
+                self._waiting_times[self._traffic_count] = last_waiting_time
+                self._service_times[self._traffic_count] = now - item.extra_data['last_get_time']
+                self._traffic_count += 1
+
+            self._lengths[self._system_count] = super().qsize()
+            self._interarrival_times[self._system_count] = now - self.last_arrival_time
+            self._system_count += 1
 
             item.extra_data['lastput_time'] = now
             self.last_arrival_time = now
+
+            if self._system_count == self.buffer_size or self._traffic_count == self.buffer_size \
+                    or time.monotonic() - self._last_flush_time >= self.flush_interval:
+                self.flush()
         return super().put_nowait(item)
 
+    def flush(self):
+        """
+        Write the recorded statistics to the sqlite3 DB and empty the buffers.
+        """
+        if not self._traffic_count and not self._system_count:
+            return
+        uuid_str = self._stage_uuid_str
+        cursor = CONN.cursor()
+        if self._traffic_count:
+            count = self._traffic_count
+            cursor.executemany(
+                "INSERT INTO traffic (uuid, waiting_time, service_time) VALUES (?, ?, ?)",
+                zip(repeat(uuid_str, count), self._waiting_times[:count],
+                    self._service_times[:count])
+            )
+            self._traffic_count = 0
+        if self._system_count:
+            count = self._system_count
+            cursor.executemany(
+                "INSERT INTO system (uuid, length, interarrival_time) VALUES (?, ?, ?)",
+                zip(repeat(uuid_str, count), self._lengths[:count],
+                    self._interarrival_times[:count])
+            )
+            self._system_count = 0
+        CONN.commit()
+        self._last_flush_time = time.monotonic()
+
     @staticmethod
     def make_and_record_queue(stage, num, maxsize):
         """
@@ -106,26 +148,46 @@ class ProfilingQueue(Queue):
             create_profile_db_and_connection()
         stage_id = uuid.uuid4()
         stage_name = '.'.join([stage.__class__.__module__, stage.__class__.__name__])
-        sql = "INSERT INTO stages (uuid, name, num) VALUES (" \
-              "'{uuid}','{stage}','{num}')"
+        sql = "INSERT INTO stages (uuid, name, num, maxsize) VALUES (" \
+              "'{uuid}','{stage}','{num}','{maxsize}')"
         formatted_sql = sql.format(
-            uuid=stage_id, stage=stage_name, num=num)
+            uuid=stage_id, stage=stage_name, num=num, maxsize=maxsize)
         CONN.cursor().execute(formatted_sql)
         in_q = ProfilingQueue(stage_id, maxsize=maxsize)
         CONN.commit()
         return in_q
 
 
+def debug_data_path():
+    """
+    Return the path of the debug data of this task, named after its job id.
+
+    The `/var/lib/pulp/debug/` folder is created if needed. Outside of a task a random uuid is used
+    instead of the job id.
+
+    Returns:
+        str: The path, without any extension.
+    """
+    debug_data_dir = "/var/lib/pulp/debug/"
+    pathlib.Path(debug_data_dir).mkdir(parents=True, exist_ok=True)
+    redis_conn = connection.get_redis_connection()
+    current_job = get_current_job(connection=redis_conn)
+    if current_job:
+        return debug_data_dir + current_job.id
+    return debug_data_dir + str(uuid.uuid4())
+
+
 def create_profile_db_and_connection():
     """
     Create a profile db from this tasks UUID and a sqlite3 connection to that databases.
 
     The database produced has three tables with the following SQL format:
 
-    The `stages` table stores info about the pipeline itself and stores 3 fields
+    The `stages` table stores info about the pipeline itself and stores 4 fields
     * uuid - the uuid of the stage
     * name - the name of the stage
     * num - the number of the stage starting at 0
+    * maxsize - the maxsize of the input queue of the stage, 0 if it is unbounded
 
     The `traffic` table stores 3 fields:
     * uuid - the uuid of the stage this queue feeds into
@@ -137,14 +199,7 @@ def create_profile_db_and_connection():
     * length - The length of items in this queue, measured just before each arrival.
     * interarrival_time - The amount of time since the last arrival.
     """
-    debug_data_dir = "/var/lib/pulp/debug/"
-    pathlib.Path(debug_data_dir).mkdir(parents=True, exist_ok=True)
-    redis_conn = connection.get_redis_connection()
-    current_job = get_current_job(connection=redis_conn)
-    if current_job:
-        db_path = debug_data_dir + current_job.id
-    else:
-        db_path = debug_data_dir + uuid.uuid4()
+    db_path = debug_data_path()
 
     import sqlite3
     global CONN
@@ -153,7 +208,7 @@ def create_profile_db_and_connection():
 
     # Create table
     c.execute('''CREATE TABLE stages
-                 (uuid varchar(36), name text, num int)''')
+                 (uuid varchar(36), name text, num int, maxsize int)''')
 
     # Create table
     c.execute('''CREATE TABLE traffic
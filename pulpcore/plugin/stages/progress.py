@@ -0,0 +1,63 @@
+import time
+
+
+class ProgressThrottle:
+    """
+    Coalesces the increments of a :class:`~pulpcore.plugin.models.ProgressReport` into few saves.
+
+    Increments are added to `done` of the progress report right away, but it is only saved once
+    `interval` milliseconds passed or `max_items` items were added since the last save. Leaving the
+    context manager of the ProgressThrottle, or of the progress report, saves the final state.
+
+    Example:
+        >>> with ProgressReport(message='Associating Content', code='associating.content') as pb:
+        >>>     progress = ProgressThrottle(pb)
+        >>>     async for batch in self.batches():
+        >>>         ...
+        >>>         progress.increase_by(len(batch))
+
+    Args:
+        progress_report (:class:`~pulpcore.plugin.models.ProgressReport`): The progress report to
+            update.
+        interval (int): The minimum number of milliseconds between two saves. Defaults to 500.
+        max_items (int): The number of items after which the progress report is saved, even within
+            `interval`. Defaults to `None`, meaning only `interval` applies.
+    """
+
+    def __init__(self, progress_report, interval=500, max_items=None):
+        self.progress_report = progress_report
+        self.interval = interval / 1000
+        self.max_items = max_items
+        self._pending = 0
+        self._last_save_time = time.monotonic()
+
+    def increase_by(self, count):
+        """
+        Add `count` items to the progress report, saving it if due.
+
+        Args:
+            count (int): The number of items handled.
+        """
+        if not count:
+            return
+        self.progress_report.done += count
+        self._pending += count
+        if self.max_items is not None and self._pending >= self.max_items:
+            self.flush()
+        elif time.monotonic() - self._last_save_time >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Save the progress report if it has pending increments.
+        """
+        if self._pending:
+            self.progress_report.save()
+            self._pending = 0
+            self._last_save_time = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.flush()
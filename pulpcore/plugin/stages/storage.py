@@ -0,0 +1,62 @@
+import os
+import shutil
+
+from django.core.files.storage import default_storage, FileSystemStorage
+from rq.job import get_current_job
+
+from pulpcore.plugin.tasking import WorkingDirectory
+
+
+class DownloadDirectory(WorkingDirectory):
+    """
+    The directory the downloads of a task are written to, on the filesystem of the artifact storage.
+
+    Path format: <storage-location>/.downloads/<worker-hostname>/<task-id>
+
+    Downloaders compute the digests while writing to a temporary file in the current working
+    directory. Saving the Artifact moves that file into the artifact storage, which is a rename on
+    the same filesystem but a full copy across filesystems. When the working directory is on another
+    filesystem than a local artifact storage, :func:`~pulpcore.plugin.stages.create_pipeline` has
+    the downloads written to this directory instead, and deletes it when the pipeline finishes.
+
+    A worker runs one task at a time, so the directories of its other tasks were left behind by
+    killed tasks. They are deleted when the directory is created.
+    """
+
+    @staticmethod
+    def _worker_path(hostname):
+        """
+        Get the download directory path for a worker by hostname.
+
+        Format: <storage-location>/.downloads/<worker-hostname>
+
+        Args:
+            hostname (str): The worker hostname.
+
+        Returns:
+            str: The absolute path to a worker's download directory.
+        """
+        return os.path.join(default_storage.location, '.downloads', hostname)
+
+    @staticmethod
+    def needed():
+        """
+        Whether the downloads of the current task should be written to the artifact storage.
+
+        Returns:
+            bool: True within a task, when the artifact storage is local and on another filesystem
+                than the working directory.
+        """
+        if get_current_job() is None or not isinstance(default_storage, FileSystemStorage):
+            return False
+        try:
+            return os.stat(os.getcwd()).st_dev != os.stat(default_storage.location).st_dev
+        except OSError:
+            return False
+
+    def create(self):
+        """
+        Create the directory, deleting the directories left behind by killed tasks of the worker.
+        """
+        shutil.rmtree(os.path.dirname(self.path), ignore_errors=True)
+        super().create()
@@ -0,0 +1,165 @@
+from collections import deque
+from contextlib import contextmanager
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+
+class Tracer:
+    """
+    Records timing spans of a Stages API pipeline in the Chrome trace event format.
+
+    The file written by :meth:`write` can be opened in trace viewers such as `chrome://tracing` or
+    Perfetto. Each stage gets its own track, named after the stage, holding the spans of its
+    batches, items, queue waits, blocked puts and database calls. Downloads overlap each other, so
+    they are recorded as asynchronous spans.
+
+    Only the last `maxlen` events are kept, so memory stays bounded however long the pipeline runs.
+
+    :func:`~pulpcore.plugin.stages.create_pipeline` creates a Tracer when the `TRACE_STAGES_API`
+    setting is enabled. It writes the trace next to the profile databases, see
+    :ref:`stages-api-profiling-docs`.
+
+    Args:
+        path (str): The path of the trace file to write.
+        maxlen (int): The maximum number of events kept. Defaults to 100000.
+    """
+
+    def __init__(self, path, maxlen=100000):
+        self.path = path
+        self.events = deque(maxlen=maxlen)
+        self._pid = os.getpid()
+        self._tracks = {}
+        self._track_names = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def track(self, stage):
+        """
+        Return the track id of a stage, creating the track if needed.
+
+        Args:
+            stage (:class:`~pulpcore.plugin.stages.Stage`): The stage.
+
+        Returns:
+            int: The track id.
+        """
+        with self._lock:
+            try:
+                return self._tracks[stage]
+            except KeyError:
+                track = self._tracks[stage] = len(self._tracks) + 1
+                self._track_names[track] = str(stage)
+                return track
+
+    @staticmethod
+    def now():
+        """
+        Returns:
+            float: The current time, in the clock of the recorded spans.
+        """
+        return time.monotonic()
+
+    def add_span(self, track, name, category, start, end, **args):
+        """
+        Record a span that started at `start` and ended at `end`.
+
+        Args:
+            track (int): The track id of the stage.
+            name (str): The name of the span, e.g. 'batch'.
+            category (str): The category of the span, e.g. 'db'.
+            start (float): The start time, as returned by :meth:`now`.
+            end (float): The end time, as returned by :meth:`now`.
+            args: Details shown with the span, e.g. the batch size.
+        """
+        self.events.append({
+            'name': name, 'cat': category, 'ph': 'X', 'pid': self._pid, 'tid': track,
+            'ts': start * 1e6, 'dur': (end - start) * 1e6, 'args': args,
+        })
+
+    @contextmanager
+    def span(self, track, name, category, **args):
+        """
+        A context manager recording a span around its body.
+
+        Args:
+            track (int): The track id of the stage.
+            name (str): The name of the span.
+            category (str): The category of the span.
+            args: Details shown with the span.
+        """
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add_span(track, name, category, start, self.now(), **args)
+
+    @contextmanager
+    def async_span(self, track, name, category, **args):
+        """
+        A context manager recording a span around its body that may overlap other spans.
+
+        Args:
+            track (int): The track id of the stage.
+            name (str): The name of the span.
+            category (str): The category of the span.
+            args: Details shown with the span.
+        """
+        span_id = next(self._ids)
+        event = {'name': name, 'cat': category, 'pid': self._pid, 'tid': track, 'id': span_id}
+        self.events.append(dict(event, ph='b', ts=self.now() * 1e6, args=args))
+        try:
+            yield
+        finally:
+            self.events.append(dict(event, ph='e', ts=self.now() * 1e6))
+
+    def wrap(self, track, name, category, func):
+        """
+        Wrap a function to record a span around each of its calls.
+
+        Args:
+            track (int): The track id of the stage.
+            name (str): The name of the spans.
+            category (str): The category of the spans.
+            func (callable): The function to wrap.
+
+        Returns:
+            callable: The wrapped function.
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.span(track, name, category):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def write(self):
+        """
+        Write the recorded events to `path` as a JSON trace file.
+        """
+        metadata = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': track,
+             'args': {'name': name}}
+            for track, name in self._track_names.items()
+        ]
+        with open(self.path, 'w') as trace_file:
+            json.dump(
+                {'traceEvents': metadata + list(self.events), 'displayTimeUnit': 'ms'}, trace_file
+            )
+
+
+class _NoSpan:
+    """
+    The context manager used instead of a span when tracing is disabled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+NO_SPAN = _NoSpan()
@@ -0,0 +1,95 @@
+"""
+Benchmark of ingesting a downloaded artifact into the artifact storage.
+
+A download is written and hashed once, either to a temporary file in the working directory, as the
+downloaders do by default, or to one in a directory of the artifact storage, as in the
+`DownloadDirectory` of a pipeline. The file is then moved into the artifact storage, as saving the
+Artifact does. The wall time and the bytes written to disk, read from `/proc/self/io`, are logged
+for both.
+
+This is only meaningful when the working directory and `MEDIA_ROOT` are on different filesystems,
+and only runs when `STAGES_BENCHMARK_ARTIFACT_SIZES` is set to a comma separated list of sizes in
+MiB::
+
+    STAGES_BENCHMARK_ARTIFACT_SIZES=1024,4096 \\
+        django-admin test ./pulpcore/tests/performance/test_artifact_ingestion.py
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import default_storage
+
+from pulpcore.plugin.models import Artifact
+
+
+log = logging.getLogger(__name__)
+
+SIZES = [
+    int(size) for size in os.environ.get('STAGES_BENCHMARK_ARTIFACT_SIZES', '').split(',') if size
+]
+CHUNK = os.urandom(1024 * 1024)
+
+
+def written_bytes():
+    """The number of bytes this process caused to be written to disk so far."""
+    with open('/proc/self/io') as io:
+        for line in io:
+            if line.startswith('write_bytes:'):
+                return int(line.split()[1])
+
+
+def download(writer, size):
+    """Write and hash `size` MiB to `writer` in one pass, like a downloader does."""
+    hashers = {name: hashlib.new(name) for name in Artifact.DIGEST_FIELDS}
+    for i in range(size):
+        writer.write(CHUNK)
+        for hasher in hashers.values():
+            hasher.update(CHUNK)
+    writer.close()
+    return {name: hasher.hexdigest() for name, hasher in hashers.items()}
+
+
+class TestArtifactIngestion(TestCase):
+
+    def setUp(self):
+        if not SIZES:
+            self.skipTest('STAGES_BENCHMARK_ARTIFACT_SIZES is not set')
+        if os.stat(os.getcwd()).st_dev == os.stat(default_storage.location).st_dev:
+            self.skipTest('the working directory is on the filesystem of the artifact storage')
+        self.target_dir = tempfile.mkdtemp(dir=default_storage.location, prefix='.benchmark-')
+        self.addCleanup(os.rmdir, self.target_dir)
+        self.download_dir = tempfile.mkdtemp(dir=default_storage.location, prefix='.downloads-')
+        self.addCleanup(os.rmdir, self.download_dir)
+
+    def ingest(self, writer, size):
+        """Download to `writer` and move the file into storage, returning the time and bytes."""
+        os.sync()
+        start_bytes, start = written_bytes(), time.perf_counter()
+        download(writer, size)
+        target = os.path.join(self.target_dir, 'artifact')
+        file_move_safe(writer.name, target)
+        os.sync()
+        elapsed, written = time.perf_counter() - start, written_bytes() - start_bytes
+        os.unlink(target)
+        return elapsed, written
+
+    def test_ingestion(self):
+        for size in sorted(SIZES):
+            working_dir = self.ingest(
+                tempfile.NamedTemporaryFile(dir=os.getcwd(), delete=False), size
+            )
+            storage = self.ingest(
+                tempfile.NamedTemporaryFile(dir=self.download_dir, delete=False), size
+            )
+            log.info(
+                '%(size)d MiB artifact: working directory %(wd_time).1fs, %(wd_bytes)d MiB '
+                'written; artifact storage %(st_time).1fs, %(st_bytes)d MiB written',
+                {'size': size, 'wd_time': working_dir[0], 'wd_bytes': working_dir[1] >> 20,
+                 'st_time': storage[0], 'st_bytes': storage[1] >> 20}
+            )
+            self.assertLess(storage[1], working_dir[1])
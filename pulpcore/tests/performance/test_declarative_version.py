@@ -0,0 +1,202 @@
+"""
+End-to-end benchmarks of the DeclarativeVersion pipeline.
+
+A synthetic first stage declares N file units, each with one artifact, and a stub downloader
+serves the artifacts from memory. The full pipeline then runs against the database configured for
+Pulp, which should be a local PostgreSQL. The `pulp_file` plugin provides the content type.
+
+These are not part of the unit tests and only run when `STAGES_BENCHMARK_SIZES` is set to a comma
+separated list of unit counts. The results are logged::
+
+    STAGES_BENCHMARK_SIZES=10000,100000,1000000 \\
+        django-admin test ./pulpcore/tests/performance/test_declarative_version.py
+
+For each size and mode, the wall time, the units per second, the peak RSS of the process and the
+number of queries of each stage are logged. Stages are told apart by the
+:meth:`~pulpcore.plugin.stages.Stage.run_in_db_executor` calls; other queries, e.g. progress
+reports and the repository version, are counted under 'event loop'. The peak RSS never decreases,
+so sizes are run in increasing order. Compare the output of runs before and after a change to spot
+regressions.
+"""
+from collections import Counter
+from contextlib import contextmanager
+import functools
+import hashlib
+import logging
+import os
+import resource
+import threading
+import time
+from unittest import mock
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import TransactionTestCase
+
+from pulpcore.plugin.download import BaseDownloader, DownloadResult
+from pulpcore.plugin.models import Artifact, Repository, Task
+from pulpcore.plugin.stages import (
+    DeclarativeArtifact,
+    DeclarativeContent,
+    DeclarativeVersion,
+    Stage,
+)
+
+try:
+    from pulp_file.app.models import FileContent, FileRemote
+except ImportError:
+    FileContent = FileRemote = None
+
+
+log = logging.getLogger(__name__)
+
+SIZES = [int(size) for size in os.environ.get('STAGES_BENCHMARK_SIZES', '').split(',') if size]
+
+
+def artifact_data(url):
+    """The content served by the stub downloader for `url`."""
+    return url.encode()
+
+
+class StubDownloader(BaseDownloader):
+    """A downloader serving the artifact data from memory, still computing and checking digests."""
+
+    async def _run(self, extra_data=None):
+        await self.handle_data(artifact_data(self.url))
+        await self.finalize()
+        return DownloadResult(path=self.path, artifact_attributes=self.artifact_attributes,
+                              url=self.url, headers=None)
+
+
+class SyntheticFirstStage(Stage):
+    """Declares `count` file units with one artifact each."""
+
+    def __init__(self, remote, count, prefix, deferred_download):
+        super().__init__()
+        self.remote = remote
+        self.count = count
+        self.prefix = prefix
+        self.deferred_download = deferred_download
+
+    async def run(self):
+        for i in range(self.count):
+            relative_path = '{prefix}/{i}'.format(prefix=self.prefix, i=i)
+            url = 'http://stages-benchmark.invalid/' + relative_path
+            data = artifact_data(url)
+            digest = hashlib.sha256(data).hexdigest()
+            artifact = Artifact(size=len(data), sha256=digest)
+            d_artifact = DeclarativeArtifact(
+                artifact=artifact, url=url, relative_path=relative_path, remote=self.remote,
+                deferred_download=self.deferred_download
+            )
+            content = FileContent(relative_path=relative_path, digest=digest)
+            await self.put(DeclarativeContent(content=content, d_artifacts=[d_artifact]))
+
+
+class QueryCounter:
+    """Counts the queries of each stage, whichever thread runs them."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        stage = getattr(self._local, 'stage', None) or 'event loop'
+        with self._lock:
+            self.counts[stage] += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def attribute(self, stage, func):
+        """Wrap `func` so its queries are counted for `stage`."""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self._local.stage = stage.__class__.__name__
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.stage = None
+        return wrapper
+
+    @contextmanager
+    def counting(self):
+        original = Stage.run_in_db_executor
+
+        async def run_in_db_executor(stage, func, *args, **kwargs):
+            return await original(stage, self.attribute(stage, func), *args, **kwargs)
+
+        connection_created.connect(self.install)
+        for connection in connections.all():
+            self.install(connection)
+        try:
+            with mock.patch.object(Stage, 'run_in_db_executor', run_in_db_executor):
+                yield self
+        finally:
+            connection_created.disconnect(self.install)
+            for connection in connections.all():
+                if self in connection.execute_wrappers:
+                    connection.execute_wrappers.remove(self)
+
+
+class TestDeclarativeVersionBenchmark(TransactionTestCase):
+    """
+    The pipeline uses a thread pool with its own database connections, so it cannot run inside the
+    transaction of a regular TestCase.
+    """
+
+    def setUp(self):
+        if not SIZES:
+            self.skipTest('STAGES_BENCHMARK_SIZES is not set')
+        if FileContent is None:
+            self.skipTest('the pulp_file plugin is not installed')
+        self.task = Task.objects.create(state='running', name='stages-benchmark')
+        job = mock.Mock(id=str(self.task.pk), origin='stages-benchmark')
+        for target in ('pulpcore.app.models.task.get_current_job',
+                       'pulpcore.tasking.services.storage.get_current_job',
+                       'pulpcore.plugin.stages.storage.get_current_job'):
+            patcher = mock.patch(target, return_value=job)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.remote = FileRemote.objects.create(name='stages-benchmark',
+                                                url='http://stages-benchmark.invalid/')
+        # Remote only has get_downloader() from pulpcore 3.0.0rc8 on
+        patcher = mock.patch.object(FileRemote, 'get_downloader',
+                                    lambda remote, url, **kwargs: StubDownloader(url, **kwargs),
+                                    create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_benchmark(self, deferred_download):
+        mode = 'deferred' if deferred_download else 'immediate'
+        for size in sorted(SIZES):
+            repository = Repository.objects.create(
+                name='stages-benchmark-{mode}-{size}'.format(mode=mode, size=size)
+            )
+            first_stage = SyntheticFirstStage(
+                self.remote, size, prefix=repository.name, deferred_download=deferred_download
+            )
+            version = DeclarativeVersion(
+                first_stage, repository, deferred_download=deferred_download
+            )
+            with QueryCounter().counting() as counter:
+                start = time.perf_counter()
+                version.create()
+                elapsed = time.perf_counter() - start
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            log.info('%(mode)s %(size)d units: %(elapsed).1fs, %(rate).0f units/s, '
+                     'peak RSS %(rss).0f MiB',
+                     {'mode': mode, 'size': size, 'elapsed': elapsed, 'rate': size / elapsed,
+                      'rss': peak_rss / 1024})
+            for stage, count in sorted(counter.counts.items()):
+                log.info('    %(stage)s: %(count)d queries', {'stage': stage, 'count': count})
+            self.assertEqual(repository.versions.latest('number').content.count(), size)
+
+    def test_immediate(self):
+        self.run_benchmark(deferred_download=False)
+
+    def test_deferred(self):
+        self.run_benchmark(deferred_download=True)
@@ -0,0 +1,91 @@
+"""
+Microbenchmarks for the matching done by the QueryExistingArtifacts stage.
+
+These are not part of the unit tests and only run when `STAGES_BENCHMARK_MATCHING` is set. The
+timings are logged::
+
+    STAGES_BENCHMARK_MATCHING=1 django-admin test ./pulpcore/tests/performance/
+"""
+import hashlib
+import logging
+import os
+import time
+from unittest import TestCase, mock
+
+from pulpcore.plugin.stages import DeclarativeArtifact, DeclarativeContent, QueryExistingArtifacts
+
+
+log = logging.getLogger(__name__)
+
+DIGEST_FIELDS = ('sha512', 'sha384', 'sha256', 'sha224', 'sha1', 'md5')
+
+
+class ArtifactMock:
+    """An in-memory stand-in for an Artifact carrying all digests of `seed`."""
+
+    DIGEST_FIELDS = DIGEST_FIELDS
+
+    def __init__(self, seed):
+        for digest_name in DIGEST_FIELDS:
+            setattr(self, digest_name, hashlib.new(digest_name, seed.encode()).hexdigest())
+        self.file = None
+        self._state = mock.Mock(adding=True)
+
+
+def make_batch(size):
+    batch = []
+    for i in range(size):
+        d_artifact = DeclarativeArtifact(
+            artifact=ArtifactMock(str(i)), url='http://example.com/{}'.format(i),
+            relative_path=str(i), remote=mock.Mock()
+        )
+        batch.append(DeclarativeContent(content=mock.Mock(), d_artifacts=[d_artifact]))
+    return batch
+
+
+def match_nested(batch, results):
+    """The matching as it was done before indexing the batch by digest."""
+    for artifact in results:
+        for d_content in batch:
+            for d_artifact in d_content.d_artifacts:
+                for digest_name in artifact.DIGEST_FIELDS:
+                    digest_value = getattr(d_artifact.artifact, digest_name)
+                    if digest_value and digest_value == getattr(artifact, digest_name):
+                        d_artifact.artifact = artifact
+                        break
+
+
+def match_indexed(batch, results):
+    d_artifacts_by_digest = QueryExistingArtifacts._index_by_digest(batch)
+    for digest_name, d_artifacts_by_value in d_artifacts_by_digest.items():
+        for artifact in results:
+            for d_artifact in d_artifacts_by_value[getattr(artifact, digest_name)]:
+                d_artifact.artifact = artifact
+
+
+class TestQueryExistingArtifactsMatching(TestCase):
+
+    def setUp(self):
+        if not os.environ.get('STAGES_BENCHMARK_MATCHING'):
+            self.skipTest('STAGES_BENCHMARK_MATCHING is not set')
+
+    def time_matching(self, match, size):
+        batch = make_batch(size)
+        # Every declared artifact already exists, which is the worst case for the old matching.
+        results = [ArtifactMock(str(i)) for i in range(size)]
+        start = time.perf_counter()
+        match(batch, results)
+        elapsed = time.perf_counter() - start
+        for d_content, artifact in zip(batch, results):
+            self.assertIs(d_content.d_artifacts[0].artifact, artifact)
+        return elapsed
+
+    def test_matching(self):
+        for size in (50, 500, 5000):
+            nested = self.time_matching(match_nested, size)
+            indexed = self.time_matching(match_indexed, size)
+            log.info('batch size %(size)d: nested %(nested).4fs, indexed %(indexed).4fs, '
+                     '%(x).1fx faster',
+                     {'size': size, 'nested': nested, 'indexed': indexed, 'x': nested / indexed})
+            if size >= 500:
+                self.assertLess(indexed, nested)
@@ -0,0 +1,53 @@
+from django.db import connection, models
+from django.test import TestCase
+
+from pulpcore.plugin.models import Content
+
+
+class NamedContent(Content):
+    """
+    A content type with its natural key in its own table, which is inserted in bulk.
+    """
+
+    TYPE = 'named'
+
+    name = models.TextField()
+    version = models.TextField(null=True)
+
+    class Meta:
+        app_label = 'stages_tests'
+        default_related_name = 'stages_tests_named'
+        unique_together = ('name', 'version')
+
+
+class FlavoredContent(NamedContent):
+    """
+    A content type with part of its natural key inherited, which is saved one by one.
+    """
+
+    TYPE = 'flavored'
+
+    flavor = models.TextField()
+
+    class Meta:
+        app_label = 'stages_tests'
+        default_related_name = 'stages_tests_flavored'
+
+    @classmethod
+    def natural_key_fields(cls):
+        return ('name', 'version', 'flavor')
+
+
+class ContentModelsTestCase(TestCase):
+    """
+    A test case creating the tables of the test content types, rolled back after its tests.
+
+    The content types belong to an app that is not installed, so the rest of pulpcore does not know
+    about them, e.g. when deleting Content units.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        with connection.schema_editor() as editor:
+            editor.create_model(NamedContent)
+            editor.create_model(FlavoredContent)
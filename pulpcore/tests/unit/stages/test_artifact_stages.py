@@ -0,0 +1,50 @@
+from pulpcore.plugin.models import Artifact, ContentArtifact, Remote, RemoteArtifact
+from pulpcore.plugin.stages import DeclarativeArtifact, DeclarativeContent, RemoteArtifactSaver
+
+from .models import ContentModelsTestCase, NamedContent
+
+
+class TestRemoteArtifactSaver(ContentModelsTestCase):
+
+    def setUp(self):
+        self.remotes = [Remote.objects.create(name=name, url='http://{}/'.format(name))
+                        for name in ('one', 'two')]
+        self.unit = NamedContent(name='a', version='1')
+        self.unit.save()
+        self.content_artifact = ContentArtifact.objects.create(content=self.unit,
+                                                               relative_path='a.txt')
+        self.stage = RemoteArtifactSaver()
+
+    def d_content(self, remote, content=None):
+        d_artifact = DeclarativeArtifact(artifact=Artifact(size=3), url=remote.url + 'a.txt',
+                                         relative_path='a.txt', remote=remote)
+        return DeclarativeContent(content=content or self.unit, d_artifacts=[d_artifact])
+
+    def test_content_with_remote_artifacts(self):
+        RemoteArtifact.objects.create(content_artifact=self.content_artifact,
+                                      remote=self.remotes[0], url='http://one/a.txt')
+        self.assertEqual(self.stage._needed_remote_artifacts([self.d_content(self.remotes[0])]),
+                         [])
+        needed = self.stage._needed_remote_artifacts([self.d_content(self.remotes[1])])
+        self.assertEqual([(ra.remote, ra.content_artifact_id, ra.url) for ra in needed],
+                         [(self.remotes[1], self.content_artifact.pk, 'http://two/a.txt')])
+
+    def test_content_without_remote_artifacts(self):
+        batch = [self.d_content(self.remotes[0]), self.d_content(self.remotes[0])]
+        needed = self.stage._needed_remote_artifacts(batch)
+        self.assertEqual([(ra.remote, ra.content_artifact_id, ra.size) for ra in needed],
+                         [(self.remotes[0], self.content_artifact.pk, 3)])
+
+    def test_created_content_is_not_looked_up(self):
+        d_content = self.d_content(self.remotes[0])
+        d_content.newly_created = True
+        d_content._content_artifacts = {'a.txt': self.content_artifact}
+        with self.assertNumQueries(0):
+            needed = self.stage._needed_remote_artifacts([d_content])
+        self.assertEqual([(ra.remote, ra.content_artifact_id) for ra in needed],
+                         [(self.remotes[0], self.content_artifact.pk)])
+
+    def test_undeclared_relative_path(self):
+        ContentArtifact.objects.create(content=self.unit, relative_path='b.txt')
+        with self.assertRaises(ValueError):
+            self.stage._needed_remote_artifacts([self.d_content(self.remotes[0])])
@@ -1,11 +1,19 @@
 import asyncio
+import os
+import tempfile
 
 import asynctest
-from unittest import mock
+from unittest import mock, TestCase
 from uuid import uuid4
 
-from pulpcore.plugin.stages import DeclarativeContent, DeclarativeArtifact
-from pulpcore.plugin.stages.artifact_stages import ArtifactDownloader
+from django.core.files.storage import FileSystemStorage
+
+from pulpcore.plugin.stages import DeclarativeContent, DeclarativeArtifact, DownloadDirectory
+from pulpcore.plugin.stages.artifact_stages import (
+    ArtifactDownloader,
+    ArtifactSaver,
+    DownloadBudget,
+)
 
 
 class MockException(Exception):
@@ -99,7 +107,7 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
         dc = DeclarativeContent(content=mock.Mock(), d_artifacts=das)
         self.in_q.put_nowait(dc)
 
-    async def download_task(self, max_concurrent_content=3):
+    async def download_task(self, max_concurrent_content=3, download_budget=None):
         """
         A coroutine running the downloader stage with a mocked ProgressReport.
 
@@ -108,7 +116,8 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
         """
         with mock.patch('pulpcore.plugin.stages.artifact_stages.ProgressReport') as pb:
             pb.return_value.__enter__.return_value.done = 0
-            ad = ArtifactDownloader(max_concurrent_content=max_concurrent_content)
+            ad = ArtifactDownloader(max_concurrent_content=max_concurrent_content,
+                                    download_budget=download_budget)
             ad._connect(self.in_q, self.out_q)
             await ad()
         return pb.return_value.__enter__.return_value.done
@@ -362,3 +371,158 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
         self.assertEqual(DownloaderMock.downloads, 3)
         self.assertEqual(DownloaderMock.running, 0)
         self.assertEqual(download_task.result(), DownloaderMock.downloads)
+
+    async def test_download_budget(self):
+        budget = DownloadBudget(max_downloads=2)
+        download_task = self.loop.create_task(self.download_task(download_budget=budget))
+        self.queue_dc(delays=[1, 1, 1])
+        self.queue_dc(delays=[1])
+        self.in_q.put_nowait(None)
+
+        # At 0.5 seconds, only two of the four downloads are running
+        await self.advance_to(0.5)
+        self.assertEqual(DownloaderMock.running, 2)
+        self.assertEqual(budget.in_flight, 2)
+
+        # At 1.5 seconds, the two remaining downloads are running
+        await self.advance_to(1.5)
+        self.assertEqual(DownloaderMock.running, 2)
+        self.assertEqual(DownloaderMock.downloads, 2)
+
+        # At 2.5 seconds, the stage is done
+        await self.advance_to(2.5)
+        self.assertEqual(DownloaderMock.running, 0)
+        self.assertEqual(budget.in_flight, 0)
+        self.assertEqual(budget.peak, 2)
+        self.assertEqual(download_task.result(), 4)
+        self.assertHandled(3)
+
+    async def test_download_budget_per_host(self):
+        budget = DownloadBudget(max_downloads=3, max_downloads_per_host=1)
+        urls = ['http://a/1', 'http://a/2', 'http://b/1', 'http://c/1']
+        tasks = [
+            self.loop.create_task(budget.run(url, lambda: asyncio.sleep(1))) for url in urls
+        ]
+
+        # At 0.5 seconds, only one download per host is running
+        await self.advance_to(0.5)
+        self.assertEqual(budget.in_flight, 3)
+
+        # At 1.5 seconds, the second download from host a is running
+        await self.advance_to(1.5)
+        self.assertEqual(budget.in_flight, 1)
+
+        await self.advance_to(2.5)
+        self.assertEqual(budget.in_flight, 0)
+        self.assertEqual(budget.peak, 3)
+        self.assertTrue(all(task.done() for task in tasks))
+
+
+class FileDownloaderMock:
+    """Mock for a Downloader writing to the file object it is given.
+
+    The download fails if the url is 'fail'.
+    """
+
+    def __init__(self, url, custom_file_object=None, **kwargs):
+        self.url = url
+        self.writer = custom_file_object
+
+    async def run(self, extra_data=None):
+        self.writer.write(b'data')
+        self.writer.close()
+        if self.url == 'fail':
+            raise MockException("Download Failed")
+        result = mock.Mock()
+        result.artifact_attributes = {}
+        return result
+
+
+class TestDownloadTempFiles(asynctest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+
+    def d_artifact(self, url):
+        artifact = mock.Mock()
+        artifact.DIGEST_FIELDS = []
+        artifact.size = None
+        remote = mock.Mock()
+        remote.get_downloader = FileDownloaderMock
+        return DeclarativeArtifact(artifact=artifact, url=url, relative_path='path',
+                                   remote=remote)
+
+    async def test_download_to_temp_dir(self):
+        d_artifact = self.d_artifact('ok')
+        await d_artifact.download(temp_dir=self.temp_dir)
+        path = str(d_artifact.artifact.file)
+        self.assertEqual(os.listdir(self.temp_dir), [os.path.basename(path)])
+
+    async def test_failed_download_removes_temp_file(self):
+        with self.assertRaises(MockException):
+            await self.d_artifact('fail').download(temp_dir=self.temp_dir)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+    async def test_download_without_temp_dir(self):
+        d_artifact = self.d_artifact('ok')
+        result = mock.Mock(artifact_attributes={}, path='downloaded')
+        with mock.patch.object(FileDownloaderMock, '__init__', return_value=None) as init, \
+                mock.patch.object(FileDownloaderMock, 'run', asynctest.CoroutineMock(
+                    return_value=result)):
+            await d_artifact.download()
+        self.assertNotIn('custom_file_object', init.call_args[1])
+        self.assertEqual(d_artifact.artifact.file, 'downloaded')
+
+    async def test_artifact_saver_removes_download_of_existing_artifact(self):
+        d_artifact = self.d_artifact('ok')
+        await d_artifact.download(temp_dir=self.temp_dir)
+        existing = mock.Mock()
+        with mock.patch('pulpcore.plugin.stages.artifact_stages.Artifact') as artifact_model:
+            artifact_model.objects.bulk_get_or_create.return_value = [existing]
+            ArtifactSaver._save_artifacts([d_artifact], self.temp_dir)
+        self.assertIs(d_artifact.artifact, existing)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+
+class TestDownloadDirectory(TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.location = temp_dir.name
+        self.job = mock.Mock(origin='worker', id='task-2')
+        for patcher in (
+            mock.patch('pulpcore.plugin.stages.storage.default_storage',
+                       FileSystemStorage(location=self.location)),
+            mock.patch('pulpcore.plugin.stages.storage.get_current_job', lambda: self.job),
+            mock.patch('pulpcore.tasking.services.storage.get_current_job', lambda: self.job),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_create_deletes_directories_of_killed_tasks(self):
+        leftover = os.path.join(self.location, '.downloads', 'worker', 'task-1')
+        os.makedirs(leftover)
+        open(os.path.join(leftover, 'download'), 'w').close()
+        download_dir = DownloadDirectory()
+        download_dir.create()
+        self.assertEqual(download_dir.path, os.path.join(self.location, '.downloads', 'worker',
+                                                         'task-2'))
+        self.assertEqual(os.listdir(os.path.dirname(download_dir.path)), ['task-2'])
+        download_dir.delete()
+        self.assertFalse(os.path.exists(download_dir.path))
+
+    def test_needed_across_filesystems(self):
+        with mock.patch('pulpcore.plugin.stages.storage.os.stat',
+                        side_effect=lambda path: mock.Mock(st_dev=hash(path))):
+            self.assertTrue(DownloadDirectory.needed())
+
+    def test_not_needed_on_the_same_filesystem(self):
+        with mock.patch('pulpcore.plugin.stages.storage.os.getcwd', return_value=self.location):
+            self.assertFalse(DownloadDirectory.needed())
+
+    def test_not_needed_outside_of_a_task(self):
+        self.job = None
+        self.assertFalse(DownloadDirectory.needed())
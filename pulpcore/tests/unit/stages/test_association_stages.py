@@ -0,0 +1,267 @@
+import asyncio
+import threading
+
+import asynctest
+from unittest import mock
+
+from pulpcore.plugin.models import Content
+from pulpcore.plugin.stages import (
+    ContentAssociation,
+    ContentChunk,
+    ContentUnassociation,
+    DatabaseExecutor,
+    DeclarativeContent,
+    RemoveDuplicates,
+)
+from pulpcore.plugin.stages.association_stages import _ContentPkTable
+
+from .models import ContentModelsTestCase, FlavoredContent, NamedContent
+
+
+class AssociationStageTestCase(asynctest.TestCase):
+
+    def setUp(self):
+        self.in_q = asyncio.Queue()
+        self.out_q = asyncio.Queue()
+        self.new_version = mock.Mock()
+        patcher = mock.patch('pulpcore.plugin.stages.association_stages.ProgressReport')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def run_stage(self, stage):
+        stage._connect(self.in_q, self.out_q)
+        await stage()
+        items = []
+        while True:
+            item = self.out_q.get_nowait()
+            if item is None:
+                return items
+            items.append(item)
+
+
+class TestContentAssociation(AssociationStageTestCase):
+
+    def queue_content(self, pks):
+        for pk in pks:
+            content = mock.Mock()
+            content.pk = pk
+            self.in_q.put_nowait(DeclarativeContent(content=content))
+        self.in_q.put_nowait(None)
+
+    async def test_stale_content_chunks(self):
+        self.new_version.content.values_list.return_value = [1, 2, 3, 4, 5]
+        self.queue_content([2])
+        stage = ContentAssociation(self.new_version)
+        stage.batch_maxsize = 2
+        chunks = await self.run_stage(stage)
+        self.assertTrue(all(isinstance(chunk, ContentChunk) for chunk in chunks))
+        self.assertEqual(sorted(pk for chunk in chunks for pk in chunk.pks), [1, 3, 4, 5])
+        self.assertEqual([len(chunk.pks) for chunk in chunks], [2, 2])
+
+    async def test_unbounded_chunks(self):
+        self.new_version.content.values_list.return_value = [1, 2, 3]
+        self.queue_content([1])
+        stage = ContentAssociation(self.new_version)
+        stage.batch_maxsize = None
+        chunks = await self.run_stage(stage)
+        self.assertEqual(len(chunks), 1)
+
+    async def test_unbounded_chunks_without_stale_content(self):
+        self.new_version.content.values_list.return_value = []
+        self.queue_content([1, 2])
+        stage = ContentAssociation(self.new_version)
+        stage.batch_maxsize = None
+        self.assertEqual(await self.run_stage(stage), [])
+
+    async def test_temp_table_is_used_from_one_thread(self):
+        self.queue_content(range(10))
+        threads = []
+
+        def record_thread(*args):
+            threads.append(threading.get_ident())
+
+        def chunks(stale):
+            # The chunks are fetched when iterating
+            record_thread()
+            yield from ()
+
+        pipeline_executor = DatabaseExecutor(max_workers=4)
+        self.addCleanup(pipeline_executor.shutdown)
+        stage = ContentAssociation(self.new_version, use_temp_table=True)
+        stage.batch_maxsize = 2
+        stage._db_executor = pipeline_executor
+        with mock.patch('pulpcore.plugin.stages.association_stages._ContentPkTable') as table:
+            for method in ('create', 'insert_received', 'insert_stale', 'drop'):
+                getattr(table.return_value, method).side_effect = record_thread
+            table.return_value.chunks = chunks
+            await self.run_stage(stage)
+        self.assertEqual(len(threads), 10)
+        self.assertEqual(len(set(threads)), 1)
+        self.assertIs(stage._db_executor, pipeline_executor)
+
+
+class TestContentPkTable(ContentModelsTestCase):
+
+    def setUp(self):
+        self.pks = sorted(Content.objects.create().pk for i in range(6))
+
+    def table(self, version_pks, chunk_size):
+        new_version = mock.Mock(content=Content.objects.filter(pk__in=version_pks))
+        table = _ContentPkTable(new_version, chunk_size)
+        table.create()
+        self.addCleanup(table.drop)
+        return table
+
+    def test_received_content_chunks(self):
+        for chunk_size, chunks in ((2, [self.pks[0:2], self.pks[2:4]]),
+                                   (3, [self.pks[0:3], self.pks[3:4]])):
+            table = self.table(self.pks[5:], chunk_size)
+            table.insert_received(self.pks[0:4])
+            table.insert_received(self.pks[1:2])
+            table.insert_stale()
+            self.assertEqual(list(table.chunks(stale=False)), chunks)
+
+    def test_received_content_already_in_the_version(self):
+        table = self.table(self.pks[0:1], 10)
+        table.insert_received(self.pks[0:2])
+        table.insert_stale()
+        self.assertEqual(list(table.chunks(stale=False)), [self.pks[1:2]])
+        self.assertEqual(list(table.chunks(stale=True)), [])
+
+    def test_stale_content(self):
+        table = self.table(self.pks[0:3], 1)
+        table.insert_received([self.pks[1], self.pks[3]])
+        table.insert_stale()
+        self.assertEqual(list(table.chunks(stale=True)), [self.pks[0:1], self.pks[2:3]])
+        self.assertEqual(list(table.chunks(stale=False)), [self.pks[3:4]])
+
+    def test_temporary_table(self):
+        table = self.table(self.pks, 10)
+        query = 'SELECT relpersistence FROM pg_class WHERE oid = to_regclass(%s)'
+        self.assertEqual(table._execute(query, [table.name]), ['t'])
+        table.drop()
+        self.assertEqual(table._execute(query, [table.name]), [])
+
+
+class TestContentUnassociation(AssociationStageTestCase):
+
+    def unassociated_pks(self):
+        pks = []
+        for call in self.new_version.remove_content.call_args_list:
+            pks.extend(call[0][0].pks)
+        return pks
+
+    async def test_content_chunks(self):
+        chunk = ContentChunk([1, 2, 3])
+        self.in_q.put_nowait(chunk)
+        self.in_q.put_nowait(None)
+        stage = ContentUnassociation(self.new_version)
+        stage.chunk_size = 2
+        with mock.patch('pulpcore.plugin.stages.association_stages.Content') as content:
+            content.objects.filter.side_effect = lambda pk__in: mock.Mock(pks=pk__in)
+            self.assertEqual(await self.run_stage(stage), [chunk])
+        self.assertEqual(self.new_version.remove_content.call_count, 2)
+        self.assertEqual(self.unassociated_pks(), [1, 2, 3])
+
+    async def test_querysets(self):
+        queryset = mock.Mock()
+        queryset.values_list.return_value = [4, 5]
+        self.in_q.put_nowait(queryset)
+        self.in_q.put_nowait(None)
+        stage = ContentUnassociation(self.new_version)
+        with mock.patch('pulpcore.plugin.stages.association_stages.Content') as content:
+            content.objects.filter.side_effect = lambda pk__in: mock.Mock(pks=pk__in)
+            self.assertEqual(await self.run_stage(stage), [queryset])
+        queryset.values_list.assert_called_once_with('pk', flat=True)
+        self.assertEqual(self.unassociated_pks(), [4, 5])
+
+
+class Unit:
+    """A stand-in for a content unit of the model given to RemoveDuplicates."""
+
+    objects = mock.Mock()
+
+    def __init__(self, pk, relative_path, digest):
+        self.pk = pk
+        self.relative_path = relative_path
+        self.digest = digest
+
+
+class TestRemoveDuplicates(AssociationStageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Unit.objects.reset_mock()
+        self.stage = RemoveDuplicates(self.new_version, Unit, ['relative_path', 'digest'])
+
+    async def run_with_duplicates(self, duplicate_pks):
+        units = [Unit(1, 'a', '1'), mock.Mock()]
+        for unit in units:
+            self.in_q.put_nowait(DeclarativeContent(content=unit))
+        self.in_q.put_nowait(None)
+        with mock.patch.object(self.stage, '_find_duplicates', return_value=duplicate_pks) as find:
+            self.assertEqual(len(await self.run_stage(self.stage)), 2)
+        find.assert_called_once_with(units[:1])
+
+    async def test_duplicates_are_removed(self):
+        await self.run_with_duplicates([3])
+        Unit.objects.filter.assert_called_once_with(pk__in=[3])
+        self.new_version.remove_content.assert_called_once_with(Unit.objects.filter.return_value)
+
+    async def test_no_duplicates(self):
+        await self.run_with_duplicates([])
+        self.new_version.remove_content.assert_not_called()
+
+
+class TestFindDuplicates(ContentModelsTestCase):
+
+    def units(self, model, *values):
+        units = [model(**unit_values) for unit_values in values]
+        for unit in units:
+            unit.save()
+        return units
+
+    def find_duplicates(self, model, field_names, version_units, units):
+        new_version = mock.Mock(content=Content.objects.filter(
+            pk__in=[unit.pk for unit in version_units]
+        ))
+        stage = RemoveDuplicates(new_version, model, field_names)
+        return set(stage._find_duplicates(units))
+
+    def test_duplicates_in_the_version(self):
+        a1, a2, b1, a3, a4 = self.units(
+            NamedContent, dict(name='a', version='1'), dict(name='a', version='2'),
+            dict(name='b', version='1'), dict(name='a', version='3'), dict(name='a', version='4')
+        )
+        self.assertEqual(
+            self.find_duplicates(NamedContent, ['name'], [a1, a2, b1], [a3]), {a1.pk, a2.pk}
+        )
+
+    def test_a_unit_is_not_its_own_duplicate(self):
+        a1, a2, b1 = self.units(
+            NamedContent, dict(name='a', version='1'), dict(name='a', version='2'),
+            dict(name='b', version='1')
+        )
+        self.assertEqual(
+            self.find_duplicates(NamedContent, ['name'], [a1, a2, b1], [a1, a2]), {a1.pk, a2.pk}
+        )
+        self.assertEqual(self.find_duplicates(NamedContent, ['name'], [a1, b1], [a1, b1]), set())
+
+    def test_null_values_are_equal(self):
+        a, b, c, d = self.units(
+            NamedContent, dict(name='a'), dict(name='b'), dict(name='c', version='1'),
+            dict(name='d')
+        )
+        self.assertEqual(
+            self.find_duplicates(NamedContent, ['version'], [a, b, c], [d]), {a.pk, b.pk}
+        )
+
+    def test_inherited_fields(self):
+        sweet, sour, other, new = self.units(
+            FlavoredContent, dict(name='a', flavor='sweet'), dict(name='a', flavor='sour'),
+            dict(name='b', flavor='sweet'), dict(name='a', flavor='sweet')
+        )
+        self.assertEqual(
+            self.find_duplicates(FlavoredContent, ['name', 'flavor'], [sweet, sour, other], [new]),
+            {sweet.pk}
+        )
@@ -0,0 +1,34 @@
+from unittest import TestCase
+
+from pulpcore.plugin.stages import BloomFilter
+
+
+class TestBloomFilter(TestCase):
+
+    def test_no_false_negatives(self):
+        bloom_filter = BloomFilter(capacity=1000)
+        keys = [('name-{}'.format(i), i) for i in range(1000)]
+        for key in keys:
+            bloom_filter.add(key)
+        self.assertEqual(bloom_filter.count, 1000)
+        for key in keys:
+            self.assertIn(key, bloom_filter)
+
+    def test_false_positive_rate(self):
+        bloom_filter = BloomFilter(capacity=1000, false_positive_rate=0.01)
+        for i in range(1000):
+            bloom_filter.add(('added', i))
+        false_positives = sum(1 for i in range(10000) if ('missing', i) in bloom_filter)
+        self.assertLess(false_positives, 300)
+        self.assertAlmostEqual(bloom_filter.false_positive_rate, 0.01, delta=0.005)
+
+    def test_values_compared_by_str(self):
+        bloom_filter = BloomFilter(capacity=10)
+        bloom_filter.add(('a', 1))
+        self.assertIn(('a', '1'), bloom_filter)
+
+    def test_invalid_parameters(self):
+        with self.assertRaises(ValueError):
+            BloomFilter(capacity=0)
+        with self.assertRaises(ValueError):
+            BloomFilter(capacity=10, false_positive_rate=1)
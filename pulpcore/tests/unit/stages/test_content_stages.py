@@ -0,0 +1,192 @@
+import asyncio
+from unittest import mock
+
+from pulpcore.plugin.models import Content
+from pulpcore.plugin.stages import (
+    BloomFilter,
+    ContentSaver,
+    DeclarativeContent,
+    DeferredContentSaver,
+    QueryExistingContents,
+)
+
+from .models import ContentModelsTestCase, FlavoredContent, NamedContent
+
+
+class TestContentSaverHooks(ContentModelsTestCase):
+
+    def test_failing_post_save_rolls_back_the_batch(self):
+        for saver_class in (ContentSaver, DeferredContentSaver):
+            class FailingSaver(saver_class):
+                def _pre_save_sync(self, batch):
+                    NamedContent(name='related').save()
+
+                def _post_save_sync(self, batch):
+                    raise ValueError()
+
+            batch = [DeclarativeContent(content=NamedContent(name='unit', version='1'))]
+            with self.assertRaises(ValueError):
+                FailingSaver()._save_batch(batch)
+            self.assertFalse(Content.objects.exists())
+
+    def test_hooks_see_the_saved_units(self):
+        seen = []
+
+        class HookedContentSaver(ContentSaver):
+            def _pre_save_sync(self, batch):
+                seen.append(NamedContent.objects.count())
+
+            def _post_save_sync(self, batch):
+                seen.append(NamedContent.objects.count())
+
+        batch = [DeclarativeContent(content=NamedContent(name='unit', version='1'))]
+        HookedContentSaver()._save_batch(batch)
+        self.assertEqual(seen, [0, 1])
+        self.assertTrue(batch[0].newly_created)
+
+
+class TestBulkInsert(ContentModelsTestCase):
+
+    def setUp(self):
+        self.saver = ContentSaver(bulk_insert=True)
+
+    def test_insert(self):
+        batch = [DeclarativeContent(content=NamedContent(name=name, version='1'))
+                 for name in ('a', 'b')]
+        created = self.saver._bulk_insert_content(batch)
+        self.assertEqual(created, batch)
+        for d_content in batch:
+            self.assertFalse(d_content.content._state.adding)
+            self.assertEqual(d_content.content.pulp_type, 'stages_tests.named')
+        self.assertEqual(
+            sorted(NamedContent.objects.values_list('name', 'pulp_type')),
+            [('a', 'stages_tests.named'), ('b', 'stages_tests.named')]
+        )
+
+    def test_conflicting_units_are_fetched_by_natural_key(self):
+        existing = NamedContent(name='a', version='1')
+        existing.save()
+        d_existing = DeclarativeContent(content=NamedContent(name='a', version='1'))
+        d_new = DeclarativeContent(content=NamedContent(name='a', version='2'))
+        created = self.saver._bulk_insert_content([d_existing, d_new])
+        self.assertEqual(created, [d_new])
+        self.assertEqual(d_existing.content.pk, existing.pk)
+        self.assertFalse(d_existing.content._state.adding)
+
+    def test_parent_rows_of_conflicting_units_are_deleted(self):
+        NamedContent(name='a', version='1').save()
+        batch = [DeclarativeContent(content=NamedContent(name='a', version='1'))]
+        self.assertEqual(self.saver._bulk_insert_content(batch), [])
+        self.assertEqual(Content.objects.count(), 1)
+        self.assertEqual(NamedContent.objects.count(), 1)
+
+    def test_duplicates_within_a_batch_are_inserted_once(self):
+        batch = [DeclarativeContent(content=NamedContent(name='a', version='1'))
+                 for i in range(3)]
+        created = self.saver._bulk_insert_content(batch)
+        self.assertEqual(created, batch[:1])
+        for d_content in batch[1:]:
+            self.assertIs(d_content.content, batch[0].content)
+        self.assertEqual(Content.objects.count(), 1)
+
+    def test_unsupported_models_are_saved_one_by_one(self):
+        self.assertTrue(ContentSaver._supports_bulk_insert(NamedContent))
+        self.assertFalse(ContentSaver._supports_bulk_insert(FlavoredContent))
+        batch = [DeclarativeContent(content=FlavoredContent(name='a', flavor=flavor))
+                 for flavor in ('sweet', 'sour')]
+        with mock.patch.object(ContentSaver, '_insert_rows') as insert_rows:
+            created = self.saver._bulk_insert_content(batch)
+        insert_rows.assert_not_called()
+        self.assertEqual(created, batch)
+        self.assertEqual(FlavoredContent.objects.count(), 2)
+        self.assertEqual(
+            set(FlavoredContent.objects.values_list('pulp_type', flat=True)),
+            {'stages_tests.flavored'}
+        )
+
+
+class TestQueryExistingContents(ContentModelsTestCase):
+
+    def test_existing_units_are_found_by_natural_key(self):
+        existing = [NamedContent(name='a', version='1'), NamedContent(name='b', version=None)]
+        for unit in existing:
+            unit.save()
+        batch = [
+            DeclarativeContent(content=NamedContent(name='a', version='1')),
+            DeclarativeContent(content=NamedContent(name='a', version='2')),
+            DeclarativeContent(content=NamedContent(name='b', version=None)),
+        ]
+        d_contents_by_type = QueryExistingContents._index_unsaved_by_type(batch)
+        QueryExistingContents._query_existing_contents(d_contents_by_type)
+        self.assertEqual(batch[0].content.pk, existing[0].pk)
+        self.assertTrue(batch[1].content._state.adding)
+        self.assertEqual(batch[2].content.pk, existing[1].pk)
+
+    def test_duplicate_units_within_a_batch(self):
+        existing = NamedContent(name='a', version='1')
+        existing.save()
+        batch = [DeclarativeContent(content=NamedContent(name='a', version='1'))
+                 for i in range(2)]
+        batch.append(DeclarativeContent(content=existing))
+        d_contents_by_type = QueryExistingContents._index_unsaved_by_type(batch)
+        self.assertEqual(d_contents_by_type, {NamedContent: {('a', '1'): batch[:2]}})
+        QueryExistingContents._query_existing_contents(d_contents_by_type)
+        for d_content in batch:
+            self.assertEqual(d_content.content.pk, existing.pk)
+
+
+class TestQueryExistingContentsBloomFilter(ContentModelsTestCase):
+
+    def setUp(self):
+        self.existing = NamedContent(name='a', version='1')
+        self.existing.save()
+        self.stage = QueryExistingContents(bloom_filter=True)
+        self.batch = [DeclarativeContent(content=NamedContent(name=name, version='1'))
+                      for name in ('a', 'b')]
+        patcher = mock.patch.object(
+            QueryExistingContents, '_query_existing_contents',
+            side_effect=QueryExistingContents._query_existing_contents
+        )
+        self.query_existing_contents = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_stage(self):
+        """Run the stage on the batch, without a DatabaseExecutor to see the test transaction."""
+        async def run():
+            in_q, out_q = asyncio.Queue(), asyncio.Queue()
+            for d_content in self.batch:
+                in_q.put_nowait(d_content)
+            in_q.put_nowait(None)
+            self.stage._connect(in_q, out_q)
+            await self.stage()
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        loop.run_until_complete(run())
+
+    def queried_keys(self):
+        return [
+            set(d_contents_by_type[NamedContent])
+            for (d_contents_by_type,), kwargs in self.query_existing_contents.call_args_list
+        ]
+
+    def test_units_missing_from_the_filter_are_not_queried(self):
+        self.run_stage()
+        self.assertEqual(self.queried_keys(), [{('a', '1')}])
+        self.assertEqual(self.batch[0].content.pk, self.existing.pk)
+        self.assertTrue(self.batch[1].content._state.adding)
+        self.assertIn(('b', '1'), self.stage._bloom_filters[NamedContent])
+        self.assertEqual(self.stage._bloom_filter_stats[NamedContent],
+                         {'skipped': 1, 'queried': 1, 'found': 1})
+
+    def test_false_positives_are_queried(self):
+        bloom_filter = BloomFilter(capacity=10)
+        bloom_filter.add(('a', '1'))
+        bloom_filter.add(('b', '1'))
+        self.stage._bloom_filters[NamedContent] = bloom_filter
+        self.run_stage()
+        self.assertEqual(self.queried_keys(), [{('a', '1'), ('b', '1')}])
+        self.assertEqual(self.batch[0].content.pk, self.existing.pk)
+        self.assertTrue(self.batch[1].content._state.adding)
+        self.assertEqual(self.stage._bloom_filter_stats[NamedContent],
+                         {'skipped': 0, 'queried': 2, 'found': 1})
@@ -0,0 +1,54 @@
+from unittest import mock, TestCase
+
+from pulpcore.plugin.stages import LogHistogram, StageMetrics
+
+
+class TestLogHistogram(TestCase):
+
+    def test_buckets(self):
+        histogram = LogHistogram(1, 4)
+        self.assertEqual(histogram.bounds, (1, 2, 4, 8))
+        for value in (0.5, 1, 3, 3, 100):
+            histogram.record(value)
+        self.assertEqual(histogram.counts, [2, 0, 2, 0, 1])
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.sum, 107.5)
+        self.assertEqual(histogram.max, 100)
+
+    def test_percentile(self):
+        histogram = LogHistogram(1, 4)
+        self.assertEqual(histogram.percentile(95), 0)
+        for value in range(1, 11):
+            histogram.record(value)
+        self.assertEqual(histogram.percentile(10), 1)
+        self.assertEqual(histogram.percentile(50), 8)
+        self.assertEqual(histogram.percentile(95), 10)
+
+    def test_snapshot(self):
+        histogram = LogHistogram(1, 2)
+        histogram.record(1)
+        histogram.record(5)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 2)
+        self.assertEqual(snapshot['mean'], 3)
+        self.assertEqual(snapshot['buckets'], [(1, 1), (None, 1)])
+
+
+class TestStageMetrics(TestCase):
+
+    def test_snapshot_before_start(self):
+        snapshot = StageMetrics().snapshot()
+        self.assertEqual(snapshot['items_in'], 0)
+        self.assertEqual(snapshot['elapsed'], 0)
+        self.assertEqual(snapshot['throughput'], 0)
+
+    def test_put_blocked_by_task(self):
+        metrics = StageMetrics()
+        task, other_task = mock.Mock(), mock.Mock()
+        metrics.record_put_blocked(task, 0.5)
+        metrics.record_put_blocked(task, 0.25)
+        metrics.record_put_blocked(None, 1)
+        self.assertEqual(metrics.put_blocked_by(task), 0.75)
+        self.assertEqual(metrics.put_blocked_by(other_task), 0)
+        self.assertEqual(metrics.put_blocked_by(None), 0)
+        self.assertEqual(metrics.put_blocked_times.count, 3)
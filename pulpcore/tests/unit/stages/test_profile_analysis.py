@@ -0,0 +1,124 @@
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+from pulpcore.plugin.profile_analysis import analyze, find_bottleneck, format_report
+
+
+class TestProfileAnalysis(TestCase):
+
+    def setUp(self):
+        fd, self.db_path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.db_path)
+
+    def write_profile(self, *pipelines, record_maxsize=True):
+        """
+        Write the profile of pipelines, each a list of stages.
+
+        Each stage is a (name, maxsize, queue length, waiting time, service time) tuple. 1000 items
+        arrive at each stage, 10 per second.
+        """
+        connection = sqlite3.connect(self.db_path)
+        if record_maxsize:
+            connection.execute('CREATE TABLE stages (uuid varchar(36), name text, num int, '
+                               'maxsize int)')
+        else:
+            connection.execute('CREATE TABLE stages (uuid varchar(36), name text, num int)')
+        connection.execute('CREATE TABLE traffic (uuid varchar(36), waiting_time real, '
+                           'service_time real)')
+        connection.execute('CREATE TABLE system (uuid varchar(36), length int, '
+                           'interarrival_time real)')
+        for i, stages in enumerate(pipelines):
+            for num, (name, maxsize, length, waiting_time, service_time) in enumerate(stages, 1):
+                uuid, next_uuid = '{}-{}'.format(i, num), '{}-{}'.format(i, num + 1)
+                if record_maxsize:
+                    connection.execute('INSERT INTO stages VALUES (?, ?, ?, ?)',
+                                       (uuid, name, num, maxsize))
+                else:
+                    connection.execute('INSERT INTO stages VALUES (?, ?, ?)', (uuid, name, num))
+                connection.executemany('INSERT INTO system VALUES (?, ?, ?)',
+                                       [(uuid, length, 0.1)] * 1000)
+                if service_time is not None:
+                    # The times of a stage are recorded when putting into the next queue
+                    connection.executemany('INSERT INTO traffic VALUES (?, ?, ?)',
+                                           [(next_uuid, waiting_time, service_time)] * 1000)
+        connection.commit()
+        connection.close()
+
+    def test_analyze(self):
+        self.write_profile([
+            ('Fast', 100, 0, 0.0, 0.01), ('Slow', 100, 4, 0.4, 0.09), ('End', 100, 0, 0, None)
+        ])
+        [(fast, slow, end)] = analyze(self.db_path)
+        self.assertEqual([fast.name, slow.name, end.name], ['Fast', 'Slow', 'End'])
+        self.assertAlmostEqual(slow.arrival_rate, 10)
+        self.assertAlmostEqual(slow.mean_queue_length, 4)
+        self.assertAlmostEqual(slow.mean_waiting_time, 0.4)
+        # The last item left 0.49s after the last arrival
+        self.assertAlmostEqual(slow.duration, 100.49)
+        self.assertAlmostEqual(slow.little_queue_length, 400 / 100.49)
+        self.assertAlmostEqual(slow.mean_in_service, 90 / 100.49)
+        self.assertAlmostEqual(slow.queue_fill, 4 / 100.49)
+        self.assertAlmostEqual(fast.mean_in_service, 10 / 100.01)
+        self.assertEqual(end.items, 0)
+
+    def test_bottleneck(self):
+        self.write_profile([
+            ('Fast', 100, 90, 9, 0.01), ('Slow', 100, 99, 9.9, 0.1), ('End', 100, 0, 0, None)
+        ])
+        [reports] = analyze(self.db_path)
+        self.assertEqual(find_bottleneck(reports).name, 'Slow')
+        report = format_report(reports)
+        self.assertIn('Slow is the bottleneck', report)
+        self.assertIn('Fast is blocked by the bottleneck', report)
+
+    def test_batched_and_concurrent_stages_are_not_the_bottleneck(self):
+        # The downloader keeps 20 items in service and the saver 10, but their queues are blocked
+        # by and starved by the sequential stage between them. The saver puts its batches into the
+        # queue of the next stage at once, which is long at arrivals but emptied right away.
+        self.write_profile([
+            ('Downloader', 100, 95, 9.5, 2), ('Sequential', 100, 99, 9.9, 0.1),
+            ('Saver', 500, 5, 0.5, 1), ('Fast', 100, 50, 0.001, 0.001), ('End', 100, 0, 0, None),
+        ])
+        [reports] = analyze(self.db_path)
+        downloader, sequential, saver, fast, end = reports
+        self.assertGreater(downloader.mean_in_service, sequential.mean_in_service)
+        self.assertGreater(saver.mean_in_service, sequential.mean_in_service)
+        self.assertLess(fast.queue_fill, 0.01)
+        self.assertIs(find_bottleneck(reports), sequential)
+        report = format_report(reports)
+        self.assertIn('Saver is starved by the bottleneck', report)
+        self.assertIn('Fast is starved by the bottleneck', report)
+
+    def test_no_backed_up_queue(self):
+        self.write_profile([
+            ('Downloader', 100, 0, 0, 2), ('Saver', 500, 5, 0.5, 1), ('End', 100, 0, 0, None),
+        ])
+        [reports] = analyze(self.db_path)
+        self.assertIsNone(find_bottleneck(reports))
+        self.assertIn('keep up with the first stage', format_report(reports))
+
+    def test_profile_without_maxsize(self):
+        self.write_profile([
+            ('Fast', None, 90, 9, 0.01), ('Slow', None, 99, 9.9, 0.1), ('End', None, 0, 0, None)
+        ], record_maxsize=False)
+        [reports] = analyze(self.db_path)
+        self.assertEqual([report.queue_fill for report in reports], [None, None, None])
+        self.assertIsNone(find_bottleneck(reports))
+        self.assertIn('No bounded input queue was backed up', format_report(reports))
+
+    def test_pipelines_are_analyzed_separately(self):
+        self.write_profile(
+            [('Fast', 100, 0, 0, 0.01), ('End', 100, 0, 0, None)],
+            [('Slow', 100, 99, 9.9, 0.1), ('Sequential', 100, 0, 0, 0.01),
+             ('End', 100, 0, 0, None)],
+        )
+        first, second = analyze(self.db_path)
+        self.assertEqual([report.name for report in first], ['Fast', 'End'])
+        self.assertEqual([report.name for report in second], ['Slow', 'Sequential', 'End'])
+        self.assertEqual(first[1].items, 0)
+        self.assertAlmostEqual(second[0].mean_waiting_time, 9.9)
+        self.assertIsNone(find_bottleneck(first))
+        self.assertIs(find_bottleneck(second), second[0])
@@ -0,0 +1,100 @@
+import os
+import sqlite3
+import tempfile
+import uuid
+
+import asynctest
+import mock
+
+from pulpcore.plugin.profile_analysis import analyze
+from pulpcore.plugin.stages import create_pipeline, EndStage, ProfilingQueue, Stage
+from pulpcore.plugin.stages import profiler
+
+
+class ProfileDBTestCase(asynctest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.db_path = os.path.join(temp_dir.name, 'profile')
+        for patcher in [
+            mock.patch.object(profiler, 'CONN', None),
+            mock.patch.object(profiler, 'debug_data_path', return_value=self.db_path),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        if profiler.CONN is not None:
+            profiler.CONN.close()
+
+    def count(self, table):
+        connection = sqlite3.connect(self.db_path)
+        try:
+            return connection.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+        finally:
+            connection.close()
+
+
+class TestProfilingQueue(ProfileDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for patcher in [
+            mock.patch.object(ProfilingQueue, 'buffer_size', 3),
+            mock.patch.object(ProfilingQueue, 'flush_interval', 3600),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        profiler.create_profile_db_and_connection()
+
+    def test_samples_are_written_when_a_buffer_is_full(self):
+        in_q, out_q = ProfilingQueue(uuid.uuid4()), ProfilingQueue(uuid.uuid4())
+        items = [mock.Mock(extra_data={}) for i in range(3)]
+        for item in items[:2]:
+            in_q.put_nowait(item)
+        self.assertEqual(self.count('system'), 0)
+        in_q.put_nowait(items[2])
+        self.assertEqual(self.count('system'), 3)
+
+        for item in items:
+            self.assertIs(in_q.get_nowait(), item)
+        for item in items[:2]:
+            out_q.put_nowait(item)
+        self.assertEqual(self.count('traffic'), 0)
+        out_q.put_nowait(items[2])
+        self.assertEqual(self.count('traffic'), 3)
+        self.assertEqual(self.count('system'), 6)
+
+    def test_samples_are_written_after_the_flush_interval(self):
+        queue = ProfilingQueue(uuid.uuid4())
+        queue.put_nowait(mock.Mock(extra_data={}))
+        self.assertEqual(self.count('system'), 0)
+        queue.flush_interval = 0
+        queue.put_nowait(mock.Mock(extra_data={}))
+        self.assertEqual(self.count('system'), 2)
+
+
+class TestProfiledPipeline(ProfileDBTestCase):
+
+    class FirstStage(Stage):
+        async def run(self):
+            for i in range(3):
+                await self.put(mock.Mock(extra_data={}))
+
+    class PassStage(Stage):
+        async def run(self):
+            async for item in self.items():
+                await self.put(item)
+
+    async def test_samples_are_written_when_the_pipeline_ends(self):
+        with mock.patch('pulpcore.plugin.stages.api.settings') as settings:
+            settings.PROFILE_STAGES_API = True
+            settings.TRACE_STAGES_API = False
+            await create_pipeline([self.FirstStage(), self.PassStage(), EndStage()], maxsize=5)
+        self.assertEqual(self.count('system'), 6)
+        self.assertEqual(self.count('traffic'), 3)
+        [reports] = analyze(self.db_path)
+        self.assertEqual([(report.num, report.maxsize, report.arrivals) for report in reports],
+                         [(1, 5, 3), (2, 5, 3)])
+        self.assertEqual(reports[0].items, 3)
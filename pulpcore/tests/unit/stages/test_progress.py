@@ -0,0 +1,38 @@
+from unittest import TestCase, mock
+
+from pulpcore.plugin.stages import ProgressThrottle
+
+
+class TestProgressThrottle(TestCase):
+
+    def setUp(self):
+        self.pb = mock.Mock(done=0)
+
+    def test_coalesces_increments(self):
+        progress = ProgressThrottle(self.pb, interval=60000)
+        for i in range(10):
+            progress.increase_by(1)
+        self.assertEqual(self.pb.done, 10)
+        self.pb.save.assert_not_called()
+
+    def test_saves_after_interval(self):
+        progress = ProgressThrottle(self.pb, interval=0)
+        progress.increase_by(2)
+        progress.increase_by(3)
+        self.assertEqual(self.pb.done, 5)
+        self.assertEqual(self.pb.save.call_count, 2)
+
+    def test_saves_after_max_items(self):
+        progress = ProgressThrottle(self.pb, interval=60000, max_items=3)
+        for i in range(7):
+            progress.increase_by(1)
+        self.assertEqual(self.pb.save.call_count, 2)
+
+    def test_flushes_on_exit(self):
+        with ProgressThrottle(self.pb, interval=60000) as progress:
+            progress.increase_by(1)
+            progress.increase_by(0)
+        self.assertEqual(self.pb.save.call_count, 1)
+        with ProgressThrottle(self.pb, interval=60000):
+            pass
+        self.assertEqual(self.pb.save.call_count, 1)
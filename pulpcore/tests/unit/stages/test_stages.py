@@ -1,9 +1,23 @@
 import asyncio
+import json
+import os
+import tempfile
+import threading
 
 import asynctest
 import mock
+from django.db import transaction
 
-from pulpcore.plugin.stages import Stage, EndStage
+from pulpcore.plugin.stages import (
+    AdaptiveBatchSizer,
+    ContentSaver,
+    create_pipeline,
+    DeferredContentSaver,
+    DownloadDirectory,
+    EndStage,
+    pipeline_metrics,
+    Stage,
+)
 
 
 class TestStage(asynctest.TestCase):
@@ -57,6 +71,78 @@ class TestStage(asynctest.TestCase):
         with self.assertRaises(StopAsyncIteration):
             await batch_it.__anext__()
 
+    async def test_maxsize(self):
+        contents = [mock.Mock(does_batch=True) for i in range(5)]
+        for content in contents:
+            self.in_q.put_nowait(content)
+        self.in_q.put_nowait(None)
+        batch_it = self.stage.batches(minsize=1, maxsize=2)
+        self.assertEqual(contents[0:2], await batch_it.__anext__())
+        self.assertEqual(contents[2:4], await batch_it.__anext__())
+        self.assertEqual(contents[4:], await batch_it.__anext__())
+        with self.assertRaises(StopAsyncIteration):
+            await batch_it.__anext__()
+
+    async def test_maxsize_from_stage(self):
+        contents = [mock.Mock(does_batch=True) for i in range(3)]
+        for content in contents:
+            self.in_q.put_nowait(content)
+        self.stage.batch_maxsize = 2
+        batch_it = self.stage.batches(minsize=50)
+        self.assertEqual(contents[0:2], await batch_it.__anext__())
+
+    async def test_max_latency(self):
+        c1 = mock.Mock(does_batch=True)
+        c2 = mock.Mock(does_batch=True)
+        self.in_q.put_nowait(c1)
+        batch_it = self.stage.batches(minsize=10, max_latency=0.01)
+        self.assertEqual([c1], await batch_it.__anext__())
+        self.in_q.put_nowait(c2)
+        self.in_q.put_nowait(None)
+        self.assertEqual([c2], await batch_it.__anext__())
+        with self.assertRaises(StopAsyncIteration):
+            await batch_it.__anext__()
+
+    async def test_batch_sizer_flushes_partial_batch(self):
+        c1 = mock.Mock(does_batch=True)
+        c2 = mock.Mock(does_batch=True)
+        self.in_q.put_nowait(c1)
+        batch_it = self.stage.batches(
+            batch_sizer=AdaptiveBatchSizer(minsize=10, maxsize=10, max_latency=0.01)
+        )
+        self.assertEqual([c1], await batch_it.__anext__())
+        self.in_q.put_nowait(c2)
+        self.in_q.put_nowait(None)
+        self.assertEqual([c2], await batch_it.__anext__())
+        with self.assertRaises(StopAsyncIteration):
+            await batch_it.__anext__()
+
+
+class TestAdaptiveBatchSizer(asynctest.TestCase):
+
+    def test_grows_with_fast_batches_and_backlog(self):
+        sizer = AdaptiveBatchSizer(minsize=10, maxsize=1000, target_service_time=1.0)
+        for i in range(20):
+            sizer.record(sizer.size, 0.001 * sizer.size, queue_depth=100)
+        self.assertEqual(sizer.size, 1000)
+
+    def test_shrinks_with_slow_batches(self):
+        sizer = AdaptiveBatchSizer(minsize=10, maxsize=1000, target_service_time=1.0)
+        sizer.size = 1000
+        for i in range(20):
+            sizer.record(sizer.size, 0.1 * sizer.size, queue_depth=100)
+        self.assertEqual(sizer.size, 10)
+
+    def test_does_not_grow_without_backlog(self):
+        sizer = AdaptiveBatchSizer(minsize=10, maxsize=1000, target_service_time=1.0)
+        for i in range(20):
+            sizer.record(sizer.size, 0.001 * sizer.size, queue_depth=0)
+        self.assertEqual(sizer.size, 10)
+
+    def test_invalid_bounds(self):
+        with self.assertRaises(ValueError):
+            AdaptiveBatchSizer(minsize=100, maxsize=10)
+
 
 class TestMultipleStages(asynctest.TestCase):
 
@@ -122,3 +208,297 @@ class TestMultipleStages(asynctest.TestCase):
                         first_stage(),
                         end_stage(),
                     )
+
+
+class TestCreatePipeline(asynctest.TestCase):
+
+    class FirstStage(Stage):
+        async def run(self):
+            for i in range(3):
+                await self.put(mock.Mock(does_batch=True))
+
+    class PassStage(Stage):
+        replica_safe = True
+
+        async def run(self):
+            async for d_content in self.items():
+                await self.put(d_content)
+
+    class BatchPassStage(Stage):
+        replica_safe = True
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.seen = 0
+
+        async def run(self):
+            async for batch in self.batches(minsize=2):
+                for d_content in batch:
+                    await asyncio.sleep(0)  # Let the other replicas take turns
+                    self.seen += 1
+                    await self.put(d_content)
+
+    class CountingEndStage(EndStage):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.seen = 0
+
+        async def __call__(self):
+            async for _ in self.items():  # noqa
+                self.seen += 1
+
+    class ThreadRecordingStage(Stage):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.thread_ids = []
+
+        async def run(self):
+            async for d_content in self.items():
+                await self.run_in_db_executor(self.record_thread)
+                await self.put(d_content)
+
+        def record_thread(self):
+            self.thread_ids.append(threading.get_ident())
+
+    async def run_pipeline(self, stages):
+        with mock.patch('pulpcore.plugin.stages.api.settings') as settings:
+            settings.PROFILE_STAGES_API = False
+            settings.TRACE_STAGES_API = False
+            await create_pipeline(stages)
+
+    async def test_in_q_maxsize(self):
+        first_stage = self.FirstStage()
+        deep_stage = self.PassStage()
+        deep_stage.in_q_maxsize = 7
+        default_stage = self.PassStage()
+        end_stage = EndStage()
+        with mock.patch('pulpcore.plugin.stages.api.settings') as settings:
+            settings.PROFILE_STAGES_API = False
+            settings.TRACE_STAGES_API = False
+            await create_pipeline([first_stage, deep_stage, default_stage, end_stage], maxsize=3)
+        self.assertEqual(deep_stage._in_q.maxsize, 7)
+        self.assertEqual(default_stage._in_q.maxsize, 3)
+        self.assertEqual(end_stage._in_q.maxsize, 3)
+
+    async def test_replicas(self):
+        first_stage = self.FirstStage()
+        replicas = [self.BatchPassStage() for i in range(3)]
+        item_replicas = [self.PassStage() for i in range(2)]
+        end_stage = self.CountingEndStage()
+        await self.run_pipeline([first_stage, replicas, item_replicas, end_stage])
+        self.assertEqual(sum(replica.seen for replica in replicas), 3)
+        self.assertEqual(end_stage.seen, 3)
+        for replica in replicas:
+            self.assertIs(replica._in_q, first_stage._out_q)
+            self.assertIs(replica._out_q, item_replicas[0]._in_q)
+
+    async def test_replicas_must_be_replica_safe(self):
+        stage = EndStage()
+        with self.assertRaises(ValueError):
+            await self.run_pipeline([self.FirstStage(), [self.PassStage(), stage], EndStage()])
+
+    async def test_download_directory_is_deleted(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        paths = []
+
+        class FailingStage(Stage):
+            async def run(self):
+                paths.append(self._temp_dir)
+                open(os.path.join(self._temp_dir, 'download'), 'w').close()
+                raise ValueError()
+
+        job = mock.Mock(origin='worker', id='task')
+        with mock.patch.object(DownloadDirectory, 'needed', return_value=True), \
+                mock.patch.object(DownloadDirectory, '_worker_path',
+                                  side_effect=lambda hostname: os.path.join(temp_dir.name,
+                                                                            hostname)), \
+                mock.patch('pulpcore.tasking.services.storage.get_current_job', return_value=job):
+            with self.assertRaises(ValueError):
+                await self.run_pipeline([self.FirstStage(), FailingStage(), EndStage()])
+        self.assertEqual(paths, [os.path.join(temp_dir.name, 'worker', 'task')])
+        self.assertEqual(os.listdir(temp_dir.name), ['worker'])
+        self.assertEqual(os.listdir(os.path.dirname(paths[0])), [])
+
+    async def test_run_in_db_executor(self):
+        stage = self.ThreadRecordingStage()
+        await self.run_pipeline([self.FirstStage(), stage, EndStage()])
+        self.assertEqual(len(stage.thread_ids), 3)
+        self.assertNotIn(threading.get_ident(), stage.thread_ids)
+
+    async def test_run_in_db_executor_without_pipeline(self):
+        stage = self.ThreadRecordingStage()
+        in_q = asyncio.Queue()
+        stage._connect(in_q, asyncio.Queue())
+        in_q.put_nowait(mock.Mock())
+        in_q.put_nowait(None)
+        await stage()
+        self.assertEqual(stage.thread_ids, [threading.get_ident()])
+
+    async def test_metrics(self):
+        first_stage = self.FirstStage()
+        batch_stage = self.BatchPassStage()
+        end_stage = EndStage()
+        stages = [first_stage, batch_stage, end_stage]
+        await self.run_pipeline(stages)
+        snapshots = pipeline_metrics(stages)
+        self.assertEqual([snapshot['stage'] for snapshot in snapshots], [str(s) for s in stages])
+        self.assertEqual(snapshots[0]['items_out'], 3)
+        self.assertEqual(snapshots[1]['items_in'], 3)
+        self.assertEqual(snapshots[1]['items_out'], 3)
+        self.assertEqual(snapshots[1]['batch_sizes']['sum'], 3)
+        self.assertEqual(
+            snapshots[1]['service_times']['count'], snapshots[1]['batch_sizes']['count']
+        )
+        self.assertEqual(snapshots[2]['items_in'], 3)
+
+    async def run_with_slow_consumer(self, stage, items, consumer_delay):
+        in_q = asyncio.Queue()
+        out_q = asyncio.Queue(maxsize=1)
+        stage._connect(in_q, out_q)
+        for i in range(items):
+            in_q.put_nowait(mock.Mock())
+        in_q.put_nowait(None)
+
+        async def consume():
+            await asyncio.sleep(consumer_delay)
+            while await out_q.get() is not None:
+                pass
+
+        await asyncio.gather(stage(), consume())
+
+    async def test_service_times_exclude_blocked_puts(self):
+        class SequentialStage(Stage):
+            async def run(self):
+                async for item in self.items():
+                    await self.put(item)
+
+        stage = SequentialStage()
+        await self.run_with_slow_consumer(stage, items=2, consumer_delay=0.05)
+        self.assertGreater(stage.metrics.put_blocked_times.sum, 0.04)
+        self.assertLess(stage.metrics.service_times.sum, 0.04)
+
+    async def test_service_times_of_concurrent_stage(self):
+        class ConcurrentStage(Stage):
+            async def run(self):
+                puts = []
+                async for item in self.items():
+                    puts.append(asyncio.ensure_future(self.put(item)))
+                    await asyncio.sleep(0.02)
+                await asyncio.gather(*puts)
+
+        stage = ConcurrentStage()
+        await self.run_with_slow_consumer(stage, items=5, consumer_delay=0.09)
+        # The puts blocked in other tasks than the one receiving the items
+        self.assertGreater(stage.metrics.put_blocked_times.sum, 0.1)
+        self.assertEqual(stage.metrics.service_times.count, 5)
+        self.assertGreater(stage.metrics.service_times.sum, 0.09)
+
+    async def test_tracing(self):
+        fd, path = tempfile.mkstemp(suffix='.trace.json')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        stage = self.ThreadRecordingStage()
+        with mock.patch('pulpcore.plugin.stages.api.settings') as settings, \
+                mock.patch('pulpcore.plugin.stages.api.debug_data_path') as debug_data_path:
+            settings.PROFILE_STAGES_API = False
+            settings.TRACE_STAGES_API = True
+            debug_data_path.return_value = path[:-len('.trace.json')]
+            await create_pipeline([self.FirstStage(), stage, EndStage()])
+        with open(path) as trace_file:
+            events = json.load(trace_file)['traceEvents']
+        names = [event['name'] for event in events if event['tid'] == stage._trace_track]
+        self.assertEqual(names.count('item'), 3)
+        self.assertEqual(names.count('wait'), 3)
+        self.assertEqual(len([name for name in names if name.endswith('.record_thread')]), 3)
+
+    @staticmethod
+    def in_atomic_block():
+        return transaction.get_connection().in_atomic_block
+
+    async def test_content_saver_hooks_run_in_the_transaction(self):
+        calls = []
+        in_atomic_block = self.in_atomic_block
+
+        class HookedContentSaver(ContentSaver):
+            def _pre_save_sync(self, batch):
+                calls.append(('pre_save', threading.get_ident(), in_atomic_block()))
+
+            def _save_content_and_artifacts(self, batch):
+                calls.append(('save', threading.get_ident(), in_atomic_block()))
+
+            def _post_save_sync(self, batch):
+                calls.append(('post_save', threading.get_ident(), in_atomic_block()))
+
+        await self.run_pipeline([self.FirstStage(), HookedContentSaver(), EndStage()])
+        self.assertEqual([call[0] for call in calls], ['pre_save', 'save', 'post_save'])
+        self.assertEqual(len({call[1] for call in calls}), 1)
+        self.assertNotEqual(calls[0][1], threading.get_ident())
+        self.assertTrue(all(call[2] for call in calls))
+
+    async def test_deferred_content_saver_hooks_run_in_the_transaction(self):
+        calls = []
+        in_atomic_block = self.in_atomic_block
+
+        class HookedDeferredContentSaver(DeferredContentSaver):
+            def _resolve_deferred_batch(self, batch):
+                calls.append(('resolve', threading.get_ident(), in_atomic_block()))
+
+            def _pre_save_sync(self, batch):
+                calls.append(('pre_save', threading.get_ident(), in_atomic_block()))
+
+            def _save_content_and_remote_artifacts(self, batch):
+                calls.append(('save', threading.get_ident(), in_atomic_block()))
+
+            def _post_save_sync(self, batch):
+                calls.append(('post_save', threading.get_ident(), in_atomic_block()))
+
+        await self.run_pipeline([self.FirstStage(), HookedDeferredContentSaver(), EndStage()])
+        self.assertEqual([call[0] for call in calls], ['resolve', 'pre_save', 'save', 'post_save'])
+        self.assertEqual(len({call[1] for call in calls}), 1)
+        self.assertNotEqual(calls[0][1], threading.get_ident())
+        self.assertTrue(all(call[2] for call in calls))
+
+    async def test_deprecated_hooks_are_awaited_in_the_transaction(self):
+        calls = []
+        in_atomic_block = self.in_atomic_block
+
+        class HookedContentSaver(ContentSaver):
+            async def _pre_save(self, batch):
+                await asyncio.sleep(0)
+                calls.append(('pre_save', threading.get_ident(), in_atomic_block()))
+
+            def _save_content_and_artifacts(self, batch):
+                calls.append(('save', threading.get_ident(), in_atomic_block()))
+
+            async def _post_save(self, batch):
+                await asyncio.sleep(0)
+                calls.append(('post_save', threading.get_ident(), in_atomic_block()))
+
+        with self.assertWarns(DeprecationWarning):
+            stage = HookedContentSaver()
+        await self.run_pipeline([self.FirstStage(), stage, EndStage()])
+        self.assertEqual([call[0] for call in calls], ['pre_save', 'save', 'post_save'])
+        self.assertEqual({call[1] for call in calls}, {threading.get_ident()})
+        self.assertTrue(all(call[2] for call in calls))
+
+    async def test_deprecated_hooks_of_deferred_content_saver(self):
+        calls = []
+
+        class HookedDeferredContentSaver(DeferredContentSaver):
+            def _resolve_deferred_batch(self, batch):
+                calls.append('resolve')
+
+            async def _pre_save(self, batch):
+                calls.append('pre_save')
+
+            def _save_content_and_remote_artifacts(self, batch):
+                calls.append('save')
+
+            async def _post_save(self, batch):
+                calls.append('post_save')
+
+        with self.assertWarns(DeprecationWarning):
+            stage = HookedDeferredContentSaver()
+        await self.run_pipeline([self.FirstStage(), stage, EndStage()])
+        self.assertEqual(calls, ['resolve', 'pre_save', 'save', 'post_save'])
@@ -0,0 +1,45 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from pulpcore.plugin.stages import Stage, Tracer
+
+
+class TestTracer(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def test_ring_buffer(self):
+        tracer = Tracer(self.path, maxlen=3)
+        track = tracer.track(Stage())
+        for i in range(5):
+            tracer.add_span(track, 'batch', 'stage', i, i + 0.5, size=i)
+        self.assertEqual([event['args']['size'] for event in tracer.events], [2, 3, 4])
+
+    def test_tracks(self):
+        tracer = Tracer(self.path)
+        stage = Stage()
+        self.assertEqual(tracer.track(stage), 1)
+        self.assertEqual(tracer.track(Stage()), 2)
+        self.assertEqual(tracer.track(stage), 1)
+
+    def test_write(self):
+        tracer = Tracer(self.path)
+        stage = Stage()
+        track = tracer.track(stage)
+        with tracer.span(track, 'query', 'db'):
+            pass
+        with tracer.async_span(track, 'download', 'download', url='http://example.com'):
+            pass
+        tracer.write()
+        with open(self.path) as trace_file:
+            events = json.load(trace_file)['traceEvents']
+        self.assertEqual([event['ph'] for event in events], ['M', 'X', 'b', 'e'])
+        self.assertEqual(events[0]['args']['name'], str(stage))
+        self.assertEqual(events[1]['tid'], track)
+        self.assertEqual(events[2]['id'], events[3]['id'])
+        self.assertEqual(events[2]['args']['url'], 'http://example.com')
@@ -20,6 +20,11 @@ setup(
     python_requires='>=3.6',
     install_requires=requirements,
     include_package_data=True,
+    entry_points={
+        'console_scripts': [
+            'pulp-stages-profile=pulpcore.plugin.profile_analysis:main',
+        ],
+    },
     classifiers=(
         'License :: OSI Approved :: GNU General Public License v2 or later (GPLv2+)',
         'Operating System :: POSIX :: Linux',